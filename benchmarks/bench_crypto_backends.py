@@ -0,0 +1,48 @@
+""" Per call cost of the crypto primitives for the ctypes binding and the
+    _lwcrypto CPython extension module.  Build the extension first
+    (make -C lorawan/extension <platform>), then from the repository root:
+        python benchmarks/bench_crypto_backends.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lorawan'))
+import crypto
+import crypto_ctypes
+
+CALLS = 100000
+KEY = '\x00\x11\x22\x33\x44\x55\x66\x77\x88\x99\xaa\xbb\xcc\xdd\xee\xff'
+FRAME = '\x40\x04\x03\x02\x01\x00\x01\x00\x01' + 'x' * 12
+BLOCK = 'y' * 16
+
+def primitives(backend):
+    ctx = backend.KeyContext(KEY)
+    return [
+        ("aes_cmac", lambda: backend.aes_cmac(FRAME, KEY)),
+        ("aes128_encrypt", lambda: backend.aes128_encrypt(BLOCK, KEY)),
+        ("compute_uplink_mic", lambda: backend.compute_uplink_mic(FRAME, KEY, 0x01020304, 1)),
+        ("compute_nwk_skey", lambda: backend.compute_nwk_skey(0x123456, 0x13, 0x4000, KEY)),
+        ("aes_cmac_ctx", lambda: backend.aes_cmac_ctx(FRAME, ctx)),
+        ("aes128_encrypt_ctx", lambda: backend.aes128_encrypt_ctx(BLOCK, ctx)),
+        ("compute_uplink_mic_ctx", lambda: backend.compute_uplink_mic_ctx(FRAME, ctx, 0x01020304, 1)),
+        ("compute_nwk_skey_ctx", lambda: backend.compute_nwk_skey_ctx(0x123456, 0x13, 0x4000, ctx)),
+    ]
+
+def bench(fn):
+    return min(timeit.repeat(fn, number=CALLS, repeat=3)) / CALLS * 1e9
+
+def main():
+    if crypto.BACKEND == crypto_ctypes.__name__:
+        print("_lwcrypto extension module not built, only ctypes is measured")
+    backends = [crypto_ctypes]
+    if crypto.backend is not crypto_ctypes:
+        backends.append(crypto.backend)
+    results = [primitives(backend) for backend in backends]
+    print("%24s" % "ns/call" + "".join("%16s" % backend.__name__ for backend in backends))
+    for i in range(0, len(results[0])):
+        name = results[0][i][0]
+        print("%24s" % name + "".join("%16.0f" % bench(result[i][1]) for result in results))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+""" Device import cost for a large device CSV file: bulk parse and compile
+    of the device store (first run), memory-mapped store load (later runs)
+    and DevEUI lookup.  Run from the repository root:
+        python benchmarks/bench_device_import.py [devices]
+"""
+import os
+import sys
+import time
+import struct
+import random
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lorawan'))
+import devicestore
+
+DEVICES = 1000000
+LOOKUPS = 100000
+
+def write_device_file(path, count):
+    with open(path, 'w') as f:
+        f.write('DEVEUI,APPKEY\n')
+        f.write(''.join('%016X,%032X\n' % (0x70B3D50000000000 + i, i * 0x1234567) for i in xrange(0, count)))
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else DEVICES
+    tmpdir = tempfile.mkdtemp()
+    try:
+        device_file = os.path.join(tmpdir, '70B3D57ED0000001.csv')
+        write_device_file(device_file, count)
+
+        start = time.time()
+        store, errors = devicestore.load(device_file)
+        compile_time = time.time() - start
+        store.close()
+
+        start = time.time()
+        store, errors = devicestore.load(device_file)
+        load_time = time.time() - start
+
+        deveuis = [struct.pack('>Q', 0x70B3D50000000000 + random.randrange(0, count)) for i in xrange(0, LOOKUPS)]
+        start = time.time()
+        for deveui in deveuis:
+            store.get(deveui)
+        lookup_time = time.time() - start
+        store.close()
+
+        print("devices              %d" % count)
+        print("csv parse + compile  %.3f s" % compile_time)
+        print("store load (mmap)    %.6f s" % load_time)
+        print("lookup               %.0f ns" % (lookup_time / LOOKUPS * 1e9))
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+""" End-to-end join throughput: runs the harness in a subprocess over a
+    temporary conf directory of synthetic devices and drives it with the
+    load generator (lorawan.loadgen).  Run from the repository root:
+        python benchmarks/bench_end_to_end.py [devices] [gateways] [seconds] [conf json]
+"""
+import os
+import sys
+import json
+import time
+import socket
+import struct
+import shutil
+import tempfile
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from lorawan import loadgen
+
+DEVICES = 5000
+GATEWAYS = 10
+DURATION = 10.0
+JOINEUI = '70B3D57ED0000001'
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('localhost', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def wait_ready(port, timeout=30.0):
+    """ Wait for the PULL_ACK of the harness """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(0.2)
+    deadline = time.time() + timeout
+    try:
+        while time.time() < deadline:
+            sock.sendto(struct.pack('<BHB', 2, 0, 2) + '\xff' * 8, ('localhost', port))
+            try:
+                sock.recv(64)
+                return True
+            except socket.timeout:
+                pass
+        return False
+    finally:
+        sock.close()
+
+def main():
+    nb_devices = int(sys.argv[1]) if len(sys.argv) > 1 else DEVICES
+    nb_gateways = int(sys.argv[2]) if len(sys.argv) > 2 else GATEWAYS
+    duration = float(sys.argv[3]) if len(sys.argv) > 3 else DURATION
+    conf = json.loads(sys.argv[4]) if len(sys.argv) > 4 else {}
+
+    tmpdir = tempfile.mkdtemp()
+    harness = None
+    try:
+        conf_dir = os.path.join(tmpdir, 'conf')
+        os.mkdir(conf_dir)
+        conf['server_port'] = free_port()
+        with open(os.path.join(conf_dir, 'test_harness.conf'), 'w') as f:
+            json.dump(conf, f)
+        with open(os.path.join(conf_dir, JOINEUI + '.csv'), 'w') as f:
+            f.write('DEVEUI,APPKEY\n')
+            f.write(''.join('%016X,%032X\n' % (i + 1, i * 0x9E3779B9) for i in xrange(0, nb_devices)))
+
+        with open(os.devnull, 'w') as devnull:
+            harness = subprocess.Popen([sys.executable, os.path.join(ROOT, 'harness.py')], cwd=tmpdir,
+                                       stdout=devnull, stderr=devnull)
+        if not wait_ready(conf['server_port']):
+            print("harness not ready")
+            return
+
+        devices = loadgen.load_devices(conf_dir)
+        generator = loadgen.LoadGenerator(('localhost', conf['server_port']), nb_gateways, devices,
+                                          region_name=conf.get('region', loadgen.REGION_DEFAULT))
+        print("devices %d, gateways %d, %.0f s, conf %s" % (nb_devices, nb_gateways, duration, json.dumps(conf)))
+        loadgen.print_report(generator.run(duration))
+    finally:
+        if harness is not None:
+            harness.terminate()
+            harness.wait()
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main()
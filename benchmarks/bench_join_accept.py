@@ -0,0 +1,66 @@
+""" Join-request to join-accept frame cost on the RX1 critical path.
+
+    Compares the former path (new session with NwkSKey derivation, then
+    join-accept encryption) with a join-accept precomputed in the background
+    (NwkSKey derived on the first uplink). Run from the repository root:
+        python benchmarks/bench_join_accept.py
+"""
+import os
+import sys
+import struct
+import time
+import random
+import logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import harness
+from lorawan import crypto
+from lorawan import packet
+from lorawan import devicestore
+
+DEVICES = 20000
+
+def setup():
+    harness.devaddr_index.clear()
+    harness.devaddr_pools.clear()
+    app = harness.Application(struct.pack('>Q', 1))
+    devices = [harness.Device(struct.pack('>Q', i), struct.pack('>QQ', i, i)) for i in range(0, DEVICES)]
+    # join-accepts are only prepared for the devices of the store
+    app.reload_store(devicestore.DeviceStore(''.join(device.deveui for device in devices) +
+                                             ''.join(device.appkey for device in devices), DEVICES), [])
+    return app, devices
+
+def former_path(app, devices):
+    for device in devices:
+        appnonce = random.randint(1, 0xFFFFFF)
+        app.set_device_session(device, appnonce, 7)
+        device.session.nwkskey = crypto.compute_nwk_skey_ctx(appnonce, app.netid, 7, device.appkey_ctx)
+        packet.encode_join_accept_frame(device.appkey_ctx, appnonce, app.netid, device.session.devaddr)
+
+def precomputed_path(app, devices):
+    for device in devices:
+        appnonce, devaddr, frame = app.take_join_accept(device)
+        app.set_device_session(device, appnonce, 7, devaddr)
+
+def main():
+    logging.disable(logging.CRITICAL)
+    app, devices = setup()
+    start = time.time()
+    former_path(app, devices)
+    former = (time.time() - start) / DEVICES
+
+    app, devices = setup()
+    start = time.time()
+    for device in devices:
+        app.prepare_join_accept(device.deveui, device.appkey)
+    prepare = (time.time() - start) / DEVICES
+    start = time.time()
+    precomputed_path(app, devices)
+    precomputed = (time.time() - start) / DEVICES
+
+    print("backend %s" % crypto.BACKEND)
+    print("former path       %6.2f us/join-request" % (former * 1e6))
+    print("precomputed path  %6.2f us/join-request (%.2f us in the background)" % (precomputed * 1e6, prepare * 1e6))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+""" Join session expiry on the timing wheel, a soak test in fast forward.
+
+    Joins arrive at RATE per second of synthetic time, half of the devices send
+    their uplink and the others time out. Reports the cost of arming a session
+    timer, of ending the session on the uplink and of expiring it, and checks
+    that no session or DevAddr is left. Run from the repository root:
+        python benchmarks/bench_join_timeouts.py [joins]
+"""
+import os
+import sys
+import struct
+import time
+import logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import harness
+from lorawan import packet_forwarder_server
+from lorawan import timerwheel
+
+JOINS = 200000
+RATE = 1000.0
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000000.0
+
+    def __call__(self):
+        return self.now
+
+def main():
+    logging.disable(logging.CRITICAL)
+    joins = int(sys.argv[1]) if len(sys.argv) > 1 else JOINS
+    clock = packet_forwarder_server.clock = Clock()
+    harness.join_timeouts = wheel = timerwheel.TimingWheel()
+    harness.devaddr_index.clear()
+    harness.devaddr_pools.clear()
+    app = harness.Application(struct.pack('>Q', 1))
+    devices = [harness.Device(struct.pack('>Q', i), struct.pack('>QQ', i, i)) for i in range(0, joins)]
+
+    arm = end = expire = 0.0
+    max_sessions = 0
+    for i, device in enumerate(devices):
+        clock.now += 1 / RATE
+        start = time.time()
+        app.set_device_session(device, 1, 7)
+        arm += time.time() - start
+        if i % 2:
+            start = time.time()
+            app.end_device_session(device)
+            end += time.time() - start
+        start = time.time()
+        harness.join_timeout_handler(wheel.advance(clock.now))
+        expire += time.time() - start
+        max_sessions = max(max_sessions, len(harness.devaddr_index))
+    while len(wheel):
+        clock.now += 1.0
+        start = time.time()
+        harness.join_timeout_handler(wheel.advance(clock.now))
+        expire += time.time() - start
+
+    print("joins %d, %d sessions at most, %d left, %d DevAddrs allocated" %
+          (joins, max_sessions, len(harness.devaddr_index), len(harness.devaddr_pool(app.netid))))
+    print("arm     %6.2f us/session" % (arm / joins * 1e6))
+    print("end     %6.2f us/session" % (end / (joins // 2) * 1e6))
+    print("expire  %6.2f us/session, advance included" % (expire / (joins - joins // 2) * 1e6))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+""" Memory and decode cost of lorawan.packet.Packet over a million synthetic
+    frames, half join-requests and half uplinks.  Reports the resident memory
+    held by the Packet objects (frame bytes excluded) and the time to build
+    them, then the time to read the header fields.  Run from the repository root:
+        python benchmarks/bench_packet_memory.py [frames]
+"""
+import os
+import sys
+import gc
+import time
+import struct
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lorawan'))
+import packet
+
+FRAMES = 1000000
+
+def rss():
+    """ resident set size in bytes (Linux) """
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+def synthetic_frames(count):
+    frames = []
+    for i in range(0, count):
+        if i & 1:
+            frames.append(struct.pack('<BIBH', 0x40, i, 0, i & 0xFFFF) + '\x01\x00\x00\x00\x00')
+        else:
+            frames.append(struct.pack('<BQQHI', 0x00, 0x70B3D57ED0000001, i, i & 0xFFFF, 0))
+    return frames
+
+def read_fields(pkts):
+    for pkt in pkts:
+        if pkt.is_join_request():
+            pkt.get_AppEui(), pkt.get_DevEui(), pkt.DevNonce
+        else:
+            pkt.DevAddr, pkt.FCnt, pkt.MIC
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else FRAMES
+    frames = synthetic_frames(count)
+    gc.collect()
+    gc.disable()
+    base = rss()
+    start = time.time()
+    pkts = [packet.Packet(frame) for frame in frames]
+    parse = time.time() - start
+    held = rss() - base
+    start = time.time()
+    read_fields(pkts)
+    fields = time.time() - start
+    with_fields = rss() - base
+    gc.enable()
+    print("frames               %d" % count)
+    print("construct   ns/frame %.0f" % (parse / count * 1e9))
+    print("packets     B/frame  %.0f" % (float(held) / count))
+    print("fields read ns/frame %.0f" % (fields / count * 1e9))
+    print("with fields B/frame  %.0f" % (float(with_fields) / count))
+
+if __name__ == '__main__':
+    main()
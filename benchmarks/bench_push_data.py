@@ -0,0 +1,55 @@
+""" PUSH_DATA decode and PULL_RESP txpk encode costs.
+
+    Compares json.loads of every datagram with the server fast path (stat
+    only datagrams skipped, ujson when installed) and the json.dumps of a txpk
+    dictionary with the per gateway txpk template. Run from the repository root:
+        python benchmarks/bench_push_data.py
+"""
+import binascii
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lorawan'))
+import packet_forwarder_server as pfs
+
+NUMBER = 100000
+
+RXPK = {"tmst": 3512348611, "chan": 2, "rfch": 0, "freq": 902.7, "stat": 1, "modu": "LORA", "datr": "SF10BW125",
+        "codr": "4/5", "lsnr": 9.5, "rssi": -35, "size": 23, "data": binascii.b2a_base64('\x00' * 23).strip()}
+STAT = {"time": "2014-01-12 08:59:28 GMT", "lati": 46.24, "long": 3.2523, "alti": 145, "rxnb": 2, "rxok": 2,
+        "rxfw": 2, "ackr": 100.0, "dwnb": 2, "txnb": 2}
+
+def decode_json(payload):
+    return json.loads(payload).get('rxpk', None)
+
+def decode_fast(payload):
+    if payload.find('"rxpk"') < 0:
+        return None
+    return pfs.json_loads(payload).get('rxpk', None)
+
+def encode_json(frame, tmst, freq, datr):
+    tx_json = {'freq': freq, 'datr': datr, 'codr': '4/5', 'tmst': tmst, 'modu': 'LORA', 'ipol': 'true',
+               'rfch': 0, 'ant': 0, 'powe': 20, 'data': frame.encode("base64").rstrip(), 'size': len(frame)}
+    return json.dumps({'txpk': tx_json})
+
+def encode_template(template, frame, tmst, freq, datr):
+    return template % (tmst, repr(freq), datr, len(frame), binascii.b2a_base64(frame)[:-1])
+
+def ns(fn, *args):
+    return min(timeit.repeat(lambda: fn(*args), number=NUMBER, repeat=3)) / NUMBER * 1e9
+
+def main():
+    print("JSON backend: %s" % pfs.JSON_BACKEND)
+    rxpk = json.dumps({'rxpk': [RXPK]})
+    stat = json.dumps({'stat': STAT})
+    print("rxpk datagram  json.loads %6.0f ns  fast path %6.0f ns" % (ns(decode_json, rxpk), ns(decode_fast, rxpk)))
+    print("stat datagram  json.loads %6.0f ns  fast path %6.0f ns" % (ns(decode_json, stat), ns(decode_fast, stat)))
+    frame = '\x20' * 17
+    template = pfs.render_txpk_template('4/5')
+    print("txpk           json.dumps %6.0f ns  template  %6.0f ns" %
+          (ns(encode_json, frame, 5000000, 923.3, 'SF10BW500'), ns(encode_template, template, frame, 5000000, 923.3, 'SF10BW500')))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+""" Per join-request region lookups: datr -> DR, channel, RX1 RxConf.
+
+    Compares the former float arithmetic and try/except lookups of the US915
+    region with the compiled tables, through the sf2txdr/tx_channel/get_rx1_conf
+    calls and through the single Region.lookup of the harness. Run from the repository root:
+        python benchmarks/bench_region.py
+"""
+import os
+import sys
+import timeit
+import logging
+from collections import namedtuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lorawan'))
+import region
+
+LOOKUPS = 200000
+
+class FormulaUS915(object):
+    """ US915 lookups as computed per packet before the region tables """
+    def __init__(self):
+        self.dr2sf_table = region.REGIONS['US915']['datarates']
+        self.sf2txdr_map = {"SF10BW125":0, "SF9BW125":1, "SF8BW125":2, "SF7BW125":3, "SF8BW500":4}
+        self.rx1_dr_offset = region.REGIONS['US915']['rx1_dr']
+        self.rx1freqs = [round(923.3 + (i * .6), 2) for i in range(0, 8)]
+
+    def sf2txdr(self, sf):
+        try:
+            return self.sf2txdr_map[sf]
+        except:
+            return
+
+    def tx_channel(self, freq_mhz, datarate):
+        if datarate in [0,1,2,3]:
+            return int((freq_mhz - 902.3) / .2)
+        elif datarate == 4:
+            return 64 + int((freq_mhz - 903.0) / 1.6)
+        return None
+
+    def get_rx1_conf(self, tx_freq, tx_dr, rx1_dr_offset=0):
+        try:
+            chnl = self.tx_channel(tx_freq, tx_dr) % len(self.rx1freqs)
+            return region.RxConf(freq=self.rx1freqs[chnl], dr=self.rx1_dr_offset[tx_dr][rx1_dr_offset])
+        except:
+            return None
+
+def join_request_lookups(r, freqs, datr):
+    for freq in freqs:
+        dr = r.sf2txdr(datr)
+        r.tx_channel(freq, dr)
+        r.get_rx1_conf(freq, dr)
+
+def join_request_lookup(r, freqs, datr):
+    for freq in freqs:
+        uplink = r.lookup(freq, datr)
+        uplink.channel, uplink.rx1[0]
+
+def main():
+    logging.disable(logging.CRITICAL)
+    freqs = [round(902.3 + (i % 64) * 0.2, 1) for i in range(0, LOOKUPS)]
+    for name, r in [('formula', FormulaUS915()), ('tables', region.get('US915'))]:
+        elapsed = min(timeit.repeat(lambda: join_request_lookups(r, freqs, 'SF10BW125'), number=1, repeat=3))
+        print("%-8s %6.0f ns/join-request" % (name, elapsed / LOOKUPS * 1e9))
+    r = region.get('US915')
+    elapsed = min(timeit.repeat(lambda: join_request_lookup(r, freqs, 'SF10BW125'), number=1, repeat=3))
+    print("%-8s %6.0f ns/join-request" % ('lookup', elapsed / LOOKUPS * 1e9))
+
+    for name in region.SUPPORTED:
+        r = region.get(name)
+        print("%s: %d uplink channels, %d (frequency, DR) entries" % (name, r.nb_channels, len(r.uplinks)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+""" Uplink DevAddr lookup cost as a function of the number of applications.
+
+    Compares the lookup of harness.uplink_handler (global DevAddr index) with
+    the former scan of every application.  Run from the repository root:
+        python benchmarks/bench_uplink_lookup.py
+"""
+import os
+import sys
+import struct
+import timeit
+import logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import harness
+
+DEVICES_PER_APP = 10
+LOOKUPS = 100000
+APP_COUNTS = [1, 10, 100, 1000]
+
+class Uplink(object):
+    def __init__(self, devaddr):
+        self.DevAddr = devaddr
+
+def setup(nb_apps):
+    harness.appdb = {}
+    harness.devaddr_index.clear()
+    harness.devaddr_pools.clear()
+    uplinks = []
+    for i in range(0, nb_apps):
+        joineui = struct.pack('>Q', i)
+        app = harness.Application(joineui)
+        for j in range(0, DEVICES_PER_APP):
+            device = harness.Device(struct.pack('>Q', i * DEVICES_PER_APP + j), '\x00' * 16)
+            app.new_device_session(device, 0)
+            uplinks.append(Uplink(device.session.devaddr))
+        harness.appdb[joineui] = app
+    return uplinks
+
+def index_lookup(pkt):
+    entry = harness.devaddr_index.get(pkt.DevAddr, None)
+    if entry is not None and entry[1].joining:
+        return entry
+
+def scan_lookup(pkt):
+    for joineui in harness.appdb:
+        app = harness.appdb[joineui]
+        device = app.devaddr2device(pkt.DevAddr)
+        if device is not None and device.joining:
+            break
+
+def bench(fn, uplinks, number):
+    nb = len(uplinks)
+    pkts = [uplinks[i % nb] for i in range(0, number)]
+    def loop():
+        for pkt in pkts:
+            fn(pkt)
+    return min(timeit.repeat(loop, number=1, repeat=3)) / number * 1e9
+
+def main():
+    harness.logger.setLevel(logging.CRITICAL)
+    print("%8s %16s %16s" % ("apps", "index ns/uplink", "scan ns/uplink"))
+    for nb_apps in APP_COUNTS:
+        uplinks = setup(nb_apps)
+        index_ns = bench(index_lookup, uplinks, LOOKUPS)
+        scan_ns = bench(scan_lookup, uplinks, max(LOOKUPS / nb_apps, 100))
+        print("%8d %16.0f %16.0f" % (nb_apps, index_ns, scan_ns))
+
+if __name__ == '__main__':
+    main()
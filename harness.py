@@ -2,27 +2,118 @@ from lorawan import packet
 from lorawan import region
 from lorawan import crypto
 from lorawan import packet_forwarder_server 
+from lorawan import logqueue
+from lorawan import devicestore
+from lorawan import metrics
+from lorawan import dedup
+from lorawan import capture
+from lorawan import timerwheel
+from lorawan import confwatch
+from lorawan import devaddrpool
+import argparse
 import json
 import sys
-import csv
 import os
 import binascii
 import logging
 import random
 import glob
-from collections import namedtuple
+import zlib
+import multiprocessing
+import threading
+import Queue
+import atexit
+import time
 
 # Harness Version
 version="1.0.0"
 TEST_HARNESS_NAME = "Test Harness - Gateway Over the Air Activation"
 
-# Tuple of device network session.  Session does not include the nwkskey
-# because it is not needed by the test harness 
-JoinSession = namedtuple('JoinSession', ['appnonce', 'devaddr', 'nwkskey'])
+class JoinSession(object):
+    """ Network session of a joining device, freed once the device passes or fails.
+        The NwkSKey is derived when the first uplink is validated """
+    __slots__ = ('appnonce', 'devaddr', 'devnonce', 'nwkskey', 'timer')
+
+    def __init__(self, appnonce, devaddr, devnonce):
+        self.appnonce = appnonce
+        self.devaddr = devaddr
+        self.devnonce = devnonce
+        self.nwkskey = None
+        # join_timeouts timer, the session ends when no uplink came before it expires
+        self.timer = None
+
+# Device test states, named after the result events
+JOIN_REQUEST_STATE = 'join_request'
+JOIN_ACCEPT_STATE = 'join_accept'
+JOIN_ACCEPT_LOST_STATE = 'join_accept_lost'
+OTAA_SUCCESS_STATE = 'otaa_success'
+MIC_FAILED_STATE = 'mic_failed'
+NO_UPLINK_STATE = 'no_uplink'
+
+PENDING = 'pending'
+PASSED = 'passed'
+FAILED = 'failed'
+VERDICTS = {JOIN_REQUEST_STATE: PENDING, JOIN_ACCEPT_STATE: PENDING, JOIN_ACCEPT_LOST_STATE: FAILED,
+            OTAA_SUCCESS_STATE: PASSED, MIC_FAILED_STATE: FAILED, NO_UPLINK_STATE: FAILED}
+# state -> states it is entered from, None for a device not tested yet.
+# A new join-request starts another attempt whatever the state
+TRANSITIONS = {JOIN_REQUEST_STATE: frozenset([None] + VERDICTS.keys()),
+               # a join-accept rejected by the gateway is sent again or lost
+               JOIN_ACCEPT_STATE: frozenset([JOIN_REQUEST_STATE, JOIN_ACCEPT_STATE]),
+               JOIN_ACCEPT_LOST_STATE: frozenset([JOIN_REQUEST_STATE, JOIN_ACCEPT_STATE]),
+               OTAA_SUCCESS_STATE: frozenset([JOIN_ACCEPT_STATE]),
+               MIC_FAILED_STATE: frozenset([JOIN_ACCEPT_STATE]),
+               NO_UPLINK_STATE: frozenset([JOIN_ACCEPT_STATE])}
+
+RESULT_COLUMNS = ('joineui', 'deveui', 'state', 'verdict', 'attempts', 'channel', 'dr', 'rxslot', 'devaddr',
+                  'join_request_time', 'join_accept_time', 'end_time')
+
+class DeviceResult(object):
+    """ OTAA test record of a device: state of the last attempt, time of each step,
+        join-request channel and DR, join-accept RX slot and number of attempts """
+    __slots__ = ('state', 'attempts', 'channel', 'dr', 'rxslot', 'devaddr',
+                 'join_request_time', 'join_accept_time', 'end_time')
+
+    def __init__(self):
+        self.state = None
+        self.attempts = 0
+        self.channel = None
+        self.dr = None
+        self.rxslot = None
+        self.devaddr = None
+        self.join_request_time = None
+        self.join_accept_time = None
+        self.end_time = None
+
+    def step(self, state, now, fields):
+        if state == JOIN_REQUEST_STATE:
+            self.attempts += 1
+            self.channel = fields.get('channel', None)
+            self.dr = fields.get('dr', None)
+            self.rxslot = None
+            self.join_request_time = now
+            self.join_accept_time = None
+            self.end_time = None
+        elif state == JOIN_ACCEPT_STATE:
+            self.rxslot = fields.get('rxslot', None)
+            self.devaddr = fields.get('devaddr', None)
+            self.join_accept_time = now
+        else:
+            self.end_time = now
+        self.state = state
+
+    def row(self, joineui, deveui):
+        return (joineui, deveui, self.state, VERDICTS[self.state], self.attempts, self.channel, self.dr, self.rxslot,
+                '%08X' % self.devaddr if self.devaddr is not None else None,
+                self.join_request_time, self.join_accept_time, self.end_time)
 
 # Dictionary of Applications indexed by JoinEui
 appdb = {}
 
+# Dictionary of (Application, Device) of the joining devices indexed by DevAddr, 
+# maintained by Application.set_device_session and Application.end_device_session
+devaddr_index = {}
+
 # custom log level for test results 
 TEST = logging.WARNING + 1
 logging.addLevelName(TEST, 'TEST')
@@ -37,20 +128,74 @@ logger.setLevel(logging.DEBUG)
 tfmt = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
 
 # test logging 
-th = logging.FileHandler('test.log')
+th = logqueue.BatchFileHandler('test.log')
 th.setLevel(TEST)
 th.setFormatter(tfmt)
 logger.addHandler(th)
 
 # console logging
-ch = logging.StreamHandler()
+ch = logqueue.BatchStreamHandler()
 cfmt = logging.Formatter('%(asctime)s - %(levelname)s - %(name)s - %(message)s')
 ch.setFormatter(cfmt)
 logger.addHandler(ch)
 
+# structured test results, one JSON line per device event
+results = logging.getLogger('harness.results')
+results.setLevel(TEST)
+results.propagate = False
+
+class HexEui(object):
+    """ Hex EUI, converted when the log message is formatted """
+    __slots__ = ('eui', 'upper')
+
+    def __init__(self, eui, upper=True):
+        self.eui = eui
+        self.upper = upper
+
+    def __str__(self):
+        eui = binascii.hexlify(self.eui)
+        return eui.upper() if self.upper else eui
+
+def test_result(application, device, event, **fields):
+    if results.handlers:
+        fields['event'] = event
+        fields['joineui'] = application.joineui
+        fields['deveui'] = binascii.hexlify(device.deveui).upper()
+        results.log(TEST, event, extra={'result': fields})
+
+def test_step(application, device, state, now, **fields):
+    """ Move the device test to state: logs the result event, updates the application
+        summary and streams the device record once the attempt passed or failed """
+    result = device.result
+    previous = result.state if result is not None else None
+    if previous not in TRANSITIONS[state]:
+        logger.warning("joineui=%s, deveui=%s : unexpected %s in state %s",
+                       application.joineui, HexEui(device.deveui), state, previous)
+        return
+    if result is None:
+        result = device.result = DeviceResult()
+    result.step(state, now, fields)
+    application.update_summary(previous, state)
+    test_result(application, device, state, **fields)
+    if VERDICTS[state] != PENDING and results.handlers:
+        results.log(TEST, state, extra={'row': result.row(application.joineui, binascii.hexlify(device.deveui).upper())})
+
 CONF_DIR = 'conf'
 TEST_CONF_FILE_DEFAULT = 'test_harness.conf'
+SERVER_HOST_DEFAULT = "localhost"
 SERVER_PORT_DEFAULT = 1780
+RX_QUEUE_SIZE_DEFAULT = 0
+WORKERS_DEFAULT = 1
+RESULTS_FILE_DEFAULT = 'test_results.jsonl'
+RESULTS_CSV_DEFAULT = 'test_results.csv'
+METRICS_PORT_DEFAULT = 0
+PRECOMPUTE_JOIN_ACCEPTS_DEFAULT = 10000
+# seconds from the join-request to the first uplink
+JOIN_TIMEOUT_DEFAULT = 60.0
+WATCH_CONF_DEFAULT = True
+NETID_DEFAULT = 0
+# NwkAddr range (first, last) of the harness instance, last None for the whole NetID
+DEVADDR_RANGE_DEFAULT = (1, None)
 LORAWAN_REGION_DEFAULT = "US915"
 
 # Packet Forwarder initialized in main 
@@ -58,36 +203,112 @@ forwarder = None
 # LoRaWAN Region 
 lw_region = None
 
-# DevAddr generator
-def generate_devaddr():
-    for devaddr in range(1,0x1FFFFF):
-        yield devaddr 
-devaddr_generator = generate_devaddr()
+# Prometheus endpoint port of the main process, worker i serves on metrics_port + 1 + i
+metrics_port = METRICS_PORT_DEFAULT
+
+UNKNOWN_JOINEUI_CNT = 'unknown_joineui'
+UNKNOWN_DEVEUI_CNT = 'unknown_deveui'
+JOIN_ACCEPT_CNT = 'join_accept'
+OTAA_SUCCESS_CNT = 'otaa_success'
+MIC_FAILED_CNT = 'mic_failed'
+PRECOMPUTED_JOIN_ACCEPT_CNT = 'precomputed_join_accept'
+NO_UPLINK_CNT = 'no_uplink'
+JOIN_TIMEOUT_CNT = 'join_timeout'
+CONF_RELOAD_CNT = 'conf_reload'
+DEVADDR_EXHAUSTED_CNT = 'devaddr_exhausted'
+counter = {UNKNOWN_JOINEUI_CNT:0, UNKNOWN_DEVEUI_CNT:0, JOIN_ACCEPT_CNT:0, OTAA_SUCCESS_CNT:0, MIC_FAILED_CNT:0,
+           PRECOMPUTED_JOIN_ACCEPT_CNT:0, NO_UPLINK_CNT:0, JOIN_TIMEOUT_CNT:0, CONF_RELOAD_CNT:0, DEVADDR_EXHAUSTED_CNT:0}
+
+def incr(name):
+    counter[name] = counter[name] + 1
+
+# Join path stage latency histograms
+DEVICE_LOOKUP_HIST = metrics.histogram('harness_device_lookup_seconds', 'Join-request JoinEUI and DevEUI lookup')
+KEY_DERIVATION_HIST = metrics.histogram('harness_key_derivation_seconds', 'NwkSKey derivation')
+JOIN_ACCEPT_ENCODE_HIST = metrics.histogram('harness_join_accept_encode_seconds', 'Join-accept frame encode')
+JOIN_HIST = metrics.histogram('harness_join_seconds', 'Join-request receipt to join-accept sent, RX1 budget used')
+
+# Log queues, records are written by background listener threads of the main process
+log_queue = None
+results_queue = None
+
+# NetID of the applications
+default_netid = NETID_DEFAULT
+# DevAddr pools by NetID, created on first use. Worker index of nb_workers
+# allocates the NwkAddrs first + index, first + index + nb_workers, ... of devaddr_range
+devaddr_pools = {}
+devaddr_range = DEVADDR_RANGE_DEFAULT
+devaddr_shard = (0, 1)
+# DevAddrs are also allocated by the join-accept precompute thread, the lock also
+# guards the prepared join-accepts of the applications
+devaddr_lock = threading.Lock()
+
+def devaddr_pool(netid):
+    pool = devaddr_pools.get(netid, None)
+    if pool is None:
+        index, nb_workers = devaddr_shard
+        first, last = devaddr_range
+        pool = devaddr_pools[netid] = devaddrpool.DevAddrPool(netid, first + index, last, nb_workers)
+    return pool
+
+def allocate_devaddr(netid):
+    """ A free DevAddr of netid, None when the pool is exhausted """
+    with devaddr_lock:
+        devaddr = devaddr_pool(netid).allocate()
+    if devaddr is None:
+        incr(DEVADDR_EXHAUSTED_CNT)
+    return devaddr
+
+def release_devaddr(netid, devaddr):
+    with devaddr_lock:
+        devaddr_pool(netid).release(devaddr)
+
+# Join sessions expiry, advanced by the packet forwarder server loop
+join_timeouts = None
+join_timeout = JOIN_TIMEOUT_DEFAULT
+
+# Join-accept precompute thread, started in main or by each worker
+join_accept_precompute = None
+precompute_budget = PRECOMPUTE_JOIN_ACCEPTS_DEFAULT
+
+# conf/*.csv watcher, started in main or by each worker, and the reloads it loaded
+# for apply_reloads to swap in between two packets
+watch_conf = WATCH_CONF_DEFAULT
+conf_poll_interval = confwatch.POLL_INTERVAL_DEFAULT
+pending_reloads = []
 
 class Device(object):
+    """ Device seen in a join-request, created on demand from the application device store """
+    __slots__ = ('__deveui', '__appkey', '__session', '__altrDr', '__result')
 
     def __init__(self, deveui, appkey):
         self.__appkey = appkey
         self.__deveui = deveui
-        self.__joining = False
-        self.__session = JoinSession(None,None,None)
+        self.__session = None
         self.__altrDr  = 0
+        self.__result = None
 
     @property
     def appkey(self):
         return self.__appkey
 
+    @property
+    def appkey_ctx(self):
+        # Expanded AppKey, bounded by the crypto key context cache
+        return crypto.key_context(self.__appkey)
+
     @property
     def deveui(self):
         return self.__deveui
 
     @property
-    def joining(self):
-        return self.__joining
+    def devaddr(self):
+        # DevAddr of the session, released when the session ends
+        return self.__session.devaddr if self.__session is not None else None
 
-    @joining.setter
-    def joining(self, joining):
-        self.__joining = joining
+    @property
+    def joining(self):
+        return self.__session is not None
 
     @property
     def session(self):
@@ -97,18 +318,32 @@ class Device(object):
     def session(self, session):
         self.__session = session
 
+    @property
+    def result(self):
+        # DeviceResult, None until the first join-request
+        return self.__result
+
+    @result.setter
+    def result(self, result):
+        self.__result = result
+
     def get_join_rxslot(self):
         rxslot = 1 if self.__altrDr & 1 == 0 else 2
         self.__altrDr = self.__altrDr + 1
         return rxslot
 
 class Application(object):
-    DEFAULT_NETID = 0
-    def __init__(self, joineui, netid=DEFAULT_NETID):
+    def __init__(self, joineui, netid=NETID_DEFAULT):
         self.__joineui = joineui
+        # Devices seen in join-requests, provisioning data stays in the device store
         self.__devices = {}
+        self.__store = None
         self.__netid = netid
-        self.__devaddr2device = {}
+        # DevEUI -> (appnonce, devaddr, join-accept frame, appkey) prepared ahead of the join-request,
+        # the DevAddr is allocated to the entry until it is used or discarded
+        self.__prepared = {}
+        # number of devices by verdict of their last attempt
+        self.__summary = {PENDING: 0, PASSED: 0, FAILED: 0}
 
     @property
     def joineui(self):
@@ -124,138 +359,516 @@ class Application(object):
 
     def import_devices(self, joineui, device_file):
         try:
-            with open(device_file) as csvfile:
-                reader = csv.DictReader(csvfile)
-                if 'DEVEUI' not in reader.fieldnames or 'APPKEY' not in reader.fieldnames:
-                    logger.error("Missing field names in f=%s" % device_file)
-                    sys.exit(-1)
-
-                row_nb = 0
-                for row in reader:
-                    row_nb = row_nb + 1
-                    try:
-                        deveui = row['DEVEUI'].strip()
-                        appkey = row['APPKEY'].strip()
-                    except:
-                        logger.critical("read file %s invalid row %d" % (device_file, row_nb))
-                        sys.exit(-1)
-
-                    # convert to binary 
-                    try:
-                        bin_deveui = binascii.unhexlify(deveui)
-                    except:
-                        bin_deveui = None 
-                    if bin_deveui is None or len(bin_deveui) != 8:
-                        logger.error("invalid deveui=%s in f=%s entry=%d" % (deveui, device_file, row_nb))
-                        sys.exit(-1)
-
-                    try:
-                        bin_appkey = binascii.unhexlify(appkey)
-                    except:
-                        bin_appkey = None 
-                    if bin_appkey is None or len(bin_appkey) != 16:
-                        logger.error("invalid appkey=%s in f=%s entry=%d" % (appkey, device_file, row_nb))
-                        sys.exit(-1)
-                    
-                    if bin_deveui not in self.__devices:
-                        self.__devices[bin_deveui] = Device(bin_deveui, bin_appkey)
-                    else:
-                        logger.error("Duplicate entries for deveui=%s found in f=%s" % (deveui, device_file))
-                        sys.exit(-1)
-        except IOError:
-            logger.critical("%s not found" % device_file)
+            store, errors = devicestore.load(device_file)
+        except (IOError, OSError):
+            logger.critical("%s not found", device_file)
+            sys.exit(-1)
+
+        if errors:
+            for error in errors:
+                logger.error(error)
+            logger.critical("f=%s has %d invalid entries", device_file, len(errors))
             sys.exit(-1)
 
-        logger.log(TEST, "joineui=%s imported %d devices" % (joineui, self.nb_devices))
+        self.__store = store
+        logger.log(TEST, "joineui=%s imported %d devices", joineui, self.nb_devices)
+
+    def reload_store(self, store, stale):
+        """ Swap in a reloaded device store. The devices of the stale DevEUIs, removed or
+            with a new AppKey, are forgotten with their session and result, the others keep theirs.
+            A None store removes all devices """
+        with devaddr_lock:
+            # swapped before the stale join-accepts are discarded: prepare_join_accept
+            # checks the store when it inserts one
+            self.__store = store
+            if store is None:
+                stale = set(self.__devices) | set(self.__prepared)
+        for deveui in stale:
+            self.discard_join_accept(deveui)
+            device = self.__devices.pop(deveui, None)
+            if device is not None:
+                self.end_device_session(device)
+                if device.result is not None:
+                    self.__summary[VERDICTS[device.result.state]] -= 1
 
     @property
     def nb_devices(self):
-        return len(self.__devices)
+        return len(self.__store) if self.__store is not None else 0
+
+    @property
+    def store(self):
+        return self.__store
+
+    def update_summary(self, previous, state):
+        if previous is not None:
+            self.__summary[VERDICTS[previous]] -= 1
+        self.__summary[VERDICTS[state]] += 1
+
+    def summary(self):
+        """ Devices by verdict, untested ones included """
+        summary = dict(self.__summary)
+        summary['untested'] = max(self.nb_devices - sum(self.__summary.values()), 0)
+        return summary
+
+    def new_device_session(self, device, devnonce):
+        return self.set_device_session(device, random.randint(1, 0xFFFFFF), devnonce)
+
+    def set_device_session(self, device, appnonce, devnonce, devaddr=None):
+        """ Start a session, on a new DevAddr unless devaddr was allocated with a prepared
+            join-accept. The previous session ends, False when no DevAddr is left """
+        self.end_device_session(device)
+        if devaddr is None:
+            devaddr = allocate_devaddr(self.__netid)
+            if devaddr is None:
+                return False
+        session = device.session = JoinSession(appnonce, devaddr, devnonce)
+        devaddr_index[devaddr] = (self, device)
+        if join_timeouts is not None:
+            now = packet_forwarder_server.clock()
+            session.timer = join_timeouts.schedule(now + join_timeout, (self, device), now)
+        return True
+
+    def session_nwkskey(self, device):
+        """ NwkSKey of the device session, derived on first use """
+        session = device.session
+        if session.nwkskey is None:
+            start = time.time()
+            session.nwkskey = crypto.compute_nwk_skey_ctx(session.appnonce, self.__netid, session.devnonce, device.appkey_ctx)
+            KEY_DERIVATION_HIST.observe(time.time() - start)
+        return session.nwkskey
 
-    def new_device_session(self, device, netid, devnonce):
-        devaddr = device.session.devaddr
+    def prepare_join_accept(self, deveui, appkey):
+        """ Draw the next AppNonce and DevAddr of a device and encrypt its join-accept,
+            which does not depend on the DevNonce. Runs in the precompute thread, a device
+            removed or re-keyed by a reload meanwhile is not prepared """
+        devaddr = allocate_devaddr(self.__netid)
         if devaddr is None:
-            devaddr = devaddr_generator.next() 
+            return
         appnonce = random.randint(1, 0xFFFFFF)
-        nwkskey = crypto.compute_nwk_skey(appnonce, netid, devnonce, device.appkey)
-        device.session = JoinSession(appnonce, devaddr, nwkskey)
-        self.__devaddr2device[devaddr] = device
+        frame = packet.encode_join_accept_frame(appkey, appnonce, self.__netid, devaddr)
+        with devaddr_lock:
+            # the store of a removed application is None
+            if self.__store is None or self.__store.get(deveui) != appkey:
+                devaddr_pool(self.__netid).release(devaddr)
+                return
+            previous = self.__prepared.get(deveui, None)
+            self.__prepared[deveui] = (appnonce, devaddr, frame, appkey)
+            if previous is not None:
+                devaddr_pool(self.__netid).release(previous[1])
+
+    def take_join_accept(self, device):
+        """ (appnonce, devaddr, frame) prepared for device or None, the DevAddr goes to the
+            session started with the frame """
+        with devaddr_lock:
+            prepared = self.__prepared.pop(device.deveui, None)
+        if prepared is None:
+            return None
+        appnonce, devaddr, frame, appkey = prepared
+        if appkey != device.appkey:
+            # prepared with the AppKey of a reloaded device file
+            release_devaddr(self.__netid, devaddr)
+            return None
+        return appnonce, devaddr, frame
+
+    def discard_join_accept(self, deveui):
+        with devaddr_lock:
+            prepared = self.__prepared.pop(deveui, None)
+        if prepared is not None:
+            release_devaddr(self.__netid, prepared[1])
+
+    def end_device_session(self, device):
+        """ Free the session of a device that passed or failed """
+        if device.session is not None:
+            if join_timeouts is not None:
+                join_timeouts.cancel(device.session.timer)
+            devaddr_index.pop(device.session.devaddr, None)
+            release_devaddr(self.__netid, device.session.devaddr)
+            device.session = None
 
     def deveui2device(self, deveui):
-        return self.__devices.get(deveui, None)
+        device = self.__devices.get(deveui, None)
+        if device is None and self.__store is not None:
+            appkey = self.__store.get(deveui)
+            if appkey is not None:
+                device = self.__devices[deveui] = Device(deveui, appkey)
+        return device
 
     def devaddr2device(self, devaddr):
-        return self.__devaddr2device.get(devaddr, None)
+        entry = devaddr_index.get(devaddr, None)
+        if entry is None or entry[0] is not self:
+            return None
+        return entry[1]
     
+def shard_key(pkt):
+    """ Worker selection: join-requests by DevEUI, uplinks by NwkAddr,
+        consistent with the DevAddr pools of init_worker """
+    if pkt.is_join_request():
+        return zlib.crc32(pkt.get_DevEui()) & 0xFFFFFFFF
+    return devaddrpool.nwkaddr(pkt.DevAddr) - devaddr_range[0]
+
+class JoinAcceptPrecompute(object):
+    """ Background thread preparing the join-accepts of up to budget provisioned devices.
+        A device is prepared again once its join-accept is used. With shard set to
+        (index, nb_workers) only the devices of the worker's DevEUI shard are prepared """
+    def __init__(self, budget, shard=None):
+        self.budget = budget
+        self.shard = shard
+        self.refill = Queue.Queue()
+
+    def start(self):
+        thread = threading.Thread(target=self.run, name='join-accept-precompute')
+        thread.daemon = True
+        thread.start()
+
+    def run(self):
+        count = 0
+        for app in appdb.values():
+            if app.store is None:
+                continue
+            for deveui, appkey in app.store:
+                if count >= self.budget:
+                    break
+                if self.shard is not None and (zlib.crc32(deveui) & 0xFFFFFFFF) % self.shard[1] != self.shard[0]:
+                    continue
+                app.prepare_join_accept(deveui, appkey)
+                count += 1
+        logger.info("%d join-accepts precomputed", count)
+        while True:
+            # entries of devices reloaded since are dropped by prepare_join_accept
+            app, deveui, appkey = self.refill.get()
+            app.prepare_join_accept(deveui, appkey)
+
+def take_prepared_join_accept(application, device):
+    if join_accept_precompute is None:
+        return None
+    prepared = application.take_join_accept(device)
+    if prepared is not None:
+        incr(PRECOMPUTED_JOIN_ACCEPT_CNT)
+        join_accept_precompute.refill.put((application, device.deveui, device.appkey))
+    return prepared
+
+def start_join_accept_precompute(budget, shard=None):
+    global join_accept_precompute
+    if budget > 0:
+        join_accept_precompute = JoinAcceptPrecompute(budget, shard)
+        join_accept_precompute.start()
+
+def init_worker(index, nb_workers):
+    """ Worker of the packets of its shard_key share, in ShardedServer and ReusePortServer modes """
+    global devaddr_shard
+
+    # NwkAddrs allocated by worker index are such that (nwkaddr - first) % nb_workers == index
+    devaddr_shard = (index, nb_workers)
+    devaddr_pools.clear()
+    # the budget is shared by the workers, each prepares the devices of its DevEUI shard
+    start_join_accept_precompute(-(-precompute_budget // nb_workers), (index, nb_workers))
+    if watch_conf:
+        start_conf_watcher()
+
+    if metrics_port:
+        metrics.start_http_server(metrics_port + 1 + index)
+
+def start_log_listener(log, queue, serialize):
+    """ Hand the handlers of log over to a background listener thread, log records are queued """
+    listener = logqueue.QueueListener(queue, *log.handlers)
+    for handler in list(log.handlers):
+        log.removeHandler(handler)
+    log.addHandler(logqueue.QueueHandler(queue, serialize))
+    listener.start()
+    # write the queued records on exit
+    atexit.register(listener.stop)
+
+def device_file_joineui(filename):
+    """ (JoinEUI, binary JoinEUI) named by a device file, None if the name is not a JoinEUI """
+    joineui = os.path.splitext(os.path.basename(filename))[0]
+    try:
+        return joineui.upper(), binascii.unhexlify(joineui)
+    except TypeError:
+        return None
+
+class ConfReloader(object):
+    """ DirectoryWatcher callback, loads the changed device files in the watcher thread and
+        queues (binary JoinEUI, JoinEUI, store, stale DevEUIs) reloads for apply_reloads.
+        A file with invalid entries is not reloaded, its devices stay as they were """
+    def __init__(self, apps):
+        # store last loaded for each JoinEUI, the base of the next diff
+        self.stores = dict((bjoineui, app.store) for bjoineui, app in apps.items())
+
+    def __call__(self, changed, removed):
+        for filename in removed:
+            names = device_file_joineui(filename)
+            if names is None or names[1] not in self.stores:
+                continue
+            joineui, bjoineui = names
+            del self.stores[bjoineui]
+            pending_reloads.append((bjoineui, joineui, None, None))
+            logger.test("joineui=%s removed", joineui)
+
+        for filename in changed:
+            names = device_file_joineui(filename)
+            if names is None:
+                logger.error("csv file=%s is not a valid join eui", filename)
+                continue
+            joineui, bjoineui = names
+            try:
+                store, errors = devicestore.load(filename)
+            except (IOError, OSError) as e:
+                logger.error("%s not reloaded: %s", filename, e)
+                continue
+            if errors:
+                for error in errors:
+                    logger.error(error)
+                logger.error("f=%s has %d invalid entries, not reloaded", filename, len(errors))
+                continue
+            old = self.stores.get(bjoineui, None) or devicestore.DeviceStore('', 0)
+            added, removed_deveuis, changed_deveuis = devicestore.diff(old, store)
+            self.stores[bjoineui] = store
+            pending_reloads.append((bjoineui, joineui, store, removed_deveuis + changed_deveuis))
+            logger.test("joineui=%s reloaded %d devices: %d added, %d removed, %d changed",
+                        joineui, len(store), len(added), len(removed_deveuis), len(changed_deveuis))
+
+def apply_reloads():
+    """ Swap the reloaded device stores into appdb, called by the packet handlers """
+    while pending_reloads:
+        bjoineui, joineui, store, stale = pending_reloads.pop(0)
+        app = appdb.get(bjoineui, None)
+        if store is None:
+            if app is not None:
+                app.reload_store(None, [])
+                del appdb[bjoineui]
+        elif app is None:
+            app = Application(joineui, default_netid)
+            app.reload_store(store, [])
+            appdb[bjoineui] = app
+        else:
+            app.reload_store(store, stale)
+        incr(CONF_RELOAD_CNT)
+
+def start_conf_watcher():
+    watcher = confwatch.DirectoryWatcher(CONF_DIR, '*.csv', ConfReloader(appdb), conf_poll_interval)
+    watcher.start()
+
 def rx_handler(pkt):
+    if pending_reloads:
+        apply_reloads()
     if pkt.is_join_request():
         join_request_handler(pkt)
     else:
         uplink_handler(pkt)
 
-def join_request_handler(pkt):
+def rx_batch_handler(pkts):
+    """ Packets of one PUSH_DATA, join-requests are answered with batched crypto calls """
+    if pending_reloads:
+        apply_reloads()
+    jreqs = []
+    for pkt in pkts:
+        if pkt.is_join_request():
+            jreqs.append(pkt)
+        else:
+            uplink_handler(pkt)
+
+    if len(jreqs) > 1:
+        join_request_batch_handler(jreqs)
+    elif jreqs:
+        join_request_handler(jreqs[0])
+
+def lookup_join_device(pkt):
+    start = time.time()
     try:
         joineui = pkt.get_AppEui()
         app = appdb[joineui]
     except:
+        incr(UNKNOWN_JOINEUI_CNT)
         if logger.isEnabledFor(logging.DEBUG):
-            logger.debug("joineui=%s not configured" % binascii.hexlify(joineui))
-        return
+            logger.debug("joineui=%s not configured", binascii.hexlify(joineui))
+        return None, None
 
     deveui = pkt.get_DevEui()
     device = app.deveui2device(deveui)
+    DEVICE_LOOKUP_HIST.observe(time.time() - start)
+    if device is None:
+       incr(UNKNOWN_DEVEUI_CNT)
+       if logger.isEnabledFor(logging.DEBUG):
+           logger.debug("joineui=%s deveui=%s not configured", binascii.hexlify(joineui), binascii.hexlify(deveui))
+    return app, device
+
+def join_request_handler(pkt):
+    app, device = lookup_join_device(pkt)
     if device is not None:
         send_join_accept(app, device, pkt)
+
+def join_accept_windows(jreq, uplink):
+    """ (rxslot, rxconf, txtmst) of the RX1 and RX2 join-accept windows """
+    return [(1, uplink.rx1[0], jreq.tmst + lw_region.JOIN_RX1_DELAY * 1000000),
+            (2, lw_region.get_rx2_conf(), jreq.tmst + lw_region.JOIN_RX2_DELAY * 1000000)]
+
+def join_accept_rx_window(application, device, jreq):
+    """ Select the join-accept rx slot, returns (rxslot, rxconf, txtmst) or None.
+        The device's rx slot is tried first, the other one when the downlink would be
+        late or collide with a downlink already scheduled on the gateway """
+    if jreq.tmst is None:
+        logger.error("join accept transmit timestamp not set")
+        return None
+    uplink = lw_region.lookup(jreq.freq, jreq.datr)
+    if uplink is None:
+        logger.error("join-request freq=%s datr=%s is not a %s channel", jreq.freq, jreq.datr, lw_region.name)
+        return None
+
+    windows = join_accept_windows(jreq, uplink)
+    if 2 == device.get_join_rxslot():
+        windows.reverse()
+
+    channel, dr = uplink.channel, uplink.dr
+    logger.test("joineui=%s, deveui=%s : status=Join-request received on channel=%d, DR%d", 
+                application.joineui, HexEui(device.deveui), channel, dr)
+    test_step(application, device, JOIN_REQUEST_STATE, jreq.rx_time, channel=channel, dr=dr)
+    rxwin = forwarder.schedule_downlink(jreq, windows, crypto.JOIN_ACCEPT_FRAME_SIZE)
+    if rxwin is None:
+        logger.test("joineui=%s, deveui=%s : status=Join-accept lost, no downlink window available on channel=%d, DR%d",
+                    application.joineui, HexEui(device.deveui), channel, dr)
+        test_step(application, device, JOIN_ACCEPT_LOST_STATE, packet_forwarder_server.clock(), channel=channel, dr=dr)
+        return None
+    return rxwin
+
+def transmit_join_accept(application, device, jreq, jacc, rxwin):
+    rxslot, rxconf, txtmst = rxwin
+    # the gateway may reject the join-accept, it is then sent again on the other window
+    uplink = lw_region.lookup(jreq.freq, jreq.datr)
+    retry_windows = [window for window in join_accept_windows(jreq, uplink) if window[0] != rxslot]
+    if forwarder.transmit(jacc, txtmst, rxconf, jreq, retry_windows, (application, device, device.session)):
+        incr(JOIN_ACCEPT_CNT)
+        now = packet_forwarder_server.clock()
+        if jreq.rx_time is not None:
+            JOIN_HIST.observe(now - jreq.rx_time)
+        logger.test("joineui=%s, deveui=%s : status=Join-accept on RX%d sent to packet forwarder", 
+                    application.joineui, HexEui(device.deveui), rxslot)
+        test_step(application, device, JOIN_ACCEPT_STATE, now, rxslot=rxslot, devaddr=device.devaddr)
     else:
-       logger.debug("joineui=%s deveui=%s not configured" % (binascii.hexlify(joineui), binascii.hexlify(deveui)))
+        logger.test("joineui=%s, deveui=%s : status=Join-accept lost, not sent to packet forwarder on RX%d",
+                    application.joineui, HexEui(device.deveui), rxslot)
+        test_step(application, device, JOIN_ACCEPT_LOST_STATE, packet_forwarder_server.clock(), rxslot=rxslot)
+        application.end_device_session(device)
+
+def join_accept_retried(context, window):
+    """ Packet forwarder server retry_handler: the join-accept rejected by the gateway
+        went out again on window, None when it is lost """
+    application, device, session = context
+    if device.session is not session:
+        # the attempt is over
+        return
+    if window is None:
+        logger.test("joineui=%s, deveui=%s : status=Join-accept lost, rejected by the gateway",
+                    application.joineui, HexEui(device.deveui))
+        test_step(application, device, JOIN_ACCEPT_LOST_STATE, packet_forwarder_server.clock())
+        application.end_device_session(device)
+        return
+    logger.test("joineui=%s, deveui=%s : status=Join-accept on RX%d sent again to packet forwarder",
+                application.joineui, HexEui(device.deveui), window[0])
+    test_step(application, device, JOIN_ACCEPT_STATE, packet_forwarder_server.clock(), rxslot=window[0], devaddr=device.devaddr)
+
+def devaddr_exhausted(application, device, jreq, rxwin):
+    """ The join-request of device is not answered, no DevAddr is left for its session """
+    forwarder.cancel_downlink(jreq, rxwin)
+    logger.error("joineui=%s, deveui=%s : no DevAddr left in NetID %06X range %s",
+                 application.joineui, HexEui(device.deveui), application.netid, devaddr_range)
+    test_step(application, device, JOIN_ACCEPT_LOST_STATE, packet_forwarder_server.clock())
 
 def send_join_accept(application, device, jreq):
-    txtmst = None 
-    # Selct rx slot
-    dr = lw_region.sf2txdr(jreq.datr)
-    rxslot = device.get_join_rxslot()
-    if 1 == rxslot:
-        rxconf = lw_region.get_rx1_conf(jreq.freq, dr)
-        txtmst = jreq.tmst + lw_region.JOIN_RX1_DELAY * 1000000 
-    elif 2 == rxslot:
-        rxconf = lw_region.get_rx2_conf()
-        txtmst = jreq.tmst + lw_region.JOIN_RX2_DELAY * 1000000 
-
-    if txtmst is None:
-        logger.error("join accept transmit timestamp not set")
+    rxwin = join_accept_rx_window(application, device, jreq)
+    if rxwin is None:
         return
 
-    deveui_s = binascii.hexlify(device.deveui).upper()
-    channel = lw_region.tx_channel(jreq.freq, dr)
-    logger.test("joineui=%s, deveui=%s : status=Join-request received on channel=%d, DR%d" 
-                    % (application.joineui, deveui_s, channel, dr))
+    # Initialize new session, the NwkSKey is derived on the first uplink
+    prepared = take_prepared_join_accept(application, device)
+    if prepared is not None:
+        appnonce, devaddr, jacc = prepared
+        application.set_device_session(device, appnonce, jreq.DevNonce, devaddr)
+    else:
+        if not application.new_device_session(device, jreq.DevNonce):
+            devaddr_exhausted(application, device, jreq, rxwin)
+            return
+        # Encode join accept frame
+        start = time.time()
+        jacc = packet.encode_join_accept_frame(device.appkey_ctx, device.session.appnonce, application.netid, device.session.devaddr)
+        JOIN_ACCEPT_ENCODE_HIST.observe(time.time() - start)
+    transmit_join_accept(application, device, jreq, jacc, rxwin)
 
-    # Initialize new session
-    application.new_device_session(device, application.netid, jreq.DevNonce) 
-    device.joining = True
+def join_request_batch_handler(jreqs):
+    accepts = []
+    for jreq in jreqs:
+        application, device = lookup_join_device(jreq)
+        if device is None:
+            continue
+        rxwin = join_accept_rx_window(application, device, jreq)
+        if rxwin is None:
+            continue
+        prepared = take_prepared_join_accept(application, device)
+        if prepared is not None:
+            appnonce, devaddr, jacc = prepared
+            application.set_device_session(device, appnonce, jreq.DevNonce, devaddr)
+            transmit_join_accept(application, device, jreq, jacc, rxwin)
+        elif application.new_device_session(device, jreq.DevNonce):
+            accepts.append((application, device, jreq, rxwin))
+        else:
+            devaddr_exhausted(application, device, jreq, rxwin)
+    if not accepts:
+        return
 
-    # Send join accept frame
-    jacc = packet.encode_join_accept_frame(device.appkey, device.session.appnonce, application.netid, device.session.devaddr)
-    if forwarder.transmit(jacc, txtmst, rxconf, jreq):
-        logger.test("joineui=%s, deveui=%s : status=Join-accept on RX%d sent to packet forwarder" % (application.joineui, deveui_s, rxslot))
+    # Send join accept frames, encoded in one call
+    appkeys = ''.join(device.appkey for _app, device, _jreq, _rxwin in accepts)
+    macpayloads = ''.join(packet.encode_join_accept_macpayload(device.session.appnonce, application.netid, device.session.devaddr)
+                          for application, device, _jreq, _rxwin in accepts)
+    start = time.time()
+    frames = crypto.encode_join_accept_batch(appkeys, macpayloads)
+    JOIN_ACCEPT_ENCODE_HIST.observe(time.time() - start, len(accepts))
+    size = crypto.JOIN_ACCEPT_FRAME_SIZE
+    for i, (application, device, jreq, rxwin) in enumerate(accepts):
+        transmit_join_accept(application, device, jreq, frames[i * size:(i + 1) * size], rxwin)
 
 def uplink_handler(pkt):
-    for joineui in appdb:
-        app = appdb[joineui]
-        device = appdb[joineui].devaddr2device(pkt.DevAddr)
-        if device is not None and device.joining:
-            validate_uplink_after_join_accept(app, device, pkt)
+    entry = devaddr_index.get(pkt.DevAddr, None)
+    if entry is None:
+        return
+    app, device = entry
+    if device.joining:
+        validate_uplink_after_join_accept(app, device, pkt)
 
 def validate_uplink_after_join_accept(app, device, pkt):
-    mic = crypto.compute_uplink_mic(bytes(pkt.PHYPayload[:-4]), device.session.nwkskey, pkt.DevAddr, pkt.FCnt)
+    mic = crypto.compute_uplink_mic(pkt.PHYPayload[:-4], app.session_nwkskey(device), pkt.DevAddr, pkt.FCnt)
     if pkt.MIC == mic:
-        logger.test("joineui=%s, deveui=%s : status=OTAA Success" % (app.joineui, binascii.hexlify(device.deveui)))
+        incr(OTAA_SUCCESS_CNT)
+        logger.test("joineui=%s, deveui=%s : status=OTAA Success", app.joineui, HexEui(device.deveui, False))
+        test_step(app, device, OTAA_SUCCESS_STATE, pkt.rx_time, devaddr=pkt.DevAddr, fcnt=pkt.FCnt)
     else:
-        logger.test("joineui=%s, deveui=%s : status=MIC check failed" % (app.joineui, binascii.hexlify(device.deveui)))
+        incr(MIC_FAILED_CNT)
+        logger.test("joineui=%s, deveui=%s : status=MIC check failed", app.joineui, HexEui(device.deveui, False))
+        test_step(app, device, MIC_FAILED_STATE, pkt.rx_time, devaddr=pkt.DevAddr, fcnt=pkt.FCnt)
 
-    device.joining = False
+    app.end_device_session(device)
+
+def summary_samples():
+    """ Devices by JoinEUI and verdict as metrics.Registry samples """
+    return [('harness_devices', {'joineui': app.joineui, 'verdict': verdict}, count)
+            for app in appdb.values() for verdict, count in app.summary().items()]
+
+def join_timeout_handler(expired):
+    """ Sessions without uplink join_timeout after the join-request, the attempts still
+        pending fail """
+    for app, device in expired:
+        incr(JOIN_TIMEOUT_CNT)
+        state = device.result.state if device.result is not None else None
+        if state == JOIN_ACCEPT_STATE:
+            incr(NO_UPLINK_CNT)
+            logger.test("joineui=%s, deveui=%s : status=No uplink after join-accept", app.joineui, HexEui(device.deveui, False))
+            test_step(app, device, NO_UPLINK_STATE, packet_forwarder_server.clock())
+        elif state == JOIN_REQUEST_STATE:
+            logger.test("joineui=%s, deveui=%s : status=Join-accept lost, not sent before the join timeout",
+                        app.joineui, HexEui(device.deveui, False))
+            test_step(app, device, JOIN_ACCEPT_LOST_STATE, packet_forwarder_server.clock())
+        app.end_device_session(device)
 
 def read_conf():
+    global default_netid
     conf_file = CONF_DIR + '/' + TEST_CONF_FILE_DEFAULT
     test_conf = {}
     app_conf  = {}
@@ -265,10 +878,21 @@ def read_conf():
         with open(conf_file, 'r') as json_file:
             test_conf = json.load(json_file)
     except IOError:
-        logger.critical("%s not found" % conf_file)
+        logger.critical("%s not found", conf_file)
         sys.exit(-1)
     except ValueError as jex:
-        logger.critical("%s: JSON error: %s" % (conf_file, jex))
+        logger.critical("%s: JSON error: %s", conf_file, jex)
+        sys.exit(-1)
+
+    # NetID of the applications, a hex string or a number
+    default_netid = test_conf.get('netid', NETID_DEFAULT)
+    try:
+        if isinstance(default_netid, basestring):
+            default_netid = int(default_netid, 16)
+        if not 0 <= default_netid <= 0xFFFFFF:
+            raise ValueError("not a 24-bit NetID")
+    except ValueError as e:
+        logger.critical("%s: invalid netid %s: %s", conf_file, test_conf['netid'], e)
         sys.exit(-1)
 
     # Import device configuration
@@ -278,42 +902,156 @@ def read_conf():
         try:
             bjoineui = binascii.unhexlify(joineui)
         except:
-            logger.critical("csv file=%s is not a valid join eui" % filename)
+            logger.critical("csv file=%s is not a valid join eui", filename)
             sys.exit(-1)
 
         # initialize application
         joineui = joineui.upper()
-        application = Application(joineui)
+        application = Application(joineui, default_netid)
         # import device
         application.import_devices(joineui, filename)
         app_conf[bjoineui] = application
 
     return test_conf, app_conf 
 
-def run():
+def run(replay_file=None, replay_speed=0):
     global appdb
     global lw_region
     global forwarder
+    global log_queue
+    global results_queue
+    global metrics_port
+    global precompute_budget
+    global join_timeouts
+    global join_timeout
+    global watch_conf
+    global conf_poll_interval
+    global devaddr_range
 
-    logger.test("Gateway Over the Air Activation Test Harness Version %s" % version)
+    logger.test("Gateway Over the Air Activation Test Harness Version %s", version)
     test_conf, appdb = read_conf()
 
     # Logging debug to file 
     if 'debug_log' in test_conf:
-        dfh = logging.FileHandler(test_conf['debug_log'])
+        dfh = logqueue.BatchFileHandler(test_conf['debug_log'])
         dfh.setLevel(logging.DEBUG)
         dfh.setFormatter(cfmt)
         logger.addHandler(dfh)
 
     # packet forwarder server configuration
+    server_host = test_conf.get('server_host', SERVER_HOST_DEFAULT)
     server_port = test_conf.get('server_port', SERVER_PORT_DEFAULT)
+    # kernel socket buffer sizes in bytes, 0 for the system default
+    so_rcvbuf = test_conf.get('so_rcvbuf', 0)
+    so_sndbuf = test_conf.get('so_sndbuf', 0)
+    reuseport = test_conf.get('reuseport', False)
     region_name = test_conf.get('region', LORAWAN_REGION_DEFAULT)
+    if region_name not in region.SUPPORTED:
+        logger.critical("unknown region %s, supported regions: %s", region_name, ', '.join(region.SUPPORTED))
+        sys.exit(-1)
+    rx_queue_size = test_conf.get('rx_queue_size', RX_QUEUE_SIZE_DEFAULT)
+    nb_workers = test_conf.get('workers', WORKERS_DEFAULT) if replay_file is None else 1
+    crypto.key_contexts.resize(test_conf.get('key_context_cache_size', crypto.KEY_CONTEXT_CACHE_SIZE_DEFAULT))
+    results_file = test_conf.get('results_file', RESULTS_FILE_DEFAULT)
+    if results_file:
+        results.addHandler(logqueue.JsonLinesHandler(results_file))
+    # one row per device attempt that passed or failed
+    results_csv = test_conf.get('results_csv', RESULTS_CSV_DEFAULT)
+    if results_csv:
+        results.addHandler(logqueue.CsvHandler(results_csv, RESULT_COLUMNS))
+
+    # Log records are written by background threads, worker processes inherit the queue handlers
+    if nb_workers > 1:
+        log_queue = multiprocessing.Queue()
+        results_queue = multiprocessing.Queue()
+    else:
+        log_queue = Queue.Queue()
+        results_queue = Queue.Queue()
+    start_log_listener(logger, log_queue, nb_workers > 1)
+    if results.handlers:
+        start_log_listener(results, results_queue, nb_workers > 1)
+
     # start server 
     lw_region = region.get(region_name)
-    forwarder = packet_forwarder_server.Server("localhost", server_port, region_name)
-    forwarder.run(rx_handler) 
+    if replay_file is not None:
+        forwarder = capture.ReplayServer(region_name)
+    elif nb_workers > 1 and reuseport:
+        # one SO_REUSEPORT socket per worker, the kernel spreads the gateways across them
+        forwarder = packet_forwarder_server.ReusePortServer(server_host, server_port, region_name, nb_workers, shard_key,
+                                                            init_worker, rcvbuf=so_rcvbuf, sndbuf=so_sndbuf)
+    elif nb_workers > 1:
+        forwarder = packet_forwarder_server.ShardedServer(server_host, server_port, region_name, nb_workers, shard_key,
+                                                          init_worker, rcvbuf=so_rcvbuf, sndbuf=so_sndbuf)
+    else:
+        forwarder = packet_forwarder_server.Server(server_host, server_port, region_name, rcvbuf=so_rcvbuf, sndbuf=so_sndbuf)
+    if test_conf.get('batch_crypto', False):
+        forwarder.rx_batch_handler = rx_batch_handler
+    forwarder.tx_ack_timeout = test_conf.get('tx_ack_timeout', packet_forwarder_server.TX_ACK_TIMEOUT_DEFAULT)
+    forwarder.retry_handler = join_accept_retried
+    # copies of a frame from several gateways are answered once, through the best gateway
+    dedup_window = test_conf.get('dedup_window', dedup.DEDUP_WINDOW_DEFAULT)
+    if dedup_window > 0:
+        forwarder.dedup = dedup.DedupCache(dedup_window, test_conf.get('dedup_max_entries', dedup.DEDUP_MAX_ENTRIES_DEFAULT))
+    # DevAddrs are allocated from the NwkAddr range of the harness instance, shared by the workers,
+    # and released when the session ends
+    devaddr_range = tuple(test_conf.get('devaddr_range', DEVADDR_RANGE_DEFAULT))
+    try:
+        devaddr_pool(default_netid)
+    except (ValueError, TypeError) as e:
+        logger.critical("invalid devaddr_range %s: %s", test_conf.get('devaddr_range'), e)
+        sys.exit(-1)
+    # sessions without uplink are reclaimed and reported after join_timeout seconds, 0 disables
+    join_timeout = test_conf.get('join_timeout', JOIN_TIMEOUT_DEFAULT)
+    if join_timeout > 0:
+        join_timeouts = forwarder.timers = timerwheel.TimingWheel()
+        forwarder.timer_handler = join_timeout_handler
+    # capture of the received and sent datagrams, per worker process in trace_file.<index>.
+    # A replay is not traced, the replayed trace may be the trace_file
+    if test_conf.get('trace_file', None) and replay_file is not None:
+        logger.warning("trace_file %s not written when replaying %s", test_conf['trace_file'], replay_file)
+    elif test_conf.get('trace_file', None):
+        forwarder.trace = capture.TraceWriter(test_conf['trace_file'], test_conf.get('trace_buffer_size', capture.TRACE_BUFFER_SIZE_DEFAULT))
+        atexit.register(forwarder.trace.close)
+
+    # Join-accepts prepared in the background, by each worker when sharded. Not when
+    # replaying, the AppNonces and DevAddrs would depend on the thread timing
+    precompute_budget = test_conf.get('precompute_join_accepts', PRECOMPUTE_JOIN_ACCEPTS_DEFAULT)
+    if nb_workers == 1 and replay_file is None:
+        start_join_accept_precompute(precompute_budget)
+    # device files edited while the harness runs are reloaded, by each worker when sharded
+    watch_conf = test_conf.get('watch_conf', WATCH_CONF_DEFAULT) and replay_file is None
+    conf_poll_interval = test_conf.get('conf_poll_interval', confwatch.POLL_INTERVAL_DEFAULT)
+    if watch_conf and nb_workers == 1:
+        start_conf_watcher()
+
+    # Prometheus metrics endpoint
+    metrics.registry.add_counters('harness', counter)
+    metrics.registry.add_collector(forwarder.metrics_samples)
+    metrics.registry.add_collector(summary_samples)
+    metrics_port = test_conf.get('metrics_port', METRICS_PORT_DEFAULT)
+    if metrics_port and nb_workers > 1 and reuseport:
+        # the main process only waits for the workers, it serves their samples labelled by worker
+        workers_registry = metrics.Registry()
+        workers_registry.add_collector(metrics.scrape_collector(
+            [('http://localhost:%d/metrics' % (metrics_port + 1 + index), {'worker': str(index)}) for index in range(0, nb_workers)]))
+        metrics.start_http_server(metrics_port, metrics_registry=workers_registry)
+    elif metrics_port:
+        metrics.start_http_server(metrics_port)
+    if replay_file is not None:
+        datagrams, trace_seconds, elapsed = forwarder.replay(rx_handler, replay_file, replay_speed)
+        logger.test("Replayed %d datagrams, %.3fs of traffic in %.3fs", datagrams, trace_seconds, elapsed)
+        logger.info("counters: %s", ', '.join('%s=%d' % (key, counter[key]) for key in sorted(counter)))
+        for app in appdb.values():
+            summary = app.summary()
+            logger.test("joineui=%s : %s", app.joineui, ', '.join('%s=%d' % (key, summary[key]) for key in sorted(summary)))
+        return
+    forwarder.run(rx_handler, rx_queue_size) 
     logger.critical("Unexpected server exit!")
     sys.exit(-1)
 
 if __name__ == '__main__':
-    run()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Gateway Over the Air Activation Test Harness")
+    parser.add_argument('--replay', metavar='TRACE', help="feed a recorded trace_file to the harness instead of serving packet forwarders")
+    parser.add_argument('--speed', type=float, default=0, help="replay speed: 1 for real time, N for N times faster, 0 for as fast as possible")
+    args = parser.parse_args()
+    run(args.replay, args.speed)
\ No newline at end of file
@@ -1 +1 @@
-__all__ = ["packet", "crypto", "region", "semtech_packet_forward_server"]
+__all__ = ["packet", "crypto", "region", "semtech_packet_forward_server", "logqueue", "devicestore", "metrics", "loadgen", "downlink", "dedup", "capture", "timerwheel", "confwatch", "devaddrpool"]
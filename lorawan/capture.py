@@ -0,0 +1,199 @@
+""" Packet forwarder traffic traces, for offline replay of real traffic.
+
+    A trace is a file header followed by one record per Semtech UDP datagram
+    received or sent by the server: a fixed size record header (monotonic
+    time in seconds, direction, IPv4 address, port, datagram length) then the
+    datagram. TraceWriter appends records with buffered writes, a background
+    thread flushes them every FLUSH_INTERVAL so that a killed harness loses
+    at most the last second of traffic.
+
+    ReplayServer feeds the received datagrams of a trace to the packet
+    handlers without sockets. The server logic runs on a synthetic clock set
+    to the time of each record, so a trace replays the same way at real
+    time, N times faster or as fast as possible. From the repository root:
+        python harness.py --replay incident.trace --speed 0
+"""
+import ctypes
+import ctypes.util
+import errno
+import os
+import socket
+import struct
+import threading
+import time
+import logging
+
+import packet_forwarder_server
+
+logger = logging.getLogger('harness.capture')
+
+MAGIC = 'LWTRACE1'
+# time, direction, IPv4 address, port, datagram length
+RECORD = struct.Struct('<dB4sHH')
+RX = 0
+TX = 1
+
+TRACE_BUFFER_SIZE_DEFAULT = 1 << 20
+# seconds
+FLUSH_INTERVAL = 1.0
+
+CLOCK_MONOTONIC = 1
+
+class timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+def _monotonic_clock():
+    """ clock_gettime(CLOCK_MONOTONIC) through ctypes, time.time where it is not available """
+    try:
+        clock_gettime = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True).clock_gettime
+    except (OSError, AttributeError):
+        return time.time
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    ts = timespec()
+    ts_ref = ctypes.byref(ts)
+    if clock_gettime(CLOCK_MONOTONIC, ts_ref) != 0:
+        return time.time
+
+    def monotonic():
+        clock_gettime(CLOCK_MONOTONIC, ts_ref)
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+    return monotonic
+
+monotonic = _monotonic_clock()
+
+def unused_path(path, now=None):
+    """ path, or path with the time of now before its extension when a file is already there """
+    if not os.path.exists(path):
+        return path
+    root, ext = os.path.splitext(path)
+    stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(now))
+    candidate = '%s-%s%s' % (root, stamp, ext)
+    n = 1
+    while os.path.exists(candidate):
+        candidate = '%s-%s-%d%s' % (root, stamp, n, ext)
+        n += 1
+    return candidate
+
+class TraceWriter(object):
+    """ Appends the datagrams of a server to a new file, an existing trace at path is
+        kept and the datagrams go to unused_path(path) """
+    def __init__(self, path, buffer_size=TRACE_BUFFER_SIZE_DEFAULT, clock=monotonic):
+        self.buffer_size = buffer_size
+        self.clock = clock
+        while True:
+            self.path = unused_path(path)
+            try:
+                # exclusive create, a trace is never truncated
+                fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+                break
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        if self.path != path:
+            logger.warning("%s exists, tracing to %s", path, self.path)
+        self.file = os.fdopen(fd, 'wb', buffer_size)
+        self.file.write(MAGIC)
+        # nothing buffered when worker processes are forked
+        self.file.flush()
+        self.records = 0
+        self.closed = threading.Event()
+        flusher = threading.Thread(target=self.flush_loop, name='trace-flush')
+        flusher.daemon = True
+        flusher.start()
+
+    def flush_loop(self):
+        while not self.closed.wait(FLUSH_INTERVAL):
+            self.file.flush()
+
+    def write(self, direction, addr, data):
+        self.file.write(RECORD.pack(self.clock(), direction, socket.inet_aton(addr[0]), addr[1], len(data)) + data)
+        self.records += 1
+
+    def rx(self, addr, data):
+        self.write(RX, addr, data)
+
+    def tx(self, addr, data):
+        self.write(TX, addr, data)
+
+    def reopen(self, index):
+        """ Trace of worker process index, in path.index """
+        return TraceWriter('%s.%d' % (self.path, index), self.buffer_size, self.clock)
+
+    def close(self):
+        self.closed.set()
+        self.file.close()
+
+def read_trace(path):
+    """ (time, direction, (host, port), datagram) of the records of a trace """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a packet forwarder trace" % path)
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            ts, direction, host, port, length = RECORD.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                logger.warning("%s: truncated record", path)
+                return
+            yield ts, direction, (socket.inet_ntoa(host), port), data
+
+class SyntheticClock(object):
+    """ Time of the trace record being replayed """
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+class ReplayServer(packet_forwarder_server.Server):
+    """ Server fed from a trace, sent datagrams are only counted and traced """
+    def __init__(self, region_name, discard_mtypes=None):
+        packet_forwarder_server.Server.__init__(self, None, None, region_name, discard_mtypes)
+        self.sent = 0
+
+    def open_socket(self, rcvbuf, sndbuf, reuseport):
+        return None
+
+    def send(self, data, addr):
+        if self.trace is not None:
+            self.trace.tx(addr, data)
+        self.sent += 1
+        return len(data)
+
+    def replay(self, rx_handler, path, speed=0):
+        """ Replay the received datagrams of a trace. speed: 1 for real time, N for N times
+            faster, 0 for as fast as possible. Returns (datagrams, trace seconds, elapsed) """
+        self.rx_handler = rx_handler
+        clock = SyntheticClock()
+        saved_clock = packet_forwarder_server.clock
+        packet_forwarder_server.clock = clock
+        if self.trace is not None:
+            self.trace.clock = clock
+        count = 0
+        first = last = None
+        start = time.time()
+        try:
+            for ts, direction, addr, data in read_trace(path):
+                if direction != RX:
+                    continue
+                if first is None:
+                    first = ts
+                last = ts
+                if speed > 0:
+                    delay = (ts - first) / speed - (time.time() - start)
+                    if delay > 0:
+                        time.sleep(delay)
+                clock.now = ts
+                # packets whose dedup window ended before this datagram
+                self.release_packets()
+                self.receive(data, addr, ts)
+                count += 1
+            # held packets and timers run to completion
+            while self.next_deadline() is not None:
+                clock.now = max(clock.now, self.next_deadline())
+                self.release_packets()
+        finally:
+            packet_forwarder_server.clock = saved_clock
+        return count, last - first if first is not None else 0.0, time.time() - start
@@ -0,0 +1,113 @@
+""" Watch a directory for added, changed and removed files.
+
+    A background thread waits for inotify events (through ctypes) on the
+    directory, or polls it where inotify is not available. Events are
+    coalesced: once the directory is quiet for settle seconds, the
+    (size, mtime) of the files matching pattern are compared with the last
+    scan and the callback gets the changed and removed paths.
+"""
+import ctypes
+import ctypes.util
+import errno
+import glob
+import os
+import select
+import threading
+import time
+import logging
+
+logger = logging.getLogger('harness.confwatch')
+
+POLL_INTERVAL_DEFAULT = 2.0
+SETTLE_DEFAULT = 0.2
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+def inotify_watch(path, mask=WATCH_MASK):
+    """ inotify file descriptor watching path, None when inotify is not available """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        inotify_init = libc.inotify_init
+        inotify_add_watch = libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    fd = inotify_init()
+    if fd < 0:
+        return None
+    if inotify_add_watch(fd, path, mask) < 0:
+        logger.warning("inotify watch of %s failed: %s", path, os.strerror(ctypes.get_errno()))
+        os.close(fd)
+        return None
+    return fd
+
+class DirectoryWatcher(object):
+    def __init__(self, path, pattern, callback, poll_interval=POLL_INTERVAL_DEFAULT, settle=SETTLE_DEFAULT):
+        """ callback(changed, removed) runs in the watcher thread, added files are changed ones """
+        self.path = path
+        self.pattern = pattern
+        self.callback = callback
+        self.poll_interval = poll_interval
+        self.settle = settle
+        self.snapshot = self.scan()
+        self.fd = None
+        self._thread = None
+
+    def scan(self):
+        """ path -> (size, mtime) of the matching files """
+        snapshot = {}
+        for filename in glob.glob(os.path.join(self.path, self.pattern)):
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue
+            snapshot[filename] = (st.st_size, st.st_mtime)
+        return snapshot
+
+    def start(self):
+        self.fd = inotify_watch(self.path)
+        logger.info("watching %s/%s with %s", self.path, self.pattern, 'inotify' if self.fd is not None else 'polling')
+        self._thread = threading.Thread(target=self._monitor, name='conf-watch')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def wait_events(self, timeout):
+        """ True when inotify events were read within timeout seconds """
+        try:
+            if not select.select([self.fd], [], [], timeout)[0]:
+                return False
+            os.read(self.fd, 65536)
+        except (OSError, select.error) as e:
+            if e.args[0] != errno.EINTR:
+                raise
+        return True
+
+    def wait_quiet(self):
+        if self.fd is None:
+            time.sleep(self.poll_interval)
+            return
+        self.wait_events(None)
+        while self.wait_events(self.settle):
+            pass
+
+    def check(self):
+        snapshot = self.scan()
+        changed = sorted(filename for filename, stat in snapshot.items() if self.snapshot.get(filename, None) != stat)
+        removed = sorted(filename for filename in self.snapshot if filename not in snapshot)
+        self.snapshot = snapshot
+        if changed or removed:
+            self.callback(changed, removed)
+
+    def _monitor(self):
+        while True:
+            self.wait_quiet()
+            try:
+                self.check()
+            except Exception:
+                logger.exception("%s reload failed", self.path)
@@ -1,85 +1,96 @@
-import ctypes
+""" LoRaWAN crypto functions.
+
+    Backed by the _lwcrypto CPython extension module when it is built, otherwise
+    by the ctypes binding of crypto.so (crypto_ctypes). Both backends share the
+    same API and the C sources of lorawan/extension.
+"""
+import imp
 import os
 import platform
 import struct
-import sys
 import logging
 
 logger = logging.getLogger("harness.lwcrypto")
 
-def initialize_crypto_extension():
-    # C extension shared libray path
+def initialize_native_extension():
+    # CPython extension module path
     mydir = os.path.dirname(os.path.abspath(__file__))
     machine = platform.machine()
-    libpath = os.path.join(mydir,'extension/build/', machine, "bin", "crypto.so")
+    modpath = os.path.join(mydir,'extension/build/', machine, "bin", "_lwcrypto.so")
     try:
-        return ctypes.CDLL(libpath)
-    except:
-        logger.critical("lorawan crypto c extension %s not found" % libpath)
-        sys.exit(-1)
-
-crypto = initialize_crypto_extension()
-
-# uint32_t aes_cmac( const uint8_t *buffer, uint16_t size, const uint8_t *key);
-crypto.aes_cmac.argtypes = (ctypes.c_char_p, ctypes.c_uint16, ctypes.c_char_p) 
-crypto.aes_cmac.restype = ctypes.c_uint32 
-
-# void encrypt( const uint8_t *buffer, uint16_t size, const uint8_t *key, uint8_t *encBuffer );
-crypto.aes128_encrypt.argtypes = (ctypes.c_char_p, ctypes.c_uint16, ctypes.c_char_p, ctypes.c_char_p)
-
-# void decrypt( const uint8_t *buffer, uint16_t size, const uint8_t *key, uint8_t *decBuffer );
-crypto.aes128_decrypt.argtypes = (ctypes.c_char_p, ctypes.c_uint16, ctypes.c_char_p, ctypes.c_char_p)
-
-# void compute_app_skey(const uint8_t *key,  uint32_t appnonce, uint32_t netid, uint16_t devnonce, uint8_t *nwkSKey);
-crypto.compute_app_skey.argtypes = (ctypes.c_char_p, ctypes.c_uint32, ctypes.c_uint32, ctypes.c_uint16, ctypes.c_char_p)
-
-# void compute_nwk_skey(const uint8_t *key,  uint32_t appnonce, uint32_t netid, uint16_t devnonce, uint8_t *nwkSKey);
-crypto.compute_nwk_skey.argtypes = (ctypes.c_char_p, ctypes.c_uint32, ctypes.c_uint32, ctypes.c_uint16, ctypes.c_char_p)
-
-# uint32_t compute_uplink_mic(const uint8_t *buffer, uint16_t size, const uint8_t *key, uint32_t devaddr,  uint32_t fcnt)
-crypto.compute_uplink_mic.argtypes = (ctypes.c_char_p, ctypes.c_uint16, ctypes.c_char_p, ctypes.c_uint32, ctypes.c_uint32)
-crypto.compute_uplink_mic.restype = ctypes.c_uint32
-
-def aes_cmac(buffer, key):
-    size = len(buffer)
-    c_buf = ctypes.c_char_p(buffer)
-    c_key = ctypes.c_char_p(key)
-    mic = crypto.aes_cmac(c_buf, size, c_key)
-    return mic 
-
-def aes128_encrypt(buffer, key):
-    size = len(buffer)
-    c_buf = ctypes.c_char_p(buffer)
-    c_key = ctypes.c_char_p(key)
-
-    out = ctypes.create_string_buffer(size) 
-    crypto.aes128_encrypt(c_buf, size, c_key, out)
-    return out.raw
-
-def aes128_decrypt(buffer, key):
-    size = len(buffer)
-    c_buf = ctypes.c_char_p(buffer)
-    c_key = ctypes.c_char_p(key)
-
-    out = ctypes.create_string_buffer(size) 
-    crypto.aes128_decrypt(c_buf, size, c_key, out)
-    return out.raw 
-
-def compute_uplink_mic(buffer, key, devaddr, fcnt):
-    size = len(buffer)
-    c_buf = ctypes.c_char_p(buffer)
-    c_key = ctypes.c_char_p(key)
-    mic = crypto.compute_uplink_mic(c_buf, size, c_key, devaddr, fcnt)
-    return mic 
-
-def compute_app_skey(appnonce, netid, devnonce, key):
-    c_key = ctypes.c_char_p(key)
-    appskey = ctypes.create_string_buffer(16)
-    crypto.compute_app_skey(c_key, appnonce, netid, devnonce, appskey)
-    return appskey.raw
-
-def compute_nwk_skey(appnonce, netid, devnonce, key):
-    c_key = ctypes.c_char_p(key)
-    nwkskey = ctypes.create_string_buffer(16)
-    crypto.compute_nwk_skey(c_key, appnonce, netid, devnonce, nwkskey)
-    return nwkskey.raw
\ No newline at end of file
+        return imp.load_dynamic('_lwcrypto', modpath)
+    except ImportError as e:
+        logger.info("lorawan crypto module %s not loaded (%s), using ctypes", modpath, e)
+        return None
+
+backend = initialize_native_extension()
+if backend is None:
+    import crypto_ctypes as backend
+
+BACKEND = backend.__name__
+
+SESSION_NONCE_SIZE = backend.SESSION_NONCE_SIZE
+UPLINK_MIC_PARAM_SIZE = backend.UPLINK_MIC_PARAM_SIZE
+JOIN_ACCEPT_MACPAYLOAD_SIZE = backend.JOIN_ACCEPT_MACPAYLOAD_SIZE
+JOIN_ACCEPT_FRAME_SIZE = backend.JOIN_ACCEPT_FRAME_SIZE
+
+KeyContext = backend.KeyContext
+
+aes_cmac = backend.aes_cmac
+aes128_encrypt = backend.aes128_encrypt
+aes128_decrypt = backend.aes128_decrypt
+compute_uplink_mic = backend.compute_uplink_mic
+compute_app_skey = backend.compute_app_skey
+compute_nwk_skey = backend.compute_nwk_skey
+
+aes_cmac_ctx = backend.aes_cmac_ctx
+aes128_encrypt_ctx = backend.aes128_encrypt_ctx
+aes128_decrypt_ctx = backend.aes128_decrypt_ctx
+compute_uplink_mic_ctx = backend.compute_uplink_mic_ctx
+compute_app_skey_ctx = backend.compute_app_skey_ctx
+compute_nwk_skey_ctx = backend.compute_nwk_skey_ctx
+
+compute_nwk_skey_batch = backend.compute_nwk_skey_batch
+compute_uplink_mic_batch = backend.compute_uplink_mic_batch
+encode_join_accept_batch = backend.encode_join_accept_batch
+
+KEY_CONTEXT_CACHE_SIZE_DEFAULT = 65536
+
+class KeyContextCache(object):
+    """ Bounded cache of KeyContext indexed by key. Approximates LRU with two 
+        generations: a hit in the old generation promotes the context, the old 
+        generation is dropped when the new one is full. """
+    def __init__(self, size=KEY_CONTEXT_CACHE_SIZE_DEFAULT):
+        self.resize(size)
+
+    def resize(self, size):
+        self.size = max(size, 2)
+        self.young = {}
+        self.old = {}
+
+    def __len__(self):
+        return len(self.young) + len(self.old)
+
+    def get(self, key):
+        ctx = self.young.get(key, None)
+        if ctx is not None:
+            return ctx
+        ctx = self.old.pop(key, None)
+        if ctx is None:
+            ctx = KeyContext(key)
+        if len(self.young) >= self.size // 2:
+            self.old = self.young
+            self.young = {}
+        self.young[key] = ctx
+        return ctx
+
+key_contexts = KeyContextCache()
+
+def key_context(key):
+    return key_contexts.get(key)
+
+def pack_session_nonce(appnonce, netid, devnonce):
+    return struct.pack("<I", appnonce)[:3] + struct.pack("<I", netid)[:3] + struct.pack("<H", devnonce)
+
+def pack_uplink_mic_param(size, devaddr, fcnt):
+    return struct.pack("<HII", size, devaddr, fcnt)
@@ -0,0 +1,219 @@
+""" ctypes binding of the crypto C extension shared library, used when the
+    _lwcrypto CPython module is not available """
+import ctypes
+import os
+import platform
+import struct
+import sys
+import logging
+
+logger = logging.getLogger("harness.lwcrypto")
+
+def initialize_crypto_extension():
+    # C extension shared libray path
+    mydir = os.path.dirname(os.path.abspath(__file__))
+    machine = platform.machine()
+    libpath = os.path.join(mydir,'extension/build/', machine, "bin", "crypto.so")
+    try:
+        return ctypes.CDLL(libpath)
+    except:
+        logger.critical("lorawan crypto c extension %s not found", libpath)
+        sys.exit(-1)
+
+crypto = initialize_crypto_extension()
+
+# uint32_t key_ctx_size( void );
+crypto.key_ctx_size.argtypes = ()
+crypto.key_ctx_size.restype = ctypes.c_uint32
+
+# void key_ctx_init( key_ctx_t *ctx, const uint8_t *key );
+crypto.key_ctx_init.argtypes = (ctypes.c_char_p, ctypes.c_char_p)
+
+# uint32_t aes_cmac( const uint8_t *buffer, uint16_t size, const uint8_t *key);
+crypto.aes_cmac.argtypes = (ctypes.c_char_p, ctypes.c_uint16, ctypes.c_char_p) 
+crypto.aes_cmac.restype = ctypes.c_uint32 
+
+# void encrypt( const uint8_t *buffer, uint16_t size, const uint8_t *key, uint8_t *encBuffer );
+crypto.aes128_encrypt.argtypes = (ctypes.c_char_p, ctypes.c_uint16, ctypes.c_char_p, ctypes.c_char_p)
+
+# void decrypt( const uint8_t *buffer, uint16_t size, const uint8_t *key, uint8_t *decBuffer );
+crypto.aes128_decrypt.argtypes = (ctypes.c_char_p, ctypes.c_uint16, ctypes.c_char_p, ctypes.c_char_p)
+
+# void compute_app_skey(const uint8_t *key,  uint32_t appnonce, uint32_t netid, uint16_t devnonce, uint8_t *nwkSKey);
+crypto.compute_app_skey.argtypes = (ctypes.c_char_p, ctypes.c_uint32, ctypes.c_uint32, ctypes.c_uint16, ctypes.c_char_p)
+
+# void compute_nwk_skey(const uint8_t *key,  uint32_t appnonce, uint32_t netid, uint16_t devnonce, uint8_t *nwkSKey);
+crypto.compute_nwk_skey.argtypes = (ctypes.c_char_p, ctypes.c_uint32, ctypes.c_uint32, ctypes.c_uint16, ctypes.c_char_p)
+
+# uint32_t compute_uplink_mic(const uint8_t *buffer, uint16_t size, const uint8_t *key, uint32_t devaddr,  uint32_t fcnt)
+crypto.compute_uplink_mic.argtypes = (ctypes.c_char_p, ctypes.c_uint16, ctypes.c_char_p, ctypes.c_uint32, ctypes.c_uint32)
+crypto.compute_uplink_mic.restype = ctypes.c_uint32
+
+# Key context variants, key is replaced by a key_ctx_t initialized by key_ctx_init
+crypto.aes_cmac_ctx.argtypes = (ctypes.c_char_p, ctypes.c_uint16, ctypes.c_char_p)
+crypto.aes_cmac_ctx.restype = ctypes.c_uint32
+crypto.aes128_encrypt_ctx.argtypes = (ctypes.c_char_p, ctypes.c_uint16, ctypes.c_char_p, ctypes.c_char_p)
+crypto.aes128_decrypt_ctx.argtypes = (ctypes.c_char_p, ctypes.c_uint16, ctypes.c_char_p, ctypes.c_char_p)
+crypto.compute_app_skey_ctx.argtypes = (ctypes.c_char_p, ctypes.c_uint32, ctypes.c_uint32, ctypes.c_uint16, ctypes.c_char_p)
+crypto.compute_nwk_skey_ctx.argtypes = (ctypes.c_char_p, ctypes.c_uint32, ctypes.c_uint32, ctypes.c_uint16, ctypes.c_char_p)
+crypto.compute_uplink_mic_ctx.argtypes = (ctypes.c_char_p, ctypes.c_uint16, ctypes.c_char_p, ctypes.c_uint32, ctypes.c_uint32)
+crypto.compute_uplink_mic_ctx.restype = ctypes.c_uint32
+
+# Batch variants, records are packed little-endian (see crypto.h)
+crypto.compute_nwk_skey_batch.argtypes = (ctypes.c_char_p, ctypes.c_char_p, ctypes.c_uint32, ctypes.c_char_p)
+crypto.compute_uplink_mic_batch.argtypes = (ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_uint32, ctypes.c_char_p)
+crypto.encode_join_accept_batch.argtypes = (ctypes.c_char_p, ctypes.c_char_p, ctypes.c_uint32, ctypes.c_char_p)
+
+SESSION_NONCE_SIZE = 8
+UPLINK_MIC_PARAM_SIZE = 10
+JOIN_ACCEPT_MACPAYLOAD_SIZE = 12
+JOIN_ACCEPT_FRAME_SIZE = 1 + JOIN_ACCEPT_MACPAYLOAD_SIZE + 4
+
+KEY_CTX_SIZE = crypto.key_ctx_size()
+
+class KeyContext(object):
+    """ Opaque handle on an expanded key (AES key schedule and CMAC subkeys) """
+    __slots__ = ('key', 'handle')
+
+    def __init__(self, key):
+        if len(key) != 16:
+            raise ValueError("key must be 16 bytes")
+        self.key = key
+        self.handle = ctypes.create_string_buffer(KEY_CTX_SIZE)
+        crypto.key_ctx_init(self.handle, key)
+
+def to_bytes(buf):
+    """ bytes of a str, bytearray, array or memoryview """
+    if isinstance(buf, bytes):
+        return buf
+    try:
+        return memoryview(buf).tobytes()
+    except TypeError:
+        # python 2 array.array only supports the old buffer protocol 
+        return bytes(buffer(buf))
+
+def aes_cmac(buffer, key):
+    buffer = to_bytes(buffer)
+    size = len(buffer)
+    c_buf = ctypes.c_char_p(buffer)
+    c_key = ctypes.c_char_p(key)
+    mic = crypto.aes_cmac(c_buf, size, c_key)
+    return mic 
+
+def aes128_encrypt(buffer, key):
+    buffer = to_bytes(buffer)
+    size = len(buffer)
+    c_buf = ctypes.c_char_p(buffer)
+    c_key = ctypes.c_char_p(key)
+
+    out = ctypes.create_string_buffer(size) 
+    crypto.aes128_encrypt(c_buf, size, c_key, out)
+    return out.raw
+
+def aes128_decrypt(buffer, key):
+    buffer = to_bytes(buffer)
+    size = len(buffer)
+    c_buf = ctypes.c_char_p(buffer)
+    c_key = ctypes.c_char_p(key)
+
+    out = ctypes.create_string_buffer(size) 
+    crypto.aes128_decrypt(c_buf, size, c_key, out)
+    return out.raw 
+
+def compute_uplink_mic(buffer, key, devaddr, fcnt):
+    buffer = to_bytes(buffer)
+    size = len(buffer)
+    c_buf = ctypes.c_char_p(buffer)
+    c_key = ctypes.c_char_p(key)
+    mic = crypto.compute_uplink_mic(c_buf, size, c_key, devaddr, fcnt)
+    return mic 
+
+def compute_app_skey(appnonce, netid, devnonce, key):
+    c_key = ctypes.c_char_p(key)
+    appskey = ctypes.create_string_buffer(16)
+    crypto.compute_app_skey(c_key, appnonce, netid, devnonce, appskey)
+    return appskey.raw
+
+def compute_nwk_skey(appnonce, netid, devnonce, key):
+    c_key = ctypes.c_char_p(key)
+    nwkskey = ctypes.create_string_buffer(16)
+    crypto.compute_nwk_skey(c_key, appnonce, netid, devnonce, nwkskey)
+    return nwkskey.raw
+
+def aes_cmac_ctx(buffer, ctx):
+    buffer = to_bytes(buffer)
+    return crypto.aes_cmac_ctx(buffer, len(buffer), ctx.handle)
+
+def aes128_encrypt_ctx(buffer, ctx):
+    buffer = to_bytes(buffer)
+    size = len(buffer)
+    out = ctypes.create_string_buffer(size) 
+    crypto.aes128_encrypt_ctx(buffer, size, ctx.handle, out)
+    return out.raw
+
+def aes128_decrypt_ctx(buffer, ctx):
+    buffer = to_bytes(buffer)
+    size = len(buffer)
+    out = ctypes.create_string_buffer(size) 
+    crypto.aes128_decrypt_ctx(buffer, size, ctx.handle, out)
+    return out.raw
+
+def compute_uplink_mic_ctx(buffer, ctx, devaddr, fcnt):
+    buffer = to_bytes(buffer)
+    return crypto.compute_uplink_mic_ctx(buffer, len(buffer), ctx.handle, devaddr, fcnt)
+
+def compute_app_skey_ctx(appnonce, netid, devnonce, ctx):
+    appskey = ctypes.create_string_buffer(16)
+    crypto.compute_app_skey_ctx(ctx.handle, appnonce, netid, devnonce, appskey)
+    return appskey.raw
+
+def compute_nwk_skey_ctx(appnonce, netid, devnonce, ctx):
+    nwkskey = ctypes.create_string_buffer(16)
+    crypto.compute_nwk_skey_ctx(ctx.handle, appnonce, netid, devnonce, nwkskey)
+    return nwkskey.raw
+
+def batch_count(buf, record_size, name):
+    count, remainder = divmod(len(buf), record_size)
+    if remainder:
+        raise ValueError("%s size %d is not a multiple of %d" % (name, len(buf), record_size))
+    return count
+
+def compute_nwk_skey_batch(keys, nonces):
+    """ keys: N x 16 byte AppKeys, nonces: N x 8 byte packed session nonces 
+        returns N x 16 byte NwkSKeys """
+    keys = to_bytes(keys)
+    nonces = to_bytes(nonces)
+    count = batch_count(keys, 16, "keys")
+    if batch_count(nonces, SESSION_NONCE_SIZE, "nonces") != count:
+        raise ValueError("keys and nonces count mismatch")
+    out = ctypes.create_string_buffer(count * 16)
+    crypto.compute_nwk_skey_batch(keys, nonces, count, out)
+    return out.raw
+
+def compute_uplink_mic_batch(buffers, params, keys):
+    """ buffers: concatenated frames without MIC, params: N x 10 byte packed (size, devaddr, fcnt), 
+        keys: N x 16 byte NwkSKeys, returns N x 4 byte little-endian MICs """
+    buffers = to_bytes(buffers)
+    params = to_bytes(params)
+    keys = to_bytes(keys)
+    count = batch_count(keys, 16, "keys")
+    if batch_count(params, UPLINK_MIC_PARAM_SIZE, "params") != count:
+        raise ValueError("keys and params count mismatch")
+    sizes = struct.unpack("<" + "H8x" * count, params)
+    if sum(sizes) > len(buffers):
+        raise ValueError("buffers shorter than the sum of sizes")
+    out = ctypes.create_string_buffer(count * 4)
+    crypto.compute_uplink_mic_batch(buffers, params, keys, count, out)
+    return out.raw
+
+def encode_join_accept_batch(keys, macpayloads):
+    """ keys: N x 16 byte AppKeys, macpayloads: N x 12 byte join-accept MACPayloads (without CFList) 
+        returns N x 17 byte encrypted join-accept frames """
+    keys = to_bytes(keys)
+    macpayloads = to_bytes(macpayloads)
+    count = batch_count(keys, 16, "keys")
+    if batch_count(macpayloads, JOIN_ACCEPT_MACPAYLOAD_SIZE, "macpayloads") != count:
+        raise ValueError("keys and macpayloads count mismatch")
+    out = ctypes.create_string_buffer(count * JOIN_ACCEPT_FRAME_SIZE)
+    crypto.encode_join_accept_batch(keys, macpayloads, count, out)
+    return out.raw
@@ -0,0 +1,86 @@
+""" Deduplication of the rxpk copies of a frame heard by several gateways or by
+    both radios of one gateway.
+
+    Copies are keyed by the rxpk base64 data. The first copy opens a window of
+    window seconds, the copies received within it replace the held packet when
+    their signal is better (RSSI, then SNR). The best copy is released when the
+    window ends, so the downlink goes through the gateway that heard the frame
+    best. Copies arriving up to one more window later are dropped.
+"""
+import collections
+
+DEDUP_WINDOW_DEFAULT = 0.2
+DEDUP_MAX_ENTRIES_DEFAULT = 65536
+
+def signal_quality(pkt):
+    rxpk = pkt.rxpk
+    return rxpk.get('rssi', -1000), rxpk.get('lsnr', -1000.0)
+
+class DedupEntry(object):
+    __slots__ = ('key', 'pkt', 'quality', 'deadline', 'copies')
+
+    def __init__(self, key, pkt, deadline):
+        self.key = key
+        self.pkt = pkt
+        self.quality = signal_quality(pkt)
+        self.deadline = deadline
+        self.copies = 1
+
+class DedupCache(object):
+    """ Frames seen in the last two windows, at most max_entries """
+    def __init__(self, window=DEDUP_WINDOW_DEFAULT, max_entries=DEDUP_MAX_ENTRIES_DEFAULT):
+        self.window = window
+        self.max_entries = max_entries
+        self.entries = {}
+        # entries by deadline: held until released, then kept until expired
+        self.held = collections.deque()
+        self.seen = collections.deque()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, pkt, now):
+        """ Returns False when pkt is a copy of a frame already seen """
+        key = pkt.rxpk['data']
+        entry = self.entries.get(key, None)
+        if entry is not None:
+            entry.copies += 1
+            if entry.deadline > now:
+                quality = signal_quality(pkt)
+                if quality > entry.quality:
+                    entry.pkt = pkt
+                    entry.quality = quality
+            return False
+        entry = self.entries[key] = DedupEntry(key, pkt, now + self.window)
+        self.held.append(entry)
+        self.seen.append(entry)
+        return True
+
+    def next_deadline(self):
+        return self.held[0].deadline if self.held else None
+
+    def release(self, now):
+        """ Best copies of the frames whose window has ended """
+        released = []
+        entries = self.entries
+        seen = self.seen
+        # beyond max_entries the oldest frames are forgotten, released early if still held
+        while len(entries) > self.max_entries:
+            entry = seen.popleft()
+            if entries.get(entry.key, None) is entry:
+                del entries[entry.key]
+            if entry.pkt is not None:
+                released.append(entry.pkt)
+                entry.pkt = None
+        held = self.held
+        while held and held[0].deadline <= now:
+            entry = held.popleft()
+            if entry.pkt is not None:
+                released.append(entry.pkt)
+                entry.pkt = None
+        expiry = now - self.window
+        while seen and seen[0].deadline <= expiry:
+            entry = seen.popleft()
+            if entries.get(entry.key, None) is entry:
+                del entries[entry.key]
+        return released
@@ -0,0 +1,106 @@
+""" DevAddr allocation within a NetID.
+
+    A DevAddr is the NetID type prefix (type ones followed by a zero), the
+    NwkID (the low bits of the NetID) and the NwkAddr, the field sizes depend
+    on the NetID type (LoRaWAN Backend Interfaces 1.0, DevAddr assignment).
+
+    A pool hands out the NwkAddrs first, first + step, ... up to last, so that
+    worker processes or harness instances sharing a network use disjoint
+    addresses. Allocation and release are O(1): the addresses never used are
+    handed out in order from a high-water mark, then the released ones in
+    release order from a free list. A bitmap of the allocated addresses
+    rejects releases of free ones.
+"""
+import collections
+
+# NetID type -> NwkID bits, the type prefix is type + 1 bits long
+NWKID_BITS = (6, 6, 9, 11, 12, 13, 15, 17)
+
+def netid_type(netid):
+    return (netid >> 21) & 0x7
+
+def nwkaddr_bits(netid):
+    type_ = netid_type(netid)
+    return 32 - (type_ + 1) - NWKID_BITS[type_]
+
+def devaddr_prefix(netid):
+    """ Type prefix and NwkID of the DevAddrs of netid, NwkAddr bits cleared """
+    type_ = netid_type(netid)
+    nwkid_bits = NWKID_BITS[type_]
+    nwkid = netid & ((1 << nwkid_bits) - 1)
+    return ((((1 << type_) - 1) << 1 << nwkid_bits) | nwkid) << nwkaddr_bits(netid)
+
+def devaddr_type(devaddr):
+    """ NetID type of a DevAddr, the number of leading ones, None for an invalid prefix """
+    for type_ in range(0, len(NWKID_BITS)):
+        if not devaddr & (0x80000000 >> type_):
+            return type_
+    return None
+
+def nwkaddr_mask(devaddr):
+    type_ = devaddr_type(devaddr)
+    return (1 << nwkaddr_bits(type_ << 21)) - 1 if type_ is not None else 0
+
+# DevAddr most significant byte -> NwkAddr mask, the type prefix is at most 8 bits
+NWKADDR_MASKS = [nwkaddr_mask(msb << 24) for msb in range(0, 256)]
+
+def nwkaddr(devaddr):
+    return devaddr & NWKADDR_MASKS[devaddr >> 24]
+
+class DevAddrPool(object):
+    def __init__(self, netid, first=1, last=None, step=1):
+        """ Pool of the DevAddrs of netid with NwkAddr in first, first + step, ... last,
+            last defaults to the highest NwkAddr. Raises ValueError on an empty range """
+        self.netid = netid
+        self.prefix = devaddr_prefix(netid)
+        self.mask = (1 << nwkaddr_bits(netid)) - 1
+        if last is None:
+            last = self.mask
+        if not 0 <= first <= last <= self.mask or step < 1:
+            raise ValueError("NwkAddr range %d..%d step %d out of NetID %06X NwkAddr range 0..%d" %
+                             (first, last, step, netid, self.mask))
+        self.first = first
+        self.step = step
+        self.size = (last - first) // step + 1
+        self.bitmap = bytearray((self.size + 7) // 8)
+        # indices below high are allocated or in the free list
+        self.high = 0
+        self.free = collections.deque()
+        self.count = 0
+
+    def __len__(self):
+        """ Allocated addresses """
+        return self.count
+
+    def allocate(self):
+        """ A free DevAddr, None when all are allocated. A released address
+            is reused once the addresses never used are exhausted """
+        if self.high < self.size:
+            index = self.high
+            self.high += 1
+        elif self.free:
+            index = self.free.popleft()
+        else:
+            return None
+        self.bitmap[index >> 3] |= 1 << (index & 7)
+        self.count += 1
+        return self.prefix | (self.first + index * self.step)
+
+    def index(self, devaddr):
+        """ Bitmap index of devaddr, None if it is not an address of the pool """
+        if devaddr & ~self.mask != self.prefix:
+            return None
+        index, remainder = divmod((devaddr & self.mask) - self.first, self.step)
+        if remainder or not 0 <= index < self.size:
+            return None
+        return index
+
+    def release(self, devaddr):
+        """ Free an allocated DevAddr, False if it was not """
+        index = self.index(devaddr)
+        if index is None or not self.bitmap[index >> 3] & (1 << (index & 7)):
+            return False
+        self.bitmap[index >> 3] &= ~(1 << (index & 7)) & 0xFF
+        self.free.append(index)
+        self.count -= 1
+        return True
@@ -0,0 +1,218 @@
+""" Device provisioning store.
+
+    A device CSV file (DEVEUI and APPKEY columns) is validated and converted in
+    bulk, then compiled into a binary store saved next to it:
+
+        header   magic(4) version(2) reserved(2) count(4) csv size(8) csv mtime(8)
+        DevEUIs  count x 8 bytes, sorted
+        AppKeys  count x 16 bytes, in DevEUI order
+
+    While the CSV file is unchanged, later runs memory-map the store instead of
+    parsing the CSV again. DevEUIs are looked up by binary search.
+"""
+import binascii
+import bisect
+import csv
+import mmap
+import operator
+import os
+import struct
+import logging
+
+logger = logging.getLogger('harness.devicestore')
+
+STORE_MAGIC = 'LWDS'
+STORE_VERSION = 1
+STORE_EXT = '.devstore'
+STORE_HEADER = struct.Struct('<4sHHIQd')
+
+DEVEUI_SIZE = 8
+APPKEY_SIZE = 16
+RECORD_SIZE = DEVEUI_SIZE + APPKEY_SIZE
+
+class SortedDevEuis(object):
+    """ Sequence view of the DevEUI array, searched with bisect """
+    __slots__ = ('buf', 'offset', 'count')
+
+    def __init__(self, buf, offset, count):
+        self.buf = buf
+        self.offset = offset
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        pos = self.offset + index * DEVEUI_SIZE
+        return self.buf[pos:pos + DEVEUI_SIZE]
+
+class DeviceStore(object):
+    """ DevEUI and AppKey arrays over a buffer (str or mmap) """
+    def __init__(self, buf, count, offset=0):
+        self.__buf = buf
+        self.__count = count
+        self.__deveuis = SortedDevEuis(buf, offset, count)
+        self.__appkey_offset = offset + count * DEVEUI_SIZE
+
+    def __len__(self):
+        return self.__count
+
+    def __iter__(self):
+        for index in xrange(0, self.__count):
+            yield self.deveui(index), self.appkey(index)
+
+    def find(self, deveui):
+        """ index of deveui or -1 """
+        index = bisect.bisect_left(self.__deveuis, deveui)
+        if index < self.__count and self.__deveuis[index] == deveui:
+            return index
+        return -1
+
+    def deveui(self, index):
+        return self.__deveuis[index]
+
+    def appkey(self, index):
+        pos = self.__appkey_offset + index * APPKEY_SIZE
+        return self.__buf[pos:pos + APPKEY_SIZE]
+
+    def get(self, deveui):
+        """ AppKey of deveui or None """
+        index = self.find(deveui)
+        return self.appkey(index) if index >= 0 else None
+
+    def close(self):
+        if isinstance(self.__buf, mmap.mmap):
+            self.__buf.close()
+
+def diff(old, new):
+    """ (added, removed, changed) DevEUIs from store old to store new, changed
+        ones have a new AppKey. A merge of the two sorted DevEUI arrays """
+    added, removed, changed = [], [], []
+    i = j = 0
+    old_count, new_count = len(old), len(new)
+    while i < old_count and j < new_count:
+        old_deveui, new_deveui = old.deveui(i), new.deveui(j)
+        if old_deveui == new_deveui:
+            if old.appkey(i) != new.appkey(j):
+                changed.append(old_deveui)
+            i += 1
+            j += 1
+        elif old_deveui < new_deveui:
+            removed.append(old_deveui)
+            i += 1
+        else:
+            added.append(new_deveui)
+            j += 1
+    removed.extend(old.deveui(index) for index in xrange(i, old_count))
+    added.extend(new.deveui(index) for index in xrange(j, new_count))
+    return added, removed, changed
+
+def store_path(device_file):
+    return os.path.splitext(device_file)[0] + STORE_EXT
+
+def row_errors(device_file, rows, deveui_col, appkey_col):
+    """ Validate rows one by one, only used to report the invalid rows once the
+        bulk conversion has failed """
+    errors = []
+    width = max(deveui_col, appkey_col) + 1
+    for row_nb, row in enumerate(rows, 1):
+        if len(row) < width:
+            errors.append("read file %s invalid row %d" % (device_file, row_nb))
+            continue
+        for name, value, size in [('deveui', row[deveui_col].strip(), DEVEUI_SIZE),
+                                  ('appkey', row[appkey_col].strip(), APPKEY_SIZE)]:
+            try:
+                valid = len(binascii.unhexlify(value)) == size
+            except TypeError:
+                valid = False
+            if not valid:
+                errors.append("invalid %s=%s in f=%s entry=%d" % (name, value, device_file, row_nb))
+    return errors
+
+def parse_device_file(device_file):
+    """ Validate and convert a device CSV file as a whole.
+        Returns (records, errors): DevEUI|AppKey records sorted by DevEUI, and
+        one error message per invalid row or duplicated DevEUI """
+    with open(device_file, 'rb') as csvfile:
+        reader = csv.reader(csvfile)
+        fieldnames = next(reader, [])
+        if 'DEVEUI' not in fieldnames or 'APPKEY' not in fieldnames:
+            return None, ["Missing field names in f=%s" % device_file]
+        rows = filter(None, reader)
+
+    deveui_col = fieldnames.index('DEVEUI')
+    appkey_col = fieldnames.index('APPKEY')
+    width = max(deveui_col, appkey_col) + 1
+    records = None
+    if not rows:
+        records = []
+    elif min(map(len, rows)) >= width:
+        deveuis = map(str.strip, map(operator.itemgetter(deveui_col), rows))
+        appkeys = map(str.strip, map(operator.itemgetter(appkey_col), rows))
+        if set(map(len, deveuis)) == set([DEVEUI_SIZE * 2]) and set(map(len, appkeys)) == set([APPKEY_SIZE * 2]):
+            try:
+                data = binascii.unhexlify(''.join(map(operator.add, deveuis, appkeys)))
+                records = [data[pos:pos + RECORD_SIZE] for pos in xrange(0, len(data), RECORD_SIZE)]
+            except TypeError:
+                pass
+    if records is None:
+        return None, row_errors(device_file, rows, deveui_col, appkey_col)
+
+    records.sort()
+    errors = []
+    for prev, record in zip(records, records[1:]):
+        if prev[:DEVEUI_SIZE] == record[:DEVEUI_SIZE]:
+            errors.append("Duplicate entries for deveui=%s found in f=%s" %
+                          (binascii.hexlify(record[:DEVEUI_SIZE]).upper(), device_file))
+    return records, errors
+
+def write_store(path, records, csv_size, csv_mtime):
+    # per process, workers may compile the same file
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(STORE_HEADER.pack(STORE_MAGIC, STORE_VERSION, 0, len(records), csv_size, csv_mtime))
+        f.write(''.join(record[:DEVEUI_SIZE] for record in records))
+        f.write(''.join(record[DEVEUI_SIZE:] for record in records))
+    os.rename(tmp_path, path)
+
+def open_store(path, csv_size=None, csv_mtime=None):
+    """ Memory-map a device store, None if missing, invalid or out of date """
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        return None
+    with f:
+        size = os.fstat(f.fileno()).st_size
+        if size < STORE_HEADER.size:
+            return None
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, _, count, src_size, src_mtime = STORE_HEADER.unpack_from(buf)
+    if (magic != STORE_MAGIC or version != STORE_VERSION or size != STORE_HEADER.size + count * RECORD_SIZE or
+            (csv_size is not None and (src_size, src_mtime) != (csv_size, csv_mtime))):
+        buf.close()
+        return None
+    return DeviceStore(buf, count, STORE_HEADER.size)
+
+def load(device_file):
+    """ Device store of a CSV file, compiled on first use.
+        Returns (store, errors), store is None when the file has invalid entries.
+        Raises IOError/OSError when the CSV file cannot be read """
+    st = os.stat(device_file)
+    path = store_path(device_file)
+    store = open_store(path, st.st_size, st.st_mtime)
+    if store is not None:
+        return store, []
+
+    records, errors = parse_device_file(device_file)
+    if errors:
+        return None, errors
+    try:
+        write_store(path, records, st.st_size, st.st_mtime)
+        store = open_store(path)
+    except (IOError, OSError) as e:
+        logger.warning("device store %s not written: %s", path, e)
+    if store is None:
+        deveuis = ''.join(record[:DEVEUI_SIZE] for record in records)
+        appkeys = ''.join(record[DEVEUI_SIZE:] for record in records)
+        store = DeviceStore(deveuis + appkeys, len(records))
+    return store, []
@@ -0,0 +1,113 @@
+""" Downlink scheduling on the gateway radio.
+
+    Times are gateway tmst values: 32 bit microsecond counters that wrap
+    around. A downlink is schedulable when it can still reach the gateway
+    lead_time_us before its tmst and does not overlap a downlink already
+    booked on the radio.
+
+    Sent downlinks are kept by PULL_RESP token until the gateway TX_ACK, so a
+    rejected downlink can be sent again on another rx window.
+"""
+import collections
+import math
+import re
+
+TMST_MASK = 0xFFFFFFFF
+# Margin for the PULL_RESP to reach the packet forwarder JIT queue
+DOWNLINK_LEAD_TIME_US = 100000
+# Radio turnaround between two downlinks
+DOWNLINK_GUARD_US = 1000
+PREAMBLE_SYMBOLS = 8
+
+DATR_RE = re.compile(r'SF(\d+)BW(\d+)')
+
+def tmst_diff(a, b):
+    """ a - b for wrapping 32 bit tmst values """
+    diff = (a - b) & TMST_MASK
+    return diff - (TMST_MASK + 1) if diff > TMST_MASK >> 1 else diff
+
+def time_on_air_us(datr, size, coderate='4/5', crc=False, preamble=PREAMBLE_SYMBOLS):
+    """ LoRa time on air in microseconds of a size byte frame, explicit header.
+        Downlinks are sent without payload CRC. """
+    match = DATR_RE.match(datr)
+    sf = int(match.group(1))
+    bw = int(match.group(2)) * 1000
+    cr = int(coderate.split('/')[1]) - 4
+    tsym = float(1 << sf) / bw
+    de = 1 if tsym > 0.016 else 0
+    payload_symbols = 8 + max(int(math.ceil((8.0 * size - 4 * sf + 28 + (16 if crc else 0)) / (4 * (sf - 2 * de)))) * (cr + 4), 0)
+    return int(((preamble + 4.25) + payload_symbols) * tsym * 1e6)
+
+class DownlinkScheduler(object):
+    """ Downlinks booked on the radio of one gateway """
+    def __init__(self, lead_time_us=DOWNLINK_LEAD_TIME_US, guard_us=DOWNLINK_GUARD_US):
+        self.lead_time_us = lead_time_us
+        self.guard_us = guard_us
+        # tmst -> end tmst of the booked downlinks
+        self.booked = {}
+
+    def __len__(self):
+        return len(self.booked)
+
+    def expire(self, now_tmst):
+        for start, end in self.booked.items():
+            if tmst_diff(end, now_tmst) < 0:
+                del self.booked[start]
+
+    def reachable(self, txtmst, now_tmst):
+        return now_tmst is None or tmst_diff(txtmst, now_tmst) >= self.lead_time_us
+
+    def available(self, txtmst, airtime_us):
+        end = (txtmst + airtime_us + self.guard_us) & TMST_MASK
+        for start, booked_end in self.booked.items():
+            if tmst_diff(txtmst, booked_end) < 0 and tmst_diff(start, end) < 0:
+                return False
+        return True
+
+    def book(self, txtmst, airtime_us):
+        self.booked[txtmst & TMST_MASK] = (txtmst + airtime_us + self.guard_us) & TMST_MASK
+
+    def cancel(self, txtmst):
+        self.booked.pop(txtmst & TMST_MASK, None)
+
+class PendingDownlink(object):
+    """ PULL_RESP waiting for its TX_ACK. retry_windows are the (rxslot, rxconf, txtmst)
+        windows the frame can still be sent on when the gateway rejects it, context
+        is given back to the server retry_handler """
+    __slots__ = ('token', 'frame', 'txtmst', 'push_pkt', 'retry_windows', 'sent_time', 'context')
+
+    def __init__(self, token, frame, txtmst, push_pkt, retry_windows, sent_time, context=None):
+        self.token = token
+        self.frame = frame
+        self.txtmst = txtmst
+        self.push_pkt = push_pkt
+        self.retry_windows = retry_windows
+        self.sent_time = sent_time
+        self.context = context
+
+class OutstandingDownlinks(object):
+    """ Pending downlinks of one gateway by PULL_RESP token, expired in send order """
+    def __init__(self):
+        self.pending = {}
+        self.order = collections.deque()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, pending):
+        self.pending[pending.token] = pending
+        self.order.append(pending)
+
+    def pop(self, token):
+        return self.pending.pop(token, None)
+
+    def expire(self, deadline):
+        """ Remove the downlinks sent before deadline, returns them """
+        expired = []
+        order = self.order
+        while order and order[0].sent_time < deadline:
+            pending = order.popleft()
+            if self.pending.get(pending.token, None) is pending:
+                del self.pending[pending.token]
+                expired.append(pending)
+        return expired
@@ -102,42 +102,42 @@ void AES_CMAC_Update(AES_CMAC_CTX *ctx, const uint8_t *data, uint32_t len)
             ctx->M_n = len;
 }
    
-void AES_CMAC_Final(uint8_t digest[AES_CMAC_DIGEST_LENGTH], AES_CMAC_CTX *ctx)
+void AES_CMAC_Subkeys(AES_CMAC_CTX *ctx, uint8_t K1[16], uint8_t K2[16])
 {
-            uint8_t K[16];
-        uint8_t in[16];
             /* generate subkey K1 */
-            memset1(K, '\0', 16);
+            memset1(K1, '\0', 16);
 
-            //rijndael_encrypt(&ctx->rijndael, K, K);
+            aes_encrypt( K1, K1, &ctx->rijndael);
 
-            aes_encrypt( K, K, &ctx->rijndael);
+            if (K1[0] & 0x80) {
+                    LSHIFT(K1, K1);
+                   K1[15] ^= 0x87;
+            } else
+                    LSHIFT(K1, K1);
 
-            if (K[0] & 0x80) {
-                    LSHIFT(K, K);
-                   K[15] ^= 0x87;
+            /* generate subkey K2 */
+            if (K1[0] & 0x80) {
+                    LSHIFT(K1, K2);
+                    K2[15] ^= 0x87;
             } else
-                    LSHIFT(K, K);
+                    LSHIFT(K1, K2);
+}
 
+void AES_CMAC_FinalSubkeys(uint8_t digest[AES_CMAC_DIGEST_LENGTH], AES_CMAC_CTX *ctx, const uint8_t K1[16], const uint8_t K2[16])
+{
+        uint8_t in[16];
 
             if (ctx->M_n == 16) {
                     /* last block was a complete block */
-                    XOR(K, ctx->M_last);
+                    XOR(K1, ctx->M_last);
 
            } else {
-                   /* generate subkey K2 */
-                  if (K[0] & 0x80) {
-                          LSHIFT(K, K);
-                          K[15] ^= 0x87;
-                  } else
-                           LSHIFT(K, K);
-
                    /* padding(M_last) */
                    ctx->M_last[ctx->M_n] = 0x80;
                    while (++ctx->M_n < 16)
                          ctx->M_last[ctx->M_n] = 0;
    
-                  XOR(K, ctx->M_last);
+                  XOR(K2, ctx->M_last);
 
 
            }
@@ -147,7 +147,15 @@ void AES_CMAC_Final(uint8_t digest[AES_CMAC_DIGEST_LENGTH], AES_CMAC_CTX *ctx)
 
        memcpy1(in, &ctx->X[0], 16); //Bestela ez du ondo iten
        aes_encrypt(in, digest, &ctx->rijndael);
-           memset1(K, 0, sizeof K);
-
 }
+   
+void AES_CMAC_Final(uint8_t digest[AES_CMAC_DIGEST_LENGTH], AES_CMAC_CTX *ctx)
+{
+            uint8_t K1[16];
+            uint8_t K2[16];
 
+            AES_CMAC_Subkeys(ctx, K1, K2);
+            AES_CMAC_FinalSubkeys(digest, ctx, K1, K2);
+            memset1(K1, 0, sizeof K1);
+            memset1(K2, 0, sizeof K2);
+}
@@ -57,6 +57,9 @@ void     AES_CMAC_Update(AES_CMAC_CTX * ctx, const uint8_t * data, uint32_t len)
           //          __attribute__((__bounded__(__string__,2,3)));
 void     AES_CMAC_Final(uint8_t digest[AES_CMAC_DIGEST_LENGTH], AES_CMAC_CTX  * ctx);
             //     __attribute__((__bounded__(__minbytes__,1,AES_CMAC_DIGEST_LENGTH)));
+void     AES_CMAC_Subkeys(AES_CMAC_CTX * ctx, uint8_t K1[16], uint8_t K2[16]);
+void     AES_CMAC_FinalSubkeys(uint8_t digest[AES_CMAC_DIGEST_LENGTH], AES_CMAC_CTX * ctx,
+                               const uint8_t K1[16], const uint8_t K2[16]);
 //__END_DECLS
 
 #endif /* _CMAC_H_ */
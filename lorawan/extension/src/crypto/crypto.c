@@ -10,7 +10,7 @@
 #include <stdio.h>
 #define DBGPRINT(format, ...) printf(format, ## __VA_ARGS__)
 #else
-#define DBGPRINT(format, ...) 
+#define DBGPRINT(format, ...)
 #endif
 
 /*!
@@ -21,85 +21,73 @@
 /*!
  * MIC field computation initial data
  */
-static uint8_t MicBlockB0[] = { 0x49, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
-                                0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00};
+static const uint8_t MicBlockB0[] = { 0x49, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
+                                      0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00};
 
-
-/*!
- * Contains the computed MIC field.
- *
- * \remark Only the 4 first bytes are used
+/*
+ * All computation state lives on the stack or in the caller provided key context
+ * so that the functions are reentrant.
  */
-static uint8_t Mic[16];
 
-/*!
- * Encryption aBlock and sBlock
- */
-static uint8_t inBlock[] = { 0x01, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
-                             0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00 };
+uint32_t key_ctx_size( void )
+{
+    return sizeof( key_ctx_t );
+}
 
-/*!
- * AES computation context variable
- */
-static aes_context AesContext;
+void key_ctx_init( key_ctx_t *ctx, const uint8_t *key )
+{
+    AES_CMAC_CTX cmac;
 
-/*!
- * CMAC computation context variable
- */
-static AES_CMAC_CTX AesCmacCtx[1];
+    memset1( ctx->aes.ksch, '\0', 240 );
+    aes_set_key( key, 16, &ctx->aes );
 
-uint32_t aes_cmac( const uint8_t *buffer, uint16_t size, const uint8_t *key)
+    memcpy1( ( uint8_t * )&cmac.rijndael, ( const uint8_t * )&ctx->aes, sizeof( aes_context ) );
+    AES_CMAC_Subkeys( &cmac, ctx->K1, ctx->K2 );
+}
+
+static void cmac_start( AES_CMAC_CTX *cmac, const key_ctx_t *ctx )
 {
-    uint32_t mic = 0;
+    memset1( cmac->X, 0, sizeof cmac->X );
+    cmac->M_n = 0;
+    memcpy1( ( uint8_t * )&cmac->rijndael, ( const uint8_t * )&ctx->aes, sizeof( aes_context ) );
+}
 
-#ifdef DEBUG
-    DBGPRINT("AES-CMAC: msg size:%d, key:", size);
-    for(uint8_t i=0; i < 16; i++)
-        DBGPRINT("%02x",key[i]);
-#endif
+static uint32_t cmac_finish( AES_CMAC_CTX *cmac, const key_ctx_t *ctx )
+{
+    uint8_t mic[16];
+
+    AES_CMAC_FinalSubkeys( mic, cmac, ctx->K1, ctx->K2 );
+    return ( uint32_t )( ( uint32_t )mic[3] << 24 | ( uint32_t )mic[2] << 16 | ( uint32_t )mic[1] << 8 | ( uint32_t )mic[0] );
+}
+
+uint32_t aes_cmac_ctx( const uint8_t *buffer, uint16_t size, const key_ctx_t *ctx )
+{
+    AES_CMAC_CTX cmac;
+    uint32_t mic;
 
 #ifdef DEBUG
-    DBGPRINT("\n msg:");
+    DBGPRINT("AES-CMAC: msg size:%d\n msg:", size);
     for(uint8_t i=0; i < size; i++)
         DBGPRINT("%02x",buffer[i]);
     DBGPRINT("\n");
 #endif
 
-    AES_CMAC_Init( AesCmacCtx );
-    AES_CMAC_SetKey( AesCmacCtx, key );
-    AES_CMAC_Update( AesCmacCtx, buffer, size & 0xFF );
-    AES_CMAC_Final( Mic, AesCmacCtx );
-
+    cmac_start( &cmac, ctx );
+    AES_CMAC_Update( &cmac, buffer, size & 0xFF );
+    mic = cmac_finish( &cmac, ctx );
 
-    mic = ( uint32_t )( ( uint32_t )Mic[3] << 24 | ( uint32_t )Mic[2] << 16 | ( uint32_t )Mic[1] << 8 | ( uint32_t )Mic[0] );
     DBGPRINT("MIC: %04x\n", mic);
-
     return mic;
 }
 
-void aes128_encrypt( const uint8_t *buffer, uint16_t size, const uint8_t *key, uint8_t *encBuffer )
+void aes128_encrypt_ctx( const uint8_t *buffer, uint16_t size, const key_ctx_t *ctx, uint8_t *encBuffer )
 {
     uint8_t bufferIndex = 0;
-    uint16_t orig_size = size;
-
-#ifdef DEBUG
-    DBGPRINT("AES128 Encrypt: msg size:%d, key:", size);
-    for(uint8_t i=0; i < 16; i++)
-        DBGPRINT("%02x",key[i]);
-    DBGPRINT("\n");
-
-    DBGPRINT("IN:");
-    for(uint8_t i=0; i < size; i++)
-        DBGPRINT("%02x",buffer[i]);
-    DBGPRINT("\n");
-#endif
-
-    memset1( AesContext.ksch, '\0', 240 );
-    aes_set_key( key, 16, &AesContext );
+    uint8_t inBlock[16];
 
     while( size >= 16 )
     {
-        aes_encrypt( buffer + bufferIndex , encBuffer + bufferIndex, &AesContext );
+        aes_encrypt( buffer + bufferIndex , encBuffer + bufferIndex, ( aes_context * )&ctx->aes );
         size -= 16;
         bufferIndex += 16;
     }
@@ -108,40 +96,18 @@ void aes128_encrypt( const uint8_t *buffer, uint16_t size, const uint8_t *key, u
     {
         memset1(inBlock, 0, 16);
         memcpy1(inBlock, buffer + bufferIndex, size);
-        aes_encrypt(inBlock, encBuffer + bufferIndex, &AesContext );
+        aes_encrypt(inBlock, encBuffer + bufferIndex, ( aes_context * )&ctx->aes );
     }
-
-#ifdef DEBUG
-    DBGPRINT("OUT:");
-    for(uint8_t i=0; i < orig_size; i++)
-        DBGPRINT("%02x",encBuffer[i]);
-    DBGPRINT("\n");
-#endif
 }
 
-void aes128_decrypt( const uint8_t *buffer, uint16_t size, const uint8_t *key, uint8_t *decBuffer )
+void aes128_decrypt_ctx( const uint8_t *buffer, uint16_t size, const key_ctx_t *ctx, uint8_t *decBuffer )
 {
     uint8_t bufferIndex = 0;
-    uint16_t orig_size = size;
-
-#ifdef DEBUG
-    DBGPRINT("AES128 Decrypt: msg size:%d, key:", size);
-    for(uint8_t i=0; i < 16; i++)
-        DBGPRINT("%02x",key[i]);
-    DBGPRINT("\n");
-
-    DBGPRINT("IN:");
-    for(uint8_t i=0; i < size; i++)
-        DBGPRINT("%02x",buffer[i]);
-    DBGPRINT("\n");
-#endif
-
-    memset1( AesContext.ksch, '\0', 240 );
-    aes_set_key( key, 16, &AesContext );
+    uint8_t inBlock[16];
 
     while( size >= 16 )
     {
-        aes_decrypt( buffer + bufferIndex , decBuffer + bufferIndex, &AesContext );
+        aes_decrypt( buffer + bufferIndex , decBuffer + bufferIndex, ( aes_context * )&ctx->aes );
         size -= 16;
         bufferIndex += 16;
     }
@@ -150,18 +116,11 @@ void aes128_decrypt( const uint8_t *buffer, uint16_t size, const uint8_t *key, u
     {
         memset1(inBlock, 0, 16);
         memcpy1(inBlock, buffer + bufferIndex, size);
-        aes_decrypt(inBlock, decBuffer + bufferIndex, &AesContext );
+        aes_decrypt(inBlock, decBuffer + bufferIndex, ( aes_context * )&ctx->aes );
     }
-
-#ifdef DEBUG
-    DBGPRINT("OUT:");
-    for(uint8_t i=0; i < orig_size; i++)
-        DBGPRINT("%02x",decBuffer[i]);
-    DBGPRINT("\n");
-#endif
 }
 
-void compute_session_key(const uint8_t *key,  uint32_t appnonce, uint32_t netid, uint16_t devnonce, uint8_t keytype, uint8_t *skey)
+static void compute_session_key_ctx(const key_ctx_t *ctx,  uint32_t appnonce, uint32_t netid, uint16_t devnonce, uint8_t keytype, uint8_t *skey)
 {
     uint8_t nonce[16];
     memset1( nonce, 0, sizeof( nonce ) );
@@ -176,16 +135,9 @@ void compute_session_key(const uint8_t *key,  uint32_t appnonce, uint32_t netid,
     nonce[7] = devnonce & 0xff;
     nonce[8] = (devnonce >> 8) & 0xff;
 
-    memset1( AesContext.ksch, '\0', 240 );
-    aes_set_key( key, 16, &AesContext );
-    aes_encrypt( nonce, skey, &AesContext );
+    aes_encrypt( nonce, skey, ( aes_context * )&ctx->aes );
 
 #ifdef DEBUG
-    DBGPRINT("KEY:");
-    for(uint8_t i=0; i < 16; i++)
-        DBGPRINT("%02x",key[i]);
-    DBGPRINT("\n");
-
     DBGPRINT("Nonce:");
     for(uint8_t i=0; i < 16; i++)
         DBGPRINT("%02x",nonce[i]);
@@ -198,53 +150,48 @@ void compute_session_key(const uint8_t *key,  uint32_t appnonce, uint32_t netid,
 #endif
 }
 
-void compute_app_skey(const uint8_t *key,  uint32_t appnonce, uint32_t netid, uint16_t devnonce, uint8_t *nwkSKey)
+void compute_app_skey_ctx(const key_ctx_t *ctx,  uint32_t appnonce, uint32_t netid, uint16_t devnonce, uint8_t *appSKey)
 {
   DBGPRINT("compute_app_skey:\r\n");
-  compute_session_key(key,  appnonce, netid, devnonce, 2, nwkSKey);
+  compute_session_key_ctx(ctx,  appnonce, netid, devnonce, 2, appSKey);
 }
 
-void compute_nwk_skey(const uint8_t *key,  uint32_t appnonce, uint32_t netid, uint16_t devnonce, uint8_t *nwkSKey)
+void compute_nwk_skey_ctx(const key_ctx_t *ctx,  uint32_t appnonce, uint32_t netid, uint16_t devnonce, uint8_t *nwkSKey)
 {
   DBGPRINT("compute_nwk_skey:\r\n");
-  compute_session_key(key,  appnonce, netid, devnonce, 1, nwkSKey);
+  compute_session_key_ctx(ctx,  appnonce, netid, devnonce, 1, nwkSKey);
 }
 
-uint32_t compute_mic(const uint8_t *buffer, uint16_t size, const uint8_t *key, uint32_t devaddr, uint8_t dir, uint32_t fcnt)
+static uint32_t compute_mic_ctx(const uint8_t *buffer, uint16_t size, const key_ctx_t *ctx, uint32_t devaddr, uint8_t dir, uint32_t fcnt)
 {
-    MicBlockB0[5] = dir;
-    
-    MicBlockB0[6] = ( devaddr ) & 0xFF;
-    MicBlockB0[7] = ( devaddr >> 8 ) & 0xFF;
-    MicBlockB0[8] = ( devaddr >> 16 ) & 0xFF;
-    MicBlockB0[9] = ( devaddr >> 24 ) & 0xFF;
+    AES_CMAC_CTX cmac;
+    uint8_t b0[LORAMAC_MIC_BLOCK_B0_SIZE];
+    uint32_t mic;
 
-    MicBlockB0[10] = ( fcnt ) & 0xFF;
-    MicBlockB0[11] = ( fcnt >> 8 ) & 0xFF;
-    MicBlockB0[12] = ( fcnt >> 16 ) & 0xFF;
-    MicBlockB0[13] = ( fcnt >> 24 ) & 0xFF;
+    memcpy1( b0, MicBlockB0, LORAMAC_MIC_BLOCK_B0_SIZE );
+    b0[5] = dir;
 
-    MicBlockB0[15] = size & 0xFF;
+    b0[6] = ( devaddr ) & 0xFF;
+    b0[7] = ( devaddr >> 8 ) & 0xFF;
+    b0[8] = ( devaddr >> 16 ) & 0xFF;
+    b0[9] = ( devaddr >> 24 ) & 0xFF;
 
-    AES_CMAC_Init( AesCmacCtx );
+    b0[10] = ( fcnt ) & 0xFF;
+    b0[11] = ( fcnt >> 8 ) & 0xFF;
+    b0[12] = ( fcnt >> 16 ) & 0xFF;
+    b0[13] = ( fcnt >> 24 ) & 0xFF;
 
-    AES_CMAC_SetKey( AesCmacCtx, key );
+    b0[15] = size & 0xFF;
 
-    AES_CMAC_Update( AesCmacCtx, MicBlockB0, LORAMAC_MIC_BLOCK_B0_SIZE );
-    
-    AES_CMAC_Update( AesCmacCtx, buffer, size & 0xFF );
-    
-    AES_CMAC_Final( Mic, AesCmacCtx );
+    cmac_start( &cmac, ctx );
+    AES_CMAC_Update( &cmac, b0, LORAMAC_MIC_BLOCK_B0_SIZE );
+    AES_CMAC_Update( &cmac, buffer, size & 0xFF );
+    mic = cmac_finish( &cmac, ctx );
 
 #ifdef DEBUG
-    DBGPRINT("KEY:");
-    for(uint8_t i=0; i < 16; i++)
-        DBGPRINT("%02x",key[i]);
-    DBGPRINT("\n");
-
     DBGPRINT("B0:");
     for(uint8_t i=0; i < 16; i++)
-        DBGPRINT("%02x",MicBlockB0[i]);
+        DBGPRINT("%02x",b0[i]);
     DBGPRINT("\n");
 
     DBGPRINT("buffer(sz=%d):", size);
@@ -253,13 +200,134 @@ uint32_t compute_mic(const uint8_t *buffer, uint16_t size, const uint8_t *key, u
     DBGPRINT("\n");
 #endif
 
-   uint32_t mic = ( uint32_t )( ( uint32_t )Mic[3] << 24 | ( uint32_t )Mic[2] << 16 | ( uint32_t )Mic[1] << 8 | ( uint32_t )Mic[0] );
    DBGPRINT("MIC=%04x",mic);
    return mic;
 }
 
-uint32_t compute_uplink_mic(const uint8_t *buffer, uint16_t size, const uint8_t *key, uint32_t devaddr,  uint32_t fcnt)
+uint32_t compute_uplink_mic_ctx(const uint8_t *buffer, uint16_t size, const key_ctx_t *ctx, uint32_t devaddr,  uint32_t fcnt)
 {
     #define UP_DIR 0
-    return compute_mic(buffer, size, key, devaddr, UP_DIR,  fcnt);
+    return compute_mic_ctx(buffer, size, ctx, devaddr, UP_DIR,  fcnt);
+}
+
+/*
+ * Raw key variants, the key is expanded on every call
+ */
+
+uint32_t aes_cmac( const uint8_t *buffer, uint16_t size, const uint8_t *key)
+{
+    key_ctx_t ctx;
+    key_ctx_init( &ctx, key );
+    return aes_cmac_ctx( buffer, size, &ctx );
+}
+
+void aes128_encrypt( const uint8_t *buffer, uint16_t size, const uint8_t *key, uint8_t *encBuffer )
+{
+    key_ctx_t ctx;
+    key_ctx_init( &ctx, key );
+    aes128_encrypt_ctx( buffer, size, &ctx, encBuffer );
+}
+
+void aes128_decrypt( const uint8_t *buffer, uint16_t size, const uint8_t *key, uint8_t *decBuffer )
+{
+    key_ctx_t ctx;
+    key_ctx_init( &ctx, key );
+    aes128_decrypt_ctx( buffer, size, &ctx, decBuffer );
+}
+
+void compute_app_skey(const uint8_t *key,  uint32_t appnonce, uint32_t netid, uint16_t devnonce, uint8_t *appSKey)
+{
+    key_ctx_t ctx;
+    key_ctx_init( &ctx, key );
+    compute_app_skey_ctx( &ctx, appnonce, netid, devnonce, appSKey );
+}
+
+void compute_nwk_skey(const uint8_t *key,  uint32_t appnonce, uint32_t netid, uint16_t devnonce, uint8_t *nwkSKey)
+{
+    key_ctx_t ctx;
+    key_ctx_init( &ctx, key );
+    compute_nwk_skey_ctx( &ctx, appnonce, netid, devnonce, nwkSKey );
+}
+
+uint32_t compute_uplink_mic(const uint8_t *buffer, uint16_t size, const uint8_t *key, uint32_t devaddr,  uint32_t fcnt)
+{
+    key_ctx_t ctx;
+    key_ctx_init( &ctx, key );
+    return compute_uplink_mic_ctx( buffer, size, &ctx, devaddr, fcnt );
+}
+
+/*
+ * Batch variants: one call processes count items laid out contiguously.
+ * Multi-byte parameters are packed little-endian, as on the air, and read
+ * byte by byte so that records need no alignment.
+ */
+
+static uint16_t get_le16( const uint8_t *p )
+{
+    return ( uint16_t )( p[0] | ( p[1] << 8 ) );
+}
+
+static uint32_t get_le32( const uint8_t *p )
+{
+    return ( uint32_t )p[0] | ( ( uint32_t )p[1] << 8 ) | ( ( uint32_t )p[2] << 16 ) | ( ( uint32_t )p[3] << 24 );
+}
+
+static void put_le32( uint8_t *p, uint32_t v )
+{
+    p[0] = v & 0xFF;
+    p[1] = ( v >> 8 ) & 0xFF;
+    p[2] = ( v >> 16 ) & 0xFF;
+    p[3] = ( v >> 24 ) & 0xFF;
+}
+
+void compute_nwk_skey_batch( const uint8_t *keys, const uint8_t *nonces, uint32_t count, uint8_t *nwkSKeys )
+{
+    key_ctx_t ctx;
+    uint32_t i;
+
+    for( i = 0; i < count; i++ )
+    {
+        const uint8_t *nonce = nonces + i * SESSION_NONCE_SIZE;
+        uint32_t appnonce = ( uint32_t )nonce[0] | ( ( uint32_t )nonce[1] << 8 ) | ( ( uint32_t )nonce[2] << 16 );
+        uint32_t netid = ( uint32_t )nonce[3] | ( ( uint32_t )nonce[4] << 8 ) | ( ( uint32_t )nonce[5] << 16 );
+
+        key_ctx_init( &ctx, keys + i * 16 );
+        compute_nwk_skey_ctx( &ctx, appnonce, netid, get_le16( nonce + 6 ), nwkSKeys + i * 16 );
+    }
+}
+
+void compute_uplink_mic_batch( const uint8_t *buffers, const uint8_t *params, const uint8_t *keys, uint32_t count, uint8_t *mics )
+{
+    key_ctx_t ctx;
+    uint32_t i;
+
+    for( i = 0; i < count; i++ )
+    {
+        const uint8_t *param = params + i * UPLINK_MIC_PARAM_SIZE;
+        uint16_t size = get_le16( param );
+
+        key_ctx_init( &ctx, keys + i * 16 );
+        put_le32( mics + i * 4, compute_uplink_mic_ctx( buffers, size, &ctx, get_le32( param + 2 ), get_le32( param + 6 ) ) );
+        buffers += size;
+    }
+}
+
+void encode_join_accept_batch( const uint8_t *keys, const uint8_t *macpayloads, uint32_t count, uint8_t *frames )
+{
+    key_ctx_t ctx;
+    uint8_t msg[1 + JOIN_ACCEPT_MACPAYLOAD_SIZE + 4];
+    uint32_t i;
+
+    msg[0] = JOIN_ACCEPT_MHDR;
+    for( i = 0; i < count; i++ )
+    {
+        uint8_t *frame = frames + i * JOIN_ACCEPT_FRAME_SIZE;
+
+        key_ctx_init( &ctx, keys + i * 16 );
+        memcpy1( msg + 1, macpayloads + i * JOIN_ACCEPT_MACPAYLOAD_SIZE, JOIN_ACCEPT_MACPAYLOAD_SIZE );
+        put_le32( msg + 1 + JOIN_ACCEPT_MACPAYLOAD_SIZE, aes_cmac_ctx( msg, 1 + JOIN_ACCEPT_MACPAYLOAD_SIZE, &ctx ) );
+
+        frame[0] = JOIN_ACCEPT_MHDR;
+        aes128_decrypt_ctx( msg + 1, JOIN_ACCEPT_MACPAYLOAD_SIZE + 4, &ctx, frame + 1 );
+    }
 }
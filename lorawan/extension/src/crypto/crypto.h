@@ -1,13 +1,50 @@
 #ifndef __LORAMAC_CRYPTO_H__
 #define __LORAMAC_CRYPTO_H__
 
+#include <stdint.h>
+#include "aes.h"
+
+/*!
+ * Key context: expanded AES key schedule and CMAC subkeys of a 128 bit key.
+ * Initialized once by key_ctx_init and passed to the *_ctx variants.
+ */
+typedef struct {
+    aes_context aes;
+    uint8_t K1[16];
+    uint8_t K2[16];
+} key_ctx_t;
+
+uint32_t key_ctx_size( void );
+void key_ctx_init( key_ctx_t *ctx, const uint8_t *key );
 
 uint32_t aes_cmac( const uint8_t *buffer, uint16_t size, const uint8_t *key);
 void aes128_encrypt( const uint8_t *buffer, uint16_t size, const uint8_t *key, uint8_t *encBuffer );
 void aes128_decrypt( const uint8_t *buffer, uint16_t size, const uint8_t *key, uint8_t *decBuffer );
-void compute_app_skey(const uint8_t *key,  uint32_t appnonce, uint32_t netid, uint16_t devnonce, uint8_t *nwkSKey);
+void compute_app_skey(const uint8_t *key,  uint32_t appnonce, uint32_t netid, uint16_t devnonce, uint8_t *appSKey);
 void compute_nwk_skey(const uint8_t *key,  uint32_t appnonce, uint32_t netid, uint16_t devnonce, uint8_t *nwkSKey);
 uint32_t compute_uplink_mic(const uint8_t *buffer, uint16_t size, const uint8_t *key, uint32_t devaddr,  uint32_t fcnt);
 
+uint32_t aes_cmac_ctx( const uint8_t *buffer, uint16_t size, const key_ctx_t *ctx );
+void aes128_encrypt_ctx( const uint8_t *buffer, uint16_t size, const key_ctx_t *ctx, uint8_t *encBuffer );
+void aes128_decrypt_ctx( const uint8_t *buffer, uint16_t size, const key_ctx_t *ctx, uint8_t *decBuffer );
+void compute_app_skey_ctx(const key_ctx_t *ctx,  uint32_t appnonce, uint32_t netid, uint16_t devnonce, uint8_t *appSKey);
+void compute_nwk_skey_ctx(const key_ctx_t *ctx,  uint32_t appnonce, uint32_t netid, uint16_t devnonce, uint8_t *nwkSKey);
+uint32_t compute_uplink_mic_ctx(const uint8_t *buffer, uint16_t size, const key_ctx_t *ctx, uint32_t devaddr,  uint32_t fcnt);
+
+/*!
+ * Batch record sizes
+ *   session nonce:   AppNonce(3) NetID(3) DevNonce(2)
+ *   uplink MIC param: size(2) DevAddr(4) FCnt(4)
+ *   join-accept MACPayload: AppNonce(3) NetID(3) DevAddr(4) DLSettings(1) RxDelay(1)
+ */
+#define SESSION_NONCE_SIZE              8
+#define UPLINK_MIC_PARAM_SIZE           10
+#define JOIN_ACCEPT_MACPAYLOAD_SIZE     12
+#define JOIN_ACCEPT_FRAME_SIZE          ( 1 + JOIN_ACCEPT_MACPAYLOAD_SIZE + 4 )
+#define JOIN_ACCEPT_MHDR                0x20
+
+void compute_nwk_skey_batch( const uint8_t *keys, const uint8_t *nonces, uint32_t count, uint8_t *nwkSKeys );
+void compute_uplink_mic_batch( const uint8_t *buffers, const uint8_t *params, const uint8_t *keys, uint32_t count, uint8_t *mics );
+void encode_join_accept_batch( const uint8_t *keys, const uint8_t *macpayloads, uint32_t count, uint8_t *frames );
 
 #endif // __LORAMAC_CRYPTO_H__
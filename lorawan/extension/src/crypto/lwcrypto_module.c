@@ -0,0 +1,479 @@
+/*
+ * _lwcrypto: CPython extension module exposing the LoRaWAN crypto functions.
+ *
+ * Buffers are taken through the buffer protocol (str, bytearray, array,
+ * memoryview) without copies and the GIL is released around the AES work.
+ * The Python API mirrors lorawan/crypto.py.
+ */
+#include <Python.h>
+#include <stdint.h>
+#include "aes.h"
+#include "crypto.h"
+
+#if PY_MAJOR_VERSION >= 3
+#define BUF_FMT "y*"
+#define PyInt_FromSize_t PyLong_FromSize_t
+#define BYTES_FromStringAndSize PyBytes_FromStringAndSize
+#define BYTES_AS_STRING PyBytes_AS_STRING
+#else
+#define BUF_FMT "s*"
+#define BYTES_FromStringAndSize PyString_FromStringAndSize
+#define BYTES_AS_STRING PyString_AS_STRING
+#endif
+
+#define KEY_SIZE 16
+
+/*
+ * KeyContext type: opaque expanded key
+ */
+typedef struct {
+    PyObject_HEAD
+    key_ctx_t ctx;
+} KeyContextObject;
+
+static int KeyContext_init( KeyContextObject *self, PyObject *args, PyObject *kwds )
+{
+    Py_buffer key;
+
+    if( !PyArg_ParseTuple( args, BUF_FMT ":KeyContext", &key ) )
+        return -1;
+    if( key.len != KEY_SIZE )
+    {
+        PyBuffer_Release( &key );
+        PyErr_SetString( PyExc_ValueError, "key must be 16 bytes" );
+        return -1;
+    }
+    key_ctx_init( &self->ctx, key.buf );
+    PyBuffer_Release( &key );
+    return 0;
+}
+
+static PyTypeObject KeyContextType = {
+    PyVarObject_HEAD_INIT( NULL, 0 )
+    "_lwcrypto.KeyContext",                     /* tp_name */
+    sizeof( KeyContextObject ),                 /* tp_basicsize */
+};
+
+static int check_key( Py_buffer *key )
+{
+    if( key->len != KEY_SIZE )
+    {
+        PyErr_SetString( PyExc_ValueError, "key must be 16 bytes" );
+        return 0;
+    }
+    return 1;
+}
+
+static int check_size( Py_buffer *buffer )
+{
+    if( buffer->len > 0xFFFF )
+    {
+        PyErr_SetString( PyExc_ValueError, "buffer too large" );
+        return 0;
+    }
+    return 1;
+}
+
+/*
+ * Raw key functions
+ */
+
+static PyObject *py_aes_cmac( PyObject *self, PyObject *args )
+{
+    Py_buffer buffer, key;
+    uint32_t mic = 0;
+    int ok;
+
+    if( !PyArg_ParseTuple( args, BUF_FMT BUF_FMT ":aes_cmac", &buffer, &key ) )
+        return NULL;
+    ok = check_size( &buffer ) && check_key( &key );
+    if( ok )
+    {
+        Py_BEGIN_ALLOW_THREADS
+        mic = aes_cmac( buffer.buf, ( uint16_t )buffer.len, key.buf );
+        Py_END_ALLOW_THREADS
+    }
+    PyBuffer_Release( &buffer );
+    PyBuffer_Release( &key );
+    return ok ? PyInt_FromSize_t( mic ) : NULL;
+}
+
+typedef void ( *cipher_fn )( const uint8_t *, uint16_t, const uint8_t *, uint8_t * );
+
+static PyObject *cipher( PyObject *args, const char *fmt, cipher_fn fn )
+{
+    Py_buffer buffer, key;
+    PyObject *out = NULL;
+
+    if( !PyArg_ParseTuple( args, fmt, &buffer, &key ) )
+        return NULL;
+    if( check_size( &buffer ) && check_key( &key ) )
+    {
+        out = BYTES_FromStringAndSize( NULL, buffer.len );
+        if( out != NULL )
+        {
+            uint8_t *dst = ( uint8_t * )BYTES_AS_STRING( out );
+            Py_BEGIN_ALLOW_THREADS
+            fn( buffer.buf, ( uint16_t )buffer.len, key.buf, dst );
+            Py_END_ALLOW_THREADS
+        }
+    }
+    PyBuffer_Release( &buffer );
+    PyBuffer_Release( &key );
+    return out;
+}
+
+static PyObject *py_aes128_encrypt( PyObject *self, PyObject *args )
+{
+    return cipher( args, BUF_FMT BUF_FMT ":aes128_encrypt", aes128_encrypt );
+}
+
+static PyObject *py_aes128_decrypt( PyObject *self, PyObject *args )
+{
+    return cipher( args, BUF_FMT BUF_FMT ":aes128_decrypt", aes128_decrypt );
+}
+
+static PyObject *py_compute_uplink_mic( PyObject *self, PyObject *args )
+{
+    Py_buffer buffer, key;
+    unsigned int devaddr, fcnt;
+    uint32_t mic = 0;
+    int ok;
+
+    if( !PyArg_ParseTuple( args, BUF_FMT BUF_FMT "II:compute_uplink_mic", &buffer, &key, &devaddr, &fcnt ) )
+        return NULL;
+    ok = check_size( &buffer ) && check_key( &key );
+    if( ok )
+    {
+        Py_BEGIN_ALLOW_THREADS
+        mic = compute_uplink_mic( buffer.buf, ( uint16_t )buffer.len, key.buf, devaddr, fcnt );
+        Py_END_ALLOW_THREADS
+    }
+    PyBuffer_Release( &buffer );
+    PyBuffer_Release( &key );
+    return ok ? PyInt_FromSize_t( mic ) : NULL;
+}
+
+typedef void ( *skey_fn )( const uint8_t *, uint32_t, uint32_t, uint16_t, uint8_t * );
+
+static PyObject *session_key( PyObject *args, const char *fmt, skey_fn fn )
+{
+    Py_buffer key;
+    unsigned int appnonce, netid;
+    unsigned short devnonce;
+    PyObject *out = NULL;
+
+    if( !PyArg_ParseTuple( args, fmt, &appnonce, &netid, &devnonce, &key ) )
+        return NULL;
+    if( check_key( &key ) )
+    {
+        out = BYTES_FromStringAndSize( NULL, KEY_SIZE );
+        if( out != NULL )
+        {
+            uint8_t *dst = ( uint8_t * )BYTES_AS_STRING( out );
+            Py_BEGIN_ALLOW_THREADS
+            fn( key.buf, appnonce, netid, devnonce, dst );
+            Py_END_ALLOW_THREADS
+        }
+    }
+    PyBuffer_Release( &key );
+    return out;
+}
+
+static PyObject *py_compute_app_skey( PyObject *self, PyObject *args )
+{
+    return session_key( args, "IIH" BUF_FMT ":compute_app_skey", compute_app_skey );
+}
+
+static PyObject *py_compute_nwk_skey( PyObject *self, PyObject *args )
+{
+    return session_key( args, "IIH" BUF_FMT ":compute_nwk_skey", compute_nwk_skey );
+}
+
+/*
+ * Key context functions
+ */
+
+static PyObject *py_aes_cmac_ctx( PyObject *self, PyObject *args )
+{
+    Py_buffer buffer;
+    KeyContextObject *ctx;
+    uint32_t mic = 0;
+    int ok;
+
+    if( !PyArg_ParseTuple( args, BUF_FMT "O!:aes_cmac_ctx", &buffer, &KeyContextType, &ctx ) )
+        return NULL;
+    ok = check_size( &buffer );
+    if( ok )
+    {
+        Py_BEGIN_ALLOW_THREADS
+        mic = aes_cmac_ctx( buffer.buf, ( uint16_t )buffer.len, &ctx->ctx );
+        Py_END_ALLOW_THREADS
+    }
+    PyBuffer_Release( &buffer );
+    return ok ? PyInt_FromSize_t( mic ) : NULL;
+}
+
+typedef void ( *cipher_ctx_fn )( const uint8_t *, uint16_t, const key_ctx_t *, uint8_t * );
+
+static PyObject *cipher_ctx( PyObject *args, const char *fmt, cipher_ctx_fn fn )
+{
+    Py_buffer buffer;
+    KeyContextObject *ctx;
+    PyObject *out = NULL;
+
+    if( !PyArg_ParseTuple( args, fmt, &buffer, &KeyContextType, &ctx ) )
+        return NULL;
+    if( check_size( &buffer ) )
+    {
+        out = BYTES_FromStringAndSize( NULL, buffer.len );
+        if( out != NULL )
+        {
+            uint8_t *dst = ( uint8_t * )BYTES_AS_STRING( out );
+            Py_BEGIN_ALLOW_THREADS
+            fn( buffer.buf, ( uint16_t )buffer.len, &ctx->ctx, dst );
+            Py_END_ALLOW_THREADS
+        }
+    }
+    PyBuffer_Release( &buffer );
+    return out;
+}
+
+static PyObject *py_aes128_encrypt_ctx( PyObject *self, PyObject *args )
+{
+    return cipher_ctx( args, BUF_FMT "O!:aes128_encrypt_ctx", aes128_encrypt_ctx );
+}
+
+static PyObject *py_aes128_decrypt_ctx( PyObject *self, PyObject *args )
+{
+    return cipher_ctx( args, BUF_FMT "O!:aes128_decrypt_ctx", aes128_decrypt_ctx );
+}
+
+static PyObject *py_compute_uplink_mic_ctx( PyObject *self, PyObject *args )
+{
+    Py_buffer buffer;
+    KeyContextObject *ctx;
+    unsigned int devaddr, fcnt;
+    uint32_t mic = 0;
+    int ok;
+
+    if( !PyArg_ParseTuple( args, BUF_FMT "O!II:compute_uplink_mic_ctx", &buffer, &KeyContextType, &ctx, &devaddr, &fcnt ) )
+        return NULL;
+    ok = check_size( &buffer );
+    if( ok )
+    {
+        Py_BEGIN_ALLOW_THREADS
+        mic = compute_uplink_mic_ctx( buffer.buf, ( uint16_t )buffer.len, &ctx->ctx, devaddr, fcnt );
+        Py_END_ALLOW_THREADS
+    }
+    PyBuffer_Release( &buffer );
+    return ok ? PyInt_FromSize_t( mic ) : NULL;
+}
+
+typedef void ( *skey_ctx_fn )( const key_ctx_t *, uint32_t, uint32_t, uint16_t, uint8_t * );
+
+static PyObject *session_key_ctx( PyObject *args, const char *fmt, skey_ctx_fn fn )
+{
+    KeyContextObject *ctx;
+    unsigned int appnonce, netid;
+    unsigned short devnonce;
+    PyObject *out;
+
+    if( !PyArg_ParseTuple( args, fmt, &appnonce, &netid, &devnonce, &KeyContextType, &ctx ) )
+        return NULL;
+    out = BYTES_FromStringAndSize( NULL, KEY_SIZE );
+    if( out != NULL )
+    {
+        uint8_t *dst = ( uint8_t * )BYTES_AS_STRING( out );
+        Py_BEGIN_ALLOW_THREADS
+        fn( &ctx->ctx, appnonce, netid, devnonce, dst );
+        Py_END_ALLOW_THREADS
+    }
+    return out;
+}
+
+static PyObject *py_compute_app_skey_ctx( PyObject *self, PyObject *args )
+{
+    return session_key_ctx( args, "IIHO!:compute_app_skey_ctx", compute_app_skey_ctx );
+}
+
+static PyObject *py_compute_nwk_skey_ctx( PyObject *self, PyObject *args )
+{
+    return session_key_ctx( args, "IIHO!:compute_nwk_skey_ctx", compute_nwk_skey_ctx );
+}
+
+/*
+ * Batch functions
+ */
+
+static int batch_count( Py_buffer *buf, Py_ssize_t record_size, const char *name, Py_ssize_t *count )
+{
+    if( buf->len % record_size )
+    {
+        PyErr_Format( PyExc_ValueError, "%s size %zd is not a multiple of %zd", name, buf->len, record_size );
+        return 0;
+    }
+    if( *count >= 0 && buf->len / record_size != *count )
+    {
+        PyErr_Format( PyExc_ValueError, "keys and %s count mismatch", name );
+        return 0;
+    }
+    *count = buf->len / record_size;
+    return 1;
+}
+
+static PyObject *py_compute_nwk_skey_batch( PyObject *self, PyObject *args )
+{
+    Py_buffer keys, nonces;
+    Py_ssize_t count = -1;
+    PyObject *out = NULL;
+
+    if( !PyArg_ParseTuple( args, BUF_FMT BUF_FMT ":compute_nwk_skey_batch", &keys, &nonces ) )
+        return NULL;
+    if( batch_count( &keys, KEY_SIZE, "keys", &count ) && batch_count( &nonces, SESSION_NONCE_SIZE, "nonces", &count ) )
+    {
+        out = BYTES_FromStringAndSize( NULL, count * KEY_SIZE );
+        if( out != NULL )
+        {
+            uint8_t *dst = ( uint8_t * )BYTES_AS_STRING( out );
+            Py_BEGIN_ALLOW_THREADS
+            compute_nwk_skey_batch( keys.buf, nonces.buf, ( uint32_t )count, dst );
+            Py_END_ALLOW_THREADS
+        }
+    }
+    PyBuffer_Release( &keys );
+    PyBuffer_Release( &nonces );
+    return out;
+}
+
+static PyObject *py_compute_uplink_mic_batch( PyObject *self, PyObject *args )
+{
+    Py_buffer buffers, params, keys;
+    Py_ssize_t count = -1;
+    Py_ssize_t total = 0;
+    Py_ssize_t i;
+    PyObject *out = NULL;
+
+    if( !PyArg_ParseTuple( args, BUF_FMT BUF_FMT BUF_FMT ":compute_uplink_mic_batch", &buffers, &params, &keys ) )
+        return NULL;
+    if( batch_count( &keys, KEY_SIZE, "keys", &count ) && batch_count( &params, UPLINK_MIC_PARAM_SIZE, "params", &count ) )
+    {
+        const uint8_t *param = params.buf;
+        for( i = 0; i < count; i++ )
+            total += param[i * UPLINK_MIC_PARAM_SIZE] | ( param[i * UPLINK_MIC_PARAM_SIZE + 1] << 8 );
+        if( total > buffers.len )
+        {
+            PyErr_SetString( PyExc_ValueError, "buffers shorter than the sum of sizes" );
+        }
+        else
+        {
+            out = BYTES_FromStringAndSize( NULL, count * 4 );
+            if( out != NULL )
+            {
+                uint8_t *dst = ( uint8_t * )BYTES_AS_STRING( out );
+                Py_BEGIN_ALLOW_THREADS
+                compute_uplink_mic_batch( buffers.buf, params.buf, keys.buf, ( uint32_t )count, dst );
+                Py_END_ALLOW_THREADS
+            }
+        }
+    }
+    PyBuffer_Release( &buffers );
+    PyBuffer_Release( &params );
+    PyBuffer_Release( &keys );
+    return out;
+}
+
+static PyObject *py_encode_join_accept_batch( PyObject *self, PyObject *args )
+{
+    Py_buffer keys, macpayloads;
+    Py_ssize_t count = -1;
+    PyObject *out = NULL;
+
+    if( !PyArg_ParseTuple( args, BUF_FMT BUF_FMT ":encode_join_accept_batch", &keys, &macpayloads ) )
+        return NULL;
+    if( batch_count( &keys, KEY_SIZE, "keys", &count ) && batch_count( &macpayloads, JOIN_ACCEPT_MACPAYLOAD_SIZE, "macpayloads", &count ) )
+    {
+        out = BYTES_FromStringAndSize( NULL, count * JOIN_ACCEPT_FRAME_SIZE );
+        if( out != NULL )
+        {
+            uint8_t *dst = ( uint8_t * )BYTES_AS_STRING( out );
+            Py_BEGIN_ALLOW_THREADS
+            encode_join_accept_batch( keys.buf, macpayloads.buf, ( uint32_t )count, dst );
+            Py_END_ALLOW_THREADS
+        }
+    }
+    PyBuffer_Release( &keys );
+    PyBuffer_Release( &macpayloads );
+    return out;
+}
+
+static PyMethodDef lwcrypto_methods[] = {
+    { "aes_cmac", py_aes_cmac, METH_VARARGS, "aes_cmac(buffer, key) -> 32 bit MIC" },
+    { "aes128_encrypt", py_aes128_encrypt, METH_VARARGS, "aes128_encrypt(buffer, key) -> bytes" },
+    { "aes128_decrypt", py_aes128_decrypt, METH_VARARGS, "aes128_decrypt(buffer, key) -> bytes" },
+    { "compute_uplink_mic", py_compute_uplink_mic, METH_VARARGS, "compute_uplink_mic(buffer, key, devaddr, fcnt) -> 32 bit MIC" },
+    { "compute_app_skey", py_compute_app_skey, METH_VARARGS, "compute_app_skey(appnonce, netid, devnonce, key) -> AppSKey" },
+    { "compute_nwk_skey", py_compute_nwk_skey, METH_VARARGS, "compute_nwk_skey(appnonce, netid, devnonce, key) -> NwkSKey" },
+    { "aes_cmac_ctx", py_aes_cmac_ctx, METH_VARARGS, "aes_cmac_ctx(buffer, ctx) -> 32 bit MIC" },
+    { "aes128_encrypt_ctx", py_aes128_encrypt_ctx, METH_VARARGS, "aes128_encrypt_ctx(buffer, ctx) -> bytes" },
+    { "aes128_decrypt_ctx", py_aes128_decrypt_ctx, METH_VARARGS, "aes128_decrypt_ctx(buffer, ctx) -> bytes" },
+    { "compute_uplink_mic_ctx", py_compute_uplink_mic_ctx, METH_VARARGS, "compute_uplink_mic_ctx(buffer, ctx, devaddr, fcnt) -> 32 bit MIC" },
+    { "compute_app_skey_ctx", py_compute_app_skey_ctx, METH_VARARGS, "compute_app_skey_ctx(appnonce, netid, devnonce, ctx) -> AppSKey" },
+    { "compute_nwk_skey_ctx", py_compute_nwk_skey_ctx, METH_VARARGS, "compute_nwk_skey_ctx(appnonce, netid, devnonce, ctx) -> NwkSKey" },
+    { "compute_nwk_skey_batch", py_compute_nwk_skey_batch, METH_VARARGS, "compute_nwk_skey_batch(keys, nonces) -> N x 16 byte NwkSKeys" },
+    { "compute_uplink_mic_batch", py_compute_uplink_mic_batch, METH_VARARGS, "compute_uplink_mic_batch(buffers, params, keys) -> N x 4 byte MICs" },
+    { "encode_join_accept_batch", py_encode_join_accept_batch, METH_VARARGS, "encode_join_accept_batch(keys, macpayloads) -> N x 17 byte frames" },
+    { NULL, NULL, 0, NULL }
+};
+
+static void lwcrypto_add_constants( PyObject *m )
+{
+    PyModule_AddIntConstant( m, "SESSION_NONCE_SIZE", SESSION_NONCE_SIZE );
+    PyModule_AddIntConstant( m, "UPLINK_MIC_PARAM_SIZE", UPLINK_MIC_PARAM_SIZE );
+    PyModule_AddIntConstant( m, "JOIN_ACCEPT_MACPAYLOAD_SIZE", JOIN_ACCEPT_MACPAYLOAD_SIZE );
+    PyModule_AddIntConstant( m, "JOIN_ACCEPT_FRAME_SIZE", JOIN_ACCEPT_FRAME_SIZE );
+}
+
+static int lwcrypto_prepare_types( void )
+{
+    KeyContextType.tp_flags = Py_TPFLAGS_DEFAULT;
+    KeyContextType.tp_doc = "KeyContext(key): expanded AES key schedule and CMAC subkeys";
+    KeyContextType.tp_new = PyType_GenericNew;
+    KeyContextType.tp_init = ( initproc )KeyContext_init;
+    return PyType_Ready( &KeyContextType );
+}
+
+#if PY_MAJOR_VERSION >= 3
+static struct PyModuleDef lwcrypto_module = {
+    PyModuleDef_HEAD_INIT, "_lwcrypto", NULL, -1, lwcrypto_methods
+};
+
+PyMODINIT_FUNC PyInit__lwcrypto( void )
+{
+    PyObject *m;
+
+    if( lwcrypto_prepare_types( ) < 0 )
+        return NULL;
+    m = PyModule_Create( &lwcrypto_module );
+    if( m == NULL )
+        return NULL;
+    Py_INCREF( &KeyContextType );
+    PyModule_AddObject( m, "KeyContext", ( PyObject * )&KeyContextType );
+    lwcrypto_add_constants( m );
+    return m;
+}
+#else
+PyMODINIT_FUNC init_lwcrypto( void )
+{
+    PyObject *m;
+
+    if( lwcrypto_prepare_types( ) < 0 )
+        return;
+    m = Py_InitModule( "_lwcrypto", lwcrypto_methods );
+    if( m == NULL )
+        return;
+    Py_INCREF( &KeyContextType );
+    PyModule_AddObject( m, "KeyContext", ( PyObject * )&KeyContextType );
+    lwcrypto_add_constants( m );
+}
+#endif
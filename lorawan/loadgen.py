@@ -0,0 +1,318 @@
+""" Load generator: simulated Semtech UDP packet forwarders on localhost.
+
+    Each simulated gateway owns a UDP socket, sends PULL_DATA and PUSH_DATA
+    join-requests for the devices of conf/*.csv and acknowledges PULL_RESP
+    with TX_ACK. Join-accepts are decrypted, the NwkSKey is derived and an
+    uplink is sent back, so that the harness completes the OTAA test.
+    Reports the join rate and the PUSH_DATA to PULL_RESP latency.
+
+    From the repository root, with the harness running:
+        python -m lorawan.loadgen --gateways 10 --devices 5000 --duration 30
+"""
+import argparse
+import binascii
+import collections
+import glob
+import json
+import os
+import select
+import socket
+import struct
+import time
+import logging
+
+import crypto
+import devicestore
+import downlink
+import packet
+import packet_forwarder_server as pfs
+import region
+
+logger = logging.getLogger('harness.loadgen')
+
+SERVER_PORT_DEFAULT = 1780
+JOIN_TIMEOUT_DEFAULT = 2.0
+PULL_DATA_INTERVAL = 10.0
+REGION_DEFAULT = 'US915'
+# channels of a simulated gateway
+GATEWAY_CHANNELS = 8
+
+def uplink_channels(region_name, count=GATEWAY_CHANNELS):
+    """ (freq MHz, datr) of the first count channels of the first uplink block
+        of a region, at the lowest DR of the block """
+    params = region.REGIONS[region_name]
+    first_hz, step_hz, nb_channels, drs = params['uplink_channels'][0]
+    datr = params['datarates'][drs[0]]
+    return [(region.hz2mhz(first_hz + i * step_hz), datr) for i in range(0, min(count, nb_channels))]
+
+def join_accept_spacing_us(region_name, channels):
+    """ rxpk tmst spacing of a gateway such that the join-accepts of its join-requests
+        do not overlap on its radio, whichever of RX1 and RX2 they are sent on: rxpk
+        n * spacing apart are at least a join-accept airtime apart and never within
+        one of the RX2 - RX1 delay. The simulated gateway clock runs ahead of time
+        when join-requests come faster, the harness only sees tmst differences """
+    lw_region = region.get(region_name)
+    rxconfs = [lw_region.lookup(freq, datr).rx1[0] for freq, datr in channels] + [lw_region.get_rx2_conf()]
+    airtime = max(downlink.time_on_air_us(lw_region.dr2sf(rxconf.dr), crypto.JOIN_ACCEPT_FRAME_SIZE, lw_region.coderate)
+                  for rxconf in rxconfs) + downlink.DOWNLINK_GUARD_US
+    delta = (lw_region.JOIN_RX2_DELAY - lw_region.JOIN_RX1_DELAY) * 1000000
+    # k rxpk before the RX2 - RX1 delay, k + 1 after it
+    for k in range(delta // airtime, 0, -1):
+        spacing = -(-(delta + airtime) // (k + 1))
+        if spacing >= airtime and k * spacing <= delta - airtime:
+            return spacing
+    return delta + airtime
+
+class SimDevice(object):
+    __slots__ = ('joineui', 'deveui', 'appkey', 'devnonce', 'gateway', 'sent_time')
+
+    def __init__(self, joineui, deveui, appkey, gateway):
+        self.joineui = joineui
+        self.deveui = deveui
+        self.appkey = appkey
+        self.devnonce = 0
+        self.gateway = gateway
+        self.sent_time = None
+
+class SimGateway(object):
+    """ Packet forwarder of simulated devices, join-requests are correlated with
+        the PULL_RESP by tmst: each rxpk has a distinct tmst and the join-accept
+        is sent at tmst + JOIN_RX1_DELAY or tmst + JOIN_RX2_DELAY.
+        spacing_us: minimum tmst difference of two rxpk, see join_accept_spacing_us """
+    def __init__(self, index, server_addr, channels=None, spacing_us=1):
+        self.channels = channels if channels is not None else uplink_channels(REGION_DEFAULT)
+        self.spacing_us = spacing_us
+        self.mac = struct.pack('>Q', 0xAA555A0000000000 + index)
+        self.server_addr = server_addr
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(('localhost', 0))
+        self.socket.setblocking(False)
+        self.token = 0
+        # microsecond time of the last rxpk, not wrapped
+        self.time_us = 0
+        self.pending = {}
+        self.pull_data_time = 0
+
+    def next_token(self):
+        self.token = (self.token + 1) & 0xFFFF
+        return self.token
+
+    def next_tmst(self):
+        """ Microsecond clock, at least spacing_us after the previous rxpk: the harness
+            schedules downlinks on the gateway radio by tmst """
+        now = max(int(time.time() * 1000000), self.time_us + self.spacing_us)
+        self.time_us = now
+        return now & downlink.TMST_MASK
+
+    def send(self, cmd, body=''):
+        self.socket.sendto(struct.pack('<BHB', 2, self.next_token(), cmd) + self.mac + body, self.server_addr)
+
+    def pull_data(self, now):
+        self.pull_data_time = now
+        self.send(pfs.PULL_DATA)
+
+    def push_data(self, frames):
+        rxpks = []
+        for frame, tmst in frames:
+            chan = tmst % len(self.channels)
+            freq, datr = self.channels[chan]
+            rxpks.append({'tmst': tmst, 'chan': chan, 'rfch': 0, 'freq': freq,
+                          'stat': 1, 'modu': 'LORA', 'datr': datr, 'codr': '4/5', 'rssi': -60, 'lsnr': 9.0,
+                          'size': len(frame), 'data': binascii.b2a_base64(frame).strip()})
+        self.send(pfs.PUSH_DATA, json.dumps({'rxpk': rxpks}))
+
+    def tx_ack(self, token):
+        self.socket.sendto(struct.pack('<BHB', 2, token, pfs.TX_ACK) + self.mac +
+                           json.dumps({'txpk_ack': {'error': 'NONE'}}), self.server_addr)
+
+    def join_device(self, txpk):
+        """ Pending device of a join-accept txpk or None """
+        tmst = txpk.get('tmst', 0)
+        for delay in [region.Region.JOIN_RX1_DELAY, region.Region.JOIN_RX2_DELAY]:
+            device = self.pending.pop((tmst - delay * 1000000) & 0xFFFFFFFF, None)
+            if device is not None:
+                return device
+        return None
+
+def decode_join_accept(frame, appkey):
+    """ Returns (appnonce, netid, devaddr) or None when the MIC is invalid """
+    if len(frame) < crypto.JOIN_ACCEPT_FRAME_SIZE or ord(frame[0]) >> 5 != packet.JOIN_ACCEPT_MTYPE:
+        return None
+    payload = crypto.aes128_encrypt(frame[1:], appkey)
+    mic, = struct.unpack('<I', payload[-4:])
+    if crypto.aes_cmac(frame[0] + payload[:-4], appkey) != mic:
+        return None
+    appnonce, = struct.unpack('<I', payload[0:3] + '\x00')
+    netid, = struct.unpack('<I', payload[3:6] + '\x00')
+    devaddr, = struct.unpack('<I', payload[6:10])
+    return appnonce, netid, devaddr
+
+def encode_uplink_frame(devaddr, fcnt, nwkskey):
+    frame = struct.pack('<BIBHB', packet.UNCONFIRMED_UL_MTYPE << 5, devaddr, 0, fcnt, 1) + '\x00'
+    return frame + struct.pack('<I', crypto.compute_uplink_mic(frame, nwkskey, devaddr, fcnt))
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+class LoadGenerator(object):
+    def __init__(self, server_addr, nb_gateways, devices, rate=0, inflight=1000, batch=1,
+                 join_timeout=JOIN_TIMEOUT_DEFAULT, region_name=REGION_DEFAULT):
+        """ devices: list of (joineui, deveui, appkey), joineui and deveui as hex strings.
+            rate: join-requests per second, 0 for as fast as inflight allows.
+            region_name: region of the harness, the uplink channels are taken from it """
+        channels = uplink_channels(region_name)
+        spacing_us = join_accept_spacing_us(region_name, channels)
+        self.gateways = [SimGateway(i, server_addr, channels, spacing_us) for i in range(0, nb_gateways)]
+        self.by_socket = dict((gateway.socket, gateway) for gateway in self.gateways)
+        self.idle = collections.deque(SimDevice(joineui, deveui, appkey, self.gateways[i % nb_gateways])
+                                      for i, (joineui, deveui, appkey) in enumerate(devices))
+        self.rate = rate
+        self.inflight = inflight
+        self.batch = batch
+        self.join_timeout = join_timeout
+        self.nb_pending = 0
+        self.latencies = []
+        self.counter = {'join_request': 0, 'join_accept': 0, 'invalid_join_accept': 0, 'timeout': 0, 'uplink': 0}
+
+    def send_join_requests(self, now, count):
+        frames = {}
+        for i in range(0, min(count, len(self.idle))):
+            device = self.idle.popleft()
+            gateway = device.gateway
+            device.devnonce = (device.devnonce + 1) & 0xFFFF
+            device.sent_time = now
+            tmst = gateway.next_tmst()
+            gateway.pending[tmst] = device
+            frame = packet.encode_join_request_frame(device.joineui, device.deveui, device.devnonce, device.appkey)
+            frames.setdefault(gateway, []).append((frame, tmst))
+        for gateway, gateway_frames in frames.items():
+            for i in range(0, len(gateway_frames), self.batch):
+                gateway.push_data(gateway_frames[i:i + self.batch])
+        sent = sum(len(gateway_frames) for gateway_frames in frames.values())
+        self.nb_pending += sent
+        self.counter['join_request'] += sent
+        return sent
+
+    def receive(self, gateway, now):
+        while True:
+            try:
+                msg = gateway.socket.recv(2048)
+            except socket.error:
+                return
+            if len(msg) < 4 or ord(msg[3]) != pfs.PULL_RESP:
+                continue
+            token, = struct.unpack('<H', msg[1:3])
+            gateway.tx_ack(token)
+            try:
+                txpk = json.loads(msg[4:])['txpk']
+                frame = binascii.a2b_base64(txpk['data'])
+            except (ValueError, KeyError, binascii.Error):
+                continue
+            device = gateway.join_device(txpk)
+            if device is None:
+                continue
+            self.nb_pending -= 1
+            self.latencies.append(now - device.sent_time)
+            self.counter['join_accept'] += 1
+            self.join_accept(device, frame)
+            self.idle.append(device)
+
+    def join_accept(self, device, frame):
+        accept = decode_join_accept(frame, device.appkey)
+        if accept is None:
+            self.counter['invalid_join_accept'] += 1
+            return
+        appnonce, netid, devaddr = accept
+        nwkskey = crypto.compute_nwk_skey(appnonce, netid, device.devnonce, device.appkey)
+        device.gateway.push_data([(encode_uplink_frame(devaddr, 0, nwkskey), device.gateway.next_tmst())])
+        self.counter['uplink'] += 1
+
+    def expire(self, now):
+        for gateway in self.gateways:
+            for tmst, device in gateway.pending.items():
+                if now - device.sent_time > self.join_timeout:
+                    del gateway.pending[tmst]
+                    self.nb_pending -= 1
+                    self.counter['timeout'] += 1
+                    self.idle.append(device)
+
+    def run(self, duration):
+        now = time.time()
+        for gateway in self.gateways:
+            gateway.pull_data(now)
+        # let the server register the PULL_DATA addresses
+        time.sleep(0.2)
+        start = now = time.time()
+        next_expire = now + self.join_timeout
+        while now - start < duration:
+            if self.rate > 0:
+                due = int((now - start) * self.rate) - self.counter['join_request']
+            else:
+                due = len(self.idle)
+            due = min(due, self.inflight - self.nb_pending)
+            if due > 0:
+                self.send_join_requests(now, due)
+            readable, _, _ = select.select(self.by_socket.keys(), [], [], 0.001)
+            now = time.time()
+            for sock in readable:
+                self.receive(self.by_socket[sock], now)
+            if now >= next_expire:
+                self.expire(now)
+                next_expire = now + self.join_timeout / 4
+            for gateway in self.gateways:
+                if now - gateway.pull_data_time > PULL_DATA_INTERVAL:
+                    gateway.pull_data(now)
+        return self.report(time.time() - start)
+
+    def report(self, elapsed):
+        latencies = sorted(self.latencies)
+        result = dict(self.counter)
+        result['elapsed'] = elapsed
+        result['joins_per_sec'] = self.counter['uplink'] / elapsed if elapsed > 0 else 0.0
+        result['latency_p50'] = percentile(latencies, 50)
+        result['latency_p99'] = percentile(latencies, 99)
+        return result
+
+def load_devices(conf_dir, max_devices=0):
+    """ (joineui, deveui, appkey) of the device files of conf_dir """
+    devices = []
+    for filename in sorted(glob.glob(os.path.join(conf_dir, '*.csv'))):
+        joineui = os.path.splitext(os.path.basename(filename))[0]
+        store, errors = devicestore.load(filename)
+        if store is None:
+            raise ValueError("%s: %s" % (filename, errors[0]))
+        for deveui, appkey in store:
+            devices.append((joineui, binascii.hexlify(deveui), appkey))
+            if max_devices and len(devices) >= max_devices:
+                return devices
+    return devices
+
+def print_report(result):
+    print("join-requests  %d" % result['join_request'])
+    print("join-accepts   %d (invalid %d, timeouts %d)" % (result['join_accept'], result['invalid_join_accept'], result['timeout']))
+    print("joins/s        %.1f" % result['joins_per_sec'])
+    print("PUSH_DATA to PULL_RESP p50 %.2f ms, p99 %.2f ms" % (result['latency_p50'] * 1e3, result['latency_p99'] * 1e3))
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulated packet forwarders for the OTAA test harness")
+    parser.add_argument('--server', default='localhost')
+    parser.add_argument('--port', type=int, default=SERVER_PORT_DEFAULT)
+    parser.add_argument('--conf', default='conf', help="directory of the <JoinEUI>.csv device files")
+    parser.add_argument('--gateways', type=int, default=1)
+    parser.add_argument('--devices', type=int, default=0, help="number of devices, 0 for all")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds")
+    parser.add_argument('--rate', type=float, default=0, help="join-requests per second, 0 for unlimited")
+    parser.add_argument('--inflight', type=int, default=1000, help="maximum pending join-requests")
+    parser.add_argument('--batch', type=int, default=1, help="join-requests per PUSH_DATA")
+    parser.add_argument('--region', default=REGION_DEFAULT, choices=region.SUPPORTED, help="region of the harness")
+    args = parser.parse_args()
+
+    devices = load_devices(args.conf, args.devices)
+    generator = LoadGenerator((args.server, args.port), args.gateways, devices, args.rate, args.inflight, args.batch,
+                              region_name=args.region)
+    print_report(generator.run(args.duration))
+
+if __name__ == '__main__':
+    main()
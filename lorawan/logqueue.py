@@ -0,0 +1,136 @@
+import logging
+import threading
+import Queue
+import json
+import os
+
+LISTENER_BATCH_SIZE_DEFAULT = 256
+
+class QueueHandler(logging.Handler):
+    """ Handler posting log records to a queue. With serialize set, records are
+        formatted before being enqueued so they can cross process boundaries,
+        otherwise they are formatted by the listener thread """
+    def __init__(self, queue, serialize=True):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.serialize = serialize
+
+    def prepare(self, record):
+        if not self.serialize:
+            return record
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Queue.Full:
+            pass
+        except Exception:
+            self.handleError(record)
+
+class QueueListener(object):
+    """ Dequeue log records posted by a QueueHandler and pass them to handlers.
+        Records are handled in batches, handlers are flushed once per batch """
+    _sentinel = None
+
+    def __init__(self, queue, *handlers, **kwargs):
+        self.queue = queue
+        self.handlers = handlers
+        self.batch_size = kwargs.get('batch_size', LISTENER_BATCH_SIZE_DEFAULT)
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._monitor, name='log-listener')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self.queue.put(self._sentinel)
+        self._thread.join()
+        self._thread = None
+
+    def handle(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def flush(self):
+        for handler in self.handlers:
+            getattr(handler, 'flush_batch', handler.flush)()
+
+    def dequeue_batch(self):
+        records = [self.queue.get()]
+        try:
+            while len(records) < self.batch_size:
+                records.append(self.queue.get_nowait())
+        except Queue.Empty:
+            pass
+        return records
+
+    def _monitor(self):
+        running = True
+        while running:
+            for record in self.dequeue_batch():
+                if record is self._sentinel:
+                    running = False
+                    break
+                self.handle(record)
+            self.flush()
+
+class BatchStreamHandler(logging.StreamHandler):
+    """ StreamHandler flushed by the QueueListener once per batch of records """
+    def flush(self):
+        pass
+
+    def flush_batch(self):
+        logging.StreamHandler.flush(self)
+
+class BatchFileHandler(logging.FileHandler):
+    """ FileHandler flushed by the QueueListener once per batch of records """
+    def flush(self):
+        pass
+
+    def flush_batch(self):
+        logging.FileHandler.flush(self)
+
+class JsonLinesHandler(BatchFileHandler):
+    """ Write the 'result' dictionary of records as JSON lines, records without one are skipped """
+    def emit(self, record):
+        if getattr(record, 'result', None) is not None:
+            BatchFileHandler.emit(self, record)
+
+    def format(self, record):
+        result = dict(record.result)
+        result['time'] = record.created
+        return json.dumps(result, sort_keys=True)
+
+class CsvHandler(BatchFileHandler):
+    """ Append the 'row' tuple of records to a CSV file, records without one are skipped.
+        The header is written when the file is created. Values are numbers and hex
+        strings, None is written as an empty field """
+    def __init__(self, filename, columns):
+        new_file = not os.path.exists(filename) or os.path.getsize(filename) == 0
+        BatchFileHandler.__init__(self, filename, 'a')
+        if new_file:
+            self.stream.write(','.join(columns) + '\n')
+            BatchFileHandler.flush_batch(self)
+
+    def emit(self, record):
+        if getattr(record, 'row', None) is not None:
+            BatchFileHandler.emit(self, record)
+
+    def format(self, record):
+        return ','.join(format_field(value) for value in record.row)
+
+def format_field(value):
+    if value is None:
+        return ''
+    # str() rounds floats to 12 digits, time.time() values need repr()
+    return repr(value) if isinstance(value, float) else str(value)
@@ -0,0 +1,148 @@
+""" Latency histograms and counters exported as Prometheus text.
+
+    Histograms have fixed buckets and are updated with time.time() deltas.
+    Counter dictionaries (Server.counter, Gateway.counter, ...) are registered
+    as they are and read when the metrics are rendered. The HTTP endpoint runs
+    in a daemon thread. The samples of other endpoints, those of worker
+    processes, can be collected and served again with a distinguishing label.
+"""
+import bisect
+import re
+import threading
+import urllib2
+import BaseHTTPServer
+import logging
+
+logger = logging.getLogger('harness.metrics')
+
+# seconds, the RX1 join-accept budget is 5s
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+class Histogram(object):
+    """ Fixed bucket histogram, observe() is a bisect and two increments """
+    __slots__ = ('name', 'help', 'bounds', 'counts', 'sum')
+
+    def __init__(self, name, help, bounds=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value, count=1):
+        self.counts[bisect.bisect_left(self.bounds, value)] += count
+        self.sum += value * count
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def render(self, lines):
+        lines.append("# HELP %s %s" % (self.name, self.help))
+        lines.append("# TYPE %s histogram" % self.name)
+        counts = list(self.counts)
+        total = 0
+        for bound, count in zip(self.bounds, counts):
+            total += count
+            lines.append('%s_bucket{le="%g"} %d' % (self.name, bound, total))
+        total += counts[-1]
+        lines.append('%s_bucket{le="+Inf"} %d' % (self.name, total))
+        lines.append("%s_sum %f" % (self.name, self.sum))
+        lines.append("%s_count %d" % (self.name, total))
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('%s="%s"' % (key, labels[key]) for key in sorted(labels)) + '}'
+
+class Registry(object):
+    def __init__(self):
+        self.histograms = {}
+        self.collectors = []
+
+    def histogram(self, name, help, bounds=LATENCY_BUCKETS):
+        """ Histogram registered under name, created on first call """
+        histogram = self.histograms.get(name, None)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram(name, help, bounds)
+        return histogram
+
+    def add_collector(self, collector):
+        """ collector() returns an iterable of (name, labels, value) samples """
+        self.collectors.append(collector)
+
+    def add_counters(self, prefix, counter, labels=None):
+        """ Export a counter dictionary, sample names are prefix_key """
+        self.add_collector(lambda: [(prefix + '_' + key, labels, value) for key, value in counter.items()])
+
+    def render(self):
+        lines = []
+        for name in sorted(self.histograms):
+            self.histograms[name].render(lines)
+        samples = []
+        for collector in self.collectors:
+            samples.extend(collector())
+        for name, labels, value in sorted(samples):
+            lines.append("%s%s %s" % (name, format_labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+SAMPLE_RE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})? (\S+)$')
+LABEL_RE = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"')
+
+def parse_samples(text, labels=None):
+    """ (name, labels, value) samples of a rendered registry, labels added to each """
+    samples = []
+    for line in text.splitlines():
+        match = SAMPLE_RE.match(line)
+        if match is None:
+            continue
+        name, sample_labels, value = match.groups()
+        sample_labels = dict(LABEL_RE.findall(sample_labels or ''))
+        sample_labels.update(labels or {})
+        samples.append((name, sample_labels, value))
+    return samples
+
+def scrape_collector(endpoints, timeout=1.0):
+    """ Collector of the samples of other endpoints, (url, labels) pairs.
+        An endpoint that does not answer is skipped """
+    # local endpoints, not through the environment proxy
+    opener = urllib2.build_opener(urllib2.ProxyHandler({}))
+    def collect():
+        samples = []
+        for url, labels in endpoints:
+            try:
+                samples.extend(parse_samples(opener.open(url, timeout=timeout).read(), labels))
+            except (IOError, ValueError) as e:
+                logger.debug("metrics %s not collected: %s", url, e)
+        return samples
+    return collect
+
+registry = Registry()
+
+def histogram(name, help, bounds=LATENCY_BUCKETS):
+    return registry.histogram(name, help, bounds)
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in ['/', '/metrics']:
+            self.send_error(404)
+            return
+        body = self.server.registry.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_http_server(port, host='localhost', metrics_registry=None):
+    """ Serve the registry on http://host:port/metrics from a daemon thread """
+    server = BaseHTTPServer.HTTPServer((host, port), MetricsHandler)
+    server.registry = metrics_registry if metrics_registry is not None else registry
+    thread = threading.Thread(target=server.serve_forever, name='metrics-http')
+    thread.daemon = True
+    thread.start()
+    logger.info("metrics endpoint http://%s:%d/metrics", host, server.server_port)
+    return server
@@ -23,18 +23,25 @@ MType = {JOIN_REQ_MTYPE:'Join Request', JOIN_ACCEPT_MTYPE:'Join Accept',
 def to_eui_format(eui):
     return '-'.join('{:02x}'.format(x) for x in eui)
 
+# Minimum PHYPayload size of a decodable frame: MHDR + MACPayload fields used
+JOIN_REQ_MIN_SIZE = 1 + 18
+UPLINK_MIN_SIZE = 1 + 7
+
 class Packet(object):
+   """ LoRaWAN frame kept as the undecoded PHYPayload bytes, header fields
+       are decoded on first access. PHYPayload is a zero-copy memoryview. """
+   __slots__ = ('__data', '__valid', 'MType', '__AppEui', '__DevEui', '__DevNonce', '__DevAddr', '__FCtrl', '__FCnt')
+
    def  __init__(self, PHYPayload = None):
-       self.PHYPayload = None
-       self.MType = None 
-       self.DevEui = None
-       self.AppEui = None
-       self.AppKey = None
-       self.DevAddr = None
-       self.DevNonce = None
-       self.FCnt = None
-       self.FCtrl = None
+       self.__data = None
        self.__valid = False
+       self.MType = None
+       self.__AppEui = None
+       self.__DevEui = None
+       self.__DevNonce = None
+       self.__DevAddr = None
+       self.__FCtrl = None
+       self.__FCnt = None
 
        if PHYPayload is not None:
           self.initialize_from_phypayload(PHYPayload)
@@ -43,31 +50,71 @@ class Packet(object):
            print("Received MType == None")
 
    def initialize_from_phypayload(self, PHYPayload):
-       self.PHYPayload = bytearray(PHYPayload)
-       self.MType = self.PHYPayload[0] >> 5
+       if not isinstance(PHYPayload, bytes):
+           PHYPayload = bytes(bytearray(PHYPayload))
+       self.__data = PHYPayload
+       if not PHYPayload:
+           logger.warning("empty PHYPayload")
+           return
+       self.MType = ord(PHYPayload[0]) >> 5
        if self.MType == JOIN_REQ_MTYPE:
-           self.__valid = self.initialize_from_join_request(self.PHYPayload[1:])
+           self.__valid = len(PHYPayload) >= JOIN_REQ_MIN_SIZE
+           if not self.__valid:
+               logger.warning("decode join request failed")
        elif self.MType in [UNCONFIRMED_UL_MTYPE, CONFIRMED_UL_MTYPE] :
-           self.__valid = self.initialize_from_uplink(self.PHYPayload[1:])
-
-   def initialize_from_join_request(self, MACPayload):
-       self.MACPayload = MACPayload
-       try:
-           self.AppEui = bytes(MACPayload[7::-1] )
-           self.DevEui = bytes(MACPayload[15:7:-1])
-           self.DevNonce = struct.unpack("<H",bytes(MACPayload[16:18]))[0]
-           return True
-       except:
-           logger.warning("decode join request failed")
-           return False
-
-   def initialize_from_uplink(self, MACPayload):
-       try:
-           self.DevAddr, self.FCtrl, self.FCnt = struct.unpack("<IBH", bytes(MACPayload[:7]))
-           return True
-       except:
-           logger.warning("decode uplink failed")
-           return False
+           self.__valid = len(PHYPayload) >= UPLINK_MIN_SIZE
+           if not self.__valid:
+               logger.warning("decode uplink failed")
+
+   def decode_uplink_fhdr(self):
+       self.__DevAddr, self.__FCtrl, self.__FCnt = struct.unpack_from("<IBH", self.__data, 1)
+
+   def is_uplink(self):
+       return self.MType in [UNCONFIRMED_UL_MTYPE, CONFIRMED_UL_MTYPE] if self.valid else False
+
+   @property
+   def PHYPayload(self):
+       return memoryview(self.__data) if self.__data is not None else None
+
+   @property
+   def MACPayload(self):
+       return memoryview(self.__data)[1:] if self.__data is not None else None
+
+   @property
+   def AppEui(self):
+       if self.__AppEui is None and self.is_join_request():
+           self.__AppEui = self.__data[8:0:-1]
+       return self.__AppEui
+
+   @property
+   def DevEui(self):
+       if self.__DevEui is None and self.is_join_request():
+           self.__DevEui = self.__data[16:8:-1]
+       return self.__DevEui
+
+   @property
+   def DevNonce(self):
+       if self.__DevNonce is None and self.is_join_request():
+           self.__DevNonce, = struct.unpack_from("<H", self.__data, 17)
+       return self.__DevNonce
+
+   @property
+   def DevAddr(self):
+       if self.__DevAddr is None and self.is_uplink():
+           self.decode_uplink_fhdr()
+       return self.__DevAddr
+
+   @property
+   def FCtrl(self):
+       if self.__FCtrl is None and self.is_uplink():
+           self.decode_uplink_fhdr()
+       return self.__FCtrl
+
+   @property
+   def FCnt(self):
+       if self.__FCnt is None and self.is_uplink():
+           self.decode_uplink_fhdr()
+       return self.__FCnt
 
    def get_MType(self):
         return self.MType if self.valid else None
@@ -86,7 +133,7 @@ class Packet(object):
    def MIC(self):
        mic = None
        if self.valid:
-           mic, = struct.unpack("<I", bytes(self.PHYPayload[-4:]))
+           mic, = struct.unpack_from("<I", self.__data, len(self.__data) - 4)
        return mic
 
    def get_MType_name(self):
@@ -99,16 +146,24 @@ class Packet(object):
         return self.MType == JOIN_ACCEPT_MTYPE  if self.valid else False
 
    def pkt_len(self):
-       return len(self.PHYPayload) if self.valid else 0
+       return len(self.__data) if self.valid else 0
+
 
+def encode_join_accept_macpayload(appnonce, netid, devaddr, dlsettings=8, rxdelay=1):
+    return struct.pack("<6BIBB", appnonce & 0xff, (appnonce>>8) & 0xff, (appnonce>>16) & 0xff,
+                                 netid & 0xff, (netid>>8) & 0xff, (netid>>16) & 0xff, 
+                                 devaddr, dlsettings, rxdelay)
 
 def encode_join_accept_frame(appkey, appnonce, netid, devaddr, dlsettings=8, rxdelay=1, cflist=None):
+    """ appkey is either the raw key or a crypto.KeyContext """
     mtype = struct.pack("B", JOIN_ACCEPT_MTYPE<<5) 
-    macpayload = struct.pack("<6BIBB", appnonce & 0xff, (appnonce>>8) & 0xff, (appnonce>>16) & 0xff,
-                                       netid & 0xff, (netid>>8) & 0xff, (netid>>16) & 0xff, 
-                                       devaddr, dlsettings, rxdelay)
-    mic = struct.pack("<I", crypto.aes_cmac(mtype + macpayload, appkey))
-    encrypted = crypto.aes128_decrypt(macpayload + mic, appkey)
+    macpayload = encode_join_accept_macpayload(appnonce, netid, devaddr, dlsettings, rxdelay)
+    if isinstance(appkey, crypto.KeyContext):
+        mic = struct.pack("<I", crypto.aes_cmac_ctx(mtype + macpayload, appkey))
+        encrypted = crypto.aes128_decrypt_ctx(macpayload + mic, appkey)
+    else:
+        mic = struct.pack("<I", crypto.aes_cmac(mtype + macpayload, appkey))
+        encrypted = crypto.aes128_decrypt(macpayload + mic, appkey)
     return mtype + encrypted
 
 def encode_join_request_frame(joineui, deveui, devnonce, appkey):
@@ -1,16 +1,34 @@
 import socket
+import select
 import json
 import binascii
+import marshal
 import struct
 import region
 import packet
 import logging
 import errno
 import sys
+import threading
+import multiprocessing
+import Queue
+import time
+import metrics
+import downlink
+import dedup
 
 logger = logging.getLogger('harness.pktfwdr')
 logger.setLevel(logging.DEBUG)
 
+# ujson decodes PUSH_DATA several times faster, the standard json module is the fallback
+try:
+    import ujson
+    json_loads = ujson.loads
+    JSON_BACKEND = 'ujson'
+except ImportError:
+    json_loads = json.loads
+    JSON_BACKEND = 'json'
+
 VERSIONS = [1,2]
 
 PUSH_DATA = 0
@@ -26,15 +44,121 @@ INVALID_DR = -1
 
 SOCK_RX_CNT = 'sock_rx'
 PUSH_DATA_CNT = 'push_data'
+PULL_DATA_CNT = 'pull_data'
 PULL_RESP_CNT = 'pull_resp'
+TX_ACK_CNT = 'tx_ack'
+QUEUE_DROP_CNT = 'queue_drop'
+QUEUE_MAX_DEPTH_CNT = 'queue_max_depth'
+SHARD_DROP_CNT = 'shard_drop'
+TX_ACK_ERROR_CNT = 'tx_ack_error'
+LATE_DOWNLINK_CNT = 'late_downlink'
+DOWNLINK_SAVED_CNT = 'downlink_saved'
+DOWNLINK_LOST_LATE_CNT = 'downlink_lost_late'
+DOWNLINK_LOST_COLLISION_CNT = 'downlink_lost_collision'
+DOWNLINK_RETRY_CNT = 'downlink_retry'
+TX_ACK_TIMEOUT_CNT = 'tx_ack_timeout'
+STAT_ONLY_CNT = 'push_data_stat_only'
+DUPLICATE_CNT = 'rxpk_duplicate'
+
+# TX_ACK errors of downlinks that can be sent again on another rx window
+RETRY_TX_ACK_ERRORS = frozenset(['TOO_LATE', 'TOO_EARLY', 'COLLISION_PACKET', 'COLLISION_BEACON'])
+TX_ACK_TIMEOUT_DEFAULT = 5.0
+
+# Stage latency histograms
+RECEIVE_HIST = metrics.histogram('lorawan_receive_seconds', 'Datagram receipt to packet handler, rx queue wait included')
+JSON_DECODE_HIST = metrics.histogram('lorawan_json_decode_seconds', 'PUSH_DATA JSON decode')
+SENDTO_HIST = metrics.histogram('lorawan_sendto_seconds', 'PULL_RESP socket sendto')
+TX_ACK_HIST = metrics.histogram('lorawan_tx_ack_seconds', 'PULL_RESP to TX_ACK round trip')
+
+WORKER_QUEUE_SIZE_DEFAULT = 4096
+
+# Linux value, the Python 2 socket module does not define it
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+PROC_NET_UDP = ('/proc/net/udp', '/proc/net/udp6')
+
+# Time of the server logic: receipt times, dedup windows, tmst estimates and TX_ACK
+# timeouts. Trace replay swaps in a synthetic clock
+clock = time.time
+
+# PULL_RESP txpk, the constant fields are rendered once per gateway and
+# tmst, freq, datr, size and data are spliced in for each downlink
+TXPK_TEMPLATE = ('{"txpk":{"tmst":%%d,"freq":%%s,"rfch":%(rfch)d,"powe":%(powe)d,"ant":%(ant)d,'
+                 '"modu":"LORA","datr":"%%s","codr":"%(codr)s","ipol":true,"size":%%d,"data":"%%s"}}')
+
+def render_txpk_template(coderate, rfch=0, powe=20, ant=0):
+    return TXPK_TEMPLATE % {'rfch': rfch, 'powe': powe, 'ant': ant, 'codr': coderate}
+
+def udp_socket(host, port, rcvbuf=0, sndbuf=0, reuseport=False):
+    """ UDP socket bound to host:port, kernel buffer sizes in bytes with 0 for the system default """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if reuseport:
+        sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    for option, size in [(socket.SO_RCVBUF, rcvbuf), (socket.SO_SNDBUF, sndbuf)]:
+        if size:
+            sock.setsockopt(socket.SOL_SOCKET, option, size)
+            # Linux doubles the requested size and caps it to net.core.[rw]mem_max
+            if sock.getsockopt(socket.SOL_SOCKET, option) < size:
+                logger.warning("socket buffer option=%d size=%d capped to %d by the kernel",
+                               option, size, sock.getsockopt(socket.SOL_SOCKET, option))
+    sock.bind((host, port))
+    return sock
+
+def udp_drops(port, paths=PROC_NET_UDP):
+    """ Datagrams dropped by the kernel on the UDP sockets bound to port, receive
+        buffer full included. None when /proc/net/udp is not available """
+    drops = None
+    for path in paths:
+        try:
+            with open(path) as f:
+                lines = f.readlines()[1:]
+        except IOError:
+            continue
+        for line in lines:
+            # sl local_address rem_address st tx_queue:rx_queue ... inode ref pointer drops
+            fields = line.split()
+            if len(fields) > 12 and int(fields[1].rsplit(':', 1)[1], 16) == port:
+                drops = (drops or 0) + int(fields[-1])
+    return drops
+
+class Gateway(object):
+    """ Per gateway state, indexed by the 8 byte gateway MAC of the message header """
+    def __init__(self, mac, token_offset=0, token_step=1, txpk_template=None):
+        self.mac = mac
+        self.push_dest_addr = None
+        self.pull_dest_addr = None
+        self.counter = {PUSH_DATA_CNT:0, PULL_DATA_CNT:0, PULL_RESP_CNT:0, TX_ACK_CNT:0,
+                        DOWNLINK_SAVED_CNT:0, DOWNLINK_LOST_LATE_CNT:0, DOWNLINK_LOST_COLLISION_CNT:0}
+        self.scheduler = downlink.DownlinkScheduler()
+        self.outstanding = downlink.OutstandingDownlinks()
+        self.pr_token = 0
+        self.token_offset = token_offset
+        self.token_step = token_step
+        self.txpk_template = txpk_template
+
+    @property
+    def eui(self):
+        return binascii.hexlify(self.mac).upper()
+
+    def incr(self, counter):
+        cnt = self.counter[counter]
+        self.counter[counter] = cnt + 1
+
+    def next_pull_response_token(self):
+        # token_offset/token_step keep the tokens of several worker processes disjoint,
+        # the worker of a token is token % token_step
+        self.pr_token = (self.pr_token + 1) % (0x10000 // self.token_step)
+        return self.token_offset + self.pr_token * self.token_step
 
 class RxPacket(packet.Packet):
-    def __init__(self, version, rxpk):
+    __slots__ = ('_version', 'rxpk', 'gateway', 'rx_time')
+
+    def __init__(self, version, rxpk, gateway, rx_time=None):
          self._version = version
          self.rxpk = rxpk
-         self.pr_token = 0
-         data = self.rxpk["data"].decode('base64')
-         packet.Packet.__init__(self, data)
+         self.gateway = gateway
+         # clock() of the datagram receipt
+         self.rx_time = rx_time
+         packet.Packet.__init__(self, binascii.a2b_base64(self.rxpk["data"]))
 
     @property
     def freq(self):
@@ -65,148 +189,609 @@ class RxPacket(packet.Packet):
     def version(self):
         return self._version 
 
+    def gateway_tmst(self):
+        """ Estimate of the gateway tmst counter now, from the packet tmst and receipt time """
+        tmst = self.rxpk.get('tmst', None)
+        if tmst is None or self.rx_time is None:
+            return tmst
+        return (tmst + int((clock() - self.rx_time) * 1000000)) & downlink.TMST_MASK
+
     def next_pull_response_token(self):
-        self.pr_token = self.pr_token + 1
-        return self.pr_token 
+        return self.gateway.next_pull_response_token()
 
 class Server:
-    def __init__(self, server_host, server_port, region_name, discard_mtypes=None):
+    def __init__(self, server_host, server_port, region_name, discard_mtypes=None, rcvbuf=0, sndbuf=0,
+                 reuseport=False):
         self.server_host = server_host
         self.server_port = server_port
-        self.counter = {SOCK_RX_CNT:0, PUSH_DATA_CNT:0, PULL_RESP_CNT:0}
+        self.counter = {SOCK_RX_CNT:0, PUSH_DATA_CNT:0, PULL_RESP_CNT:0, QUEUE_DROP_CNT:0, QUEUE_MAX_DEPTH_CNT:0,
+                        TX_ACK_ERROR_CNT:0, LATE_DOWNLINK_CNT:0,
+                        DOWNLINK_SAVED_CNT:0, DOWNLINK_LOST_LATE_CNT:0, DOWNLINK_LOST_COLLISION_CNT:0,
+                        DOWNLINK_RETRY_CNT:0, TX_ACK_TIMEOUT_CNT:0, STAT_ONLY_CNT:0, DUPLICATE_CNT:0}
         self.rx_handler = None
+        self.rx_batch_handler = None
+        self.rx_queue = None
+        # dedup.DedupCache holding received packets until the copies from other gateways are in
+        self.dedup = None
+        # capture.TraceWriter recording the received and sent datagrams
+        self.trace = None
+        # timerwheel.TimingWheel advanced by the server loop, the items of the expired
+        # timers are handed to timer_handler
+        self.timers = None
+        self.timer_handler = None
+        # retry_handler(context, window) of a downlink rejected by the gateway: window is
+        # the (rxslot, rxconf, txtmst) it was sent again on, None when it is lost
+        self.retry_handler = None
         self.region = region.get(region_name)
+        self.txpk_template = render_txpk_template(self.region.coderate)
         self.discard_mtypes = discard_mtypes
-        self.socket_up = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket_up = self.open_socket(rcvbuf, sndbuf, reuseport)
         self.socket_down = self.socket_up
-        self.socket_up.bind((self.server_host, self.server_port))
-        self.pull_dest_addr = None
-        self.push_dest_addr = None
+        # actual port when server_port is 0
+        self.local_port = self.socket_up.getsockname()[1] if self.socket_up is not None else None
+        self.gateways = {}
+        self.token_offset = 0
+        self.token_step = 1
+        self.tx_ack_timeout = TX_ACK_TIMEOUT_DEFAULT
+        self.next_tx_ack_expiry = 0
+
+    def open_socket(self, rcvbuf, sndbuf, reuseport):
+        return udp_socket(self.server_host, self.server_port, rcvbuf, sndbuf, reuseport)
 
     def incr(self, counter):
         cnt = self.counter[counter] 
         self.counter[counter] = cnt + 1
 
-    def run(self, rx_handler):
-        self.rx_handler = rx_handler
+    def get_gateway(self, mac):
+        gateway = self.gateways.get(mac, None)
+        if gateway is None:
+            gateway = Gateway(mac, self.token_offset, self.token_step, self.txpk_template)
+            self.gateways[mac] = gateway
+            logger.info("new gateway=%s", gateway.eui)
+        return gateway
+
+    @property
+    def queue_depth(self):
+        return self.rx_queue.qsize() if self.rx_queue is not None else 0
+
+    def metrics_samples(self):
+        """ Server and gateway counters as metrics.Registry samples """
+        samples = [('lorawan_server_' + key, None, value) for key, value in self.counter.items()]
+        samples.append(('lorawan_server_queue_depth', None, self.queue_depth))
+        if self.dedup is not None:
+            samples.append(('lorawan_server_dedup_entries', None, len(self.dedup)))
+        drops = udp_drops(self.local_port) if self.local_port is not None else None
+        if drops is not None:
+            samples.append(('lorawan_server_kernel_rx_drops', None, drops))
+        for gateway in self.gateways.values():
+            labels = {'gateway': gateway.eui}
+            samples.extend(('lorawan_gateway_' + key, labels, value) for key, value in gateway.counter.items())
+        return samples
 
-        logger.info("server accepting connections on %s:%d" % (self.server_host, self.server_port))
+    def recvfrom(self, timeout=None):
+        """ Blocking socket receive, returns None on unrecoverable socket error
+            and False when nothing is received within timeout seconds """
         while True:
             try:
-                data, addr = self.socket_up.recvfrom(1024)
-            except socket.error as e:
-                if e.errno != errno.EINTR:
-                    logger.critical("Error receving from socket:  %s" % e)
-                    sys.exit(1)
+                if timeout is not None and not select.select([self.socket_up], [], [], timeout)[0]:
+                    return False
+                return self.socket_up.recvfrom(1024)
+            except (socket.error, select.error) as e:
+                if e.args[0] != errno.EINTR:
+                    logger.critical("Error receving from socket:  %s", e)
+                    return None
                 else:
                     logger.warning("Ignoring socket EINTR exception")
-                    continue
-            self.receive(data, addr)
-                
 
-    def receive(self, msg, addr):
+    def run(self, rx_handler, queue_size=0):
+        """ Serve packet forwarders. When queue_size is set the socket is drained 
+            by a receiver thread into a bounded queue processed by the calling thread """
+        self.rx_handler = rx_handler
+
+        logger.info("server accepting connections on %s:%d", self.server_host, self.server_port)
+        if queue_size > 0:
+            self.start_receiver(queue_size)
+            self.process_queue()
+            return
+
+        while True:
+            rx = self.recvfrom(self.release_timeout())
+            if rx is None:
+                sys.exit(1)
+            if rx:
+                self.receive(rx[0], rx[1], clock())
+            self.release_packets()
+
+    def start_receiver(self, queue_size):
+        self.rx_queue = Queue.Queue(queue_size)
+        receiver = threading.Thread(target=self.receiver_loop, name='pktfwdr-rx')
+        receiver.daemon = True
+        receiver.start()
+        logger.info("receiver thread started queue size=%d", queue_size)
+
+    def receiver_loop(self):
+        while True:
+            rx = self.recvfrom()
+            if rx is None:
+                # wake up the processing thread, it exits on the None entry
+                self.rx_queue.put(None)
+                return
+            try:
+                self.rx_queue.put_nowait((rx[0], rx[1], clock()))
+            except Queue.Full:
+                self.incr(QUEUE_DROP_CNT)
+                continue
+            depth = self.rx_queue.qsize()
+            if depth > self.counter[QUEUE_MAX_DEPTH_CNT]:
+                self.counter[QUEUE_MAX_DEPTH_CNT] = depth
+
+    def process_queue(self):
+        while True:
+            try:
+                rx = self.rx_queue.get(timeout=self.release_timeout())
+            except Queue.Empty:
+                self.release_packets()
+                continue
+            if rx is None:
+                logger.critical("receiver thread exited")
+                sys.exit(1)
+            self.receive(*rx)
+            self.release_packets()
+
+    def next_deadline(self):
+        """ End of the dedup window of the oldest held packet or next timer tick, None
+            when neither packets nor timers are pending """
+        deadline = self.dedup.next_deadline() if self.dedup is not None else None
+        tick = self.timers.next_tick() if self.timers is not None else None
+        if deadline is None or (tick is not None and tick < deadline):
+            return tick
+        return deadline
+
+    def release_timeout(self):
+        """ Seconds until next_deadline(), None when nothing is pending """
+        deadline = self.next_deadline()
+        if deadline is None:
+            return None
+        return max(deadline - clock(), 0.0001)
+
+    def release_packets(self):
+        """ Hand over the packets whose dedup window ended and the expired timers """
+        now = clock()
+        if self.dedup is not None:
+            pkts = self.dedup.release(now)
+            if pkts:
+                self.handle_packets(pkts)
+        if self.timers is not None:
+            expired = self.timers.advance(now)
+            if expired:
+                self.timer_handler(expired)
+
+    def send(self, data, addr):
+        if self.trace is not None:
+            self.trace.tx(addr, data)
+        return self.socket_down.sendto(data, addr)
+
+    def receive(self, msg, addr, rx_time=None):
         self.incr(SOCK_RX_CNT)
+        if self.trace is not None:
+            self.trace.rx(addr, msg)
         version, = struct.unpack('=B',msg[0])
         if version not in VERSIONS:
-             logger.warning("received bad version %d" % version)
+             logger.warning("received bad version %d", version)
              return
 
         # Get mesage header
-        try:
-            _token, cmd, _mac = struct.unpack('<HBQ', msg[1:12])
-        except:
-            logger.warning("message size %d is too small" % len(msg))
+        if len(msg) < 12:
+            logger.warning("message size %d is too small", len(msg))
             return
+        _token, cmd = struct.unpack('<HB', msg[1:4])
+        gateway = self.get_gateway(msg[4:12])
 
         # Process message 
         if cmd == PUSH_DATA:
-            self.push_dest_addr = addr
-            self.push_data(msg, version)
+            gateway.push_dest_addr = addr
+            self.push_data(msg, version, gateway, rx_time)
         elif cmd == PULL_DATA:
-            self.pull_dest_addr = addr
-            self.pull_data(msg)
+            gateway.pull_dest_addr = addr
+            self.pull_data(msg, gateway)
         elif cmd == TX_ACK:
-            self.tx_ack(msg)
+            self.tx_ack(msg, gateway)
         else:
-            logger.debug("unhandled message command=%d" % cmd)
+            logger.debug("unhandled message command=%d", cmd)
 
-    def push_data(self, msg, version):
-        # Parse JSON message
-        try:
-            data = json.loads(msg[12:])
-        except:
-            logger.error("push_data JSON decode error")
-            return
+    def push_data(self, msg, version, gateway, rx_time=None):
+        # Gateway status reports carry no rxpk and are acknowledged without parsing them
+        if msg.find('"rxpk"', 12) < 0:
+            rxpk = None
+            self.incr(STAT_ONLY_CNT)
+        else:
+            # Parse JSON message
+            start = time.time()
+            try:
+                rxpk = json_loads(msg[12:]).get('rxpk', None)
+            except:
+                logger.error("push_data JSON decode error")
+                return
+            JSON_DECODE_HIST.observe(time.time() - start)
 
         self.incr(PUSH_DATA_CNT) 
+        gateway.incr(PUSH_DATA_CNT)
         # Send ack
         ack = msg[:3] + struct.pack('B', PUSH_ACK)
-        self.socket_down.sendto(ack, self.push_dest_addr)
-        # logger.debug("push_ack address=%s:%d" %(self.push_dest_addr[0], self.push_dest_addr[1]))
+        self.send(ack, gateway.push_dest_addr)
+        # logger.debug("push_ack address=%s:%d" %(gateway.push_dest_addr[0], gateway.push_dest_addr[1]))
 
         # process packets
-        rxpk = data.get('rxpk', None)
         if rxpk is not None:
+            pkts = []
             for pkt in rxpk:
-                pkt = RxPacket(version, pkt)
+                pkt = RxPacket(version, pkt, gateway, rx_time)
                 if pkt.valid == False:
-                    logger.debug("invalid rxpk: %s" % rxpk)
+                    logger.debug("invalid rxpk: %s", rxpk)
                     continue
                 if logger.isEnabledFor(logging.DEBUG):
-                    logger.debug("rxpk: %s" % pkt.rxpk)
+                    logger.debug("rxpk: %s", pkt.rxpk)
                 if (self.discard_mtypes == None) or (pkt.get_MType() not in self.discard_mtypes):
-                    self.rx_handler(pkt)
+                    pkts.append(pkt)
+            self.accept_packets(pkts, rx_time)
+
+    def accept_packets(self, pkts, rx_time):
+        """ Valid packets of a PUSH_DATA, held by the dedup cache or handled right away """
+        if self.dedup is None:
+            self.handle_packets(pkts)
+            return
+        now = rx_time if rx_time is not None else clock()
+        for pkt in pkts:
+            if not self.dedup.add(pkt, now):
+                self.incr(DUPLICATE_CNT)
+
+    def handle_packets(self, pkts):
+        """ Packets of one PUSH_DATA or released by the dedup cache, handed over in one call 
+            when rx_batch_handler is set """
+        if pkts and pkts[0].rx_time is not None:
+            RECEIVE_HIST.observe(clock() - pkts[0].rx_time, len(pkts))
+        if self.rx_batch_handler is not None:
+            if pkts:
+                self.rx_batch_handler(pkts)
+        else:
+            for pkt in pkts:
+                self.rx_handler(pkt)
 
-    def pull_data(self, msg):
+    def pull_data(self, msg, gateway):
+        gateway.incr(PULL_DATA_CNT)
         ack = msg[:3] + struct.pack('B', PULL_ACK)
-        self.socket_down.sendto(ack, self.pull_dest_addr)
-        # logger.debug("pull_ack address=%s:%d" %(self.pull_dest_addr[0], self.pull_dest_addr[1]))
+        self.send(ack, gateway.pull_dest_addr)
+        # logger.debug("pull_ack address=%s:%d" %(gateway.pull_dest_addr[0], gateway.pull_dest_addr[1]))
 
-    def tx_ack(self, msg):
+    def tx_ack(self, msg, gateway):
+        gateway.incr(TX_ACK_CNT)
+        token, = struct.unpack('<H', msg[1:3])
         status = 'None'
         # Check for downlink status indication 
         try:
-            data = json.loads(msg[12:])
+            data = json_loads(msg[12:])
             txpk_ack = data.get("txpk_ack", None)
             if txpk_ack:
                 status = txpk_ack['error']
         except:
             pass
+        self.downlink_ack(gateway, token, status)
 
-        logger.debug("downlink status=%s" % status) 
-         
+    def downlink_ack(self, gateway, token, status):
+        """ Match a TX_ACK with its PULL_RESP, rejected downlinks are sent again on their
+            next rx window when the gateway error allows it """
+        pending = gateway.outstanding.pop(token)
+        if pending is not None:
+            TX_ACK_HIST.observe(clock() - pending.sent_time)
+        if status not in ['None', 'NONE']:
+            self.incr(TX_ACK_ERROR_CNT)
+            if status == 'TOO_LATE':
+                self.incr(LATE_DOWNLINK_CNT)
+            if pending is not None and status in RETRY_TX_ACK_ERRORS:
+                self.retry_downlink(pending, status)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("gateway=%s token=%d downlink status=%s", gateway.eui, token, status)
 
-    def transmit(self, frame, tmst, rxconf, push_pkt):
-        # base64 encode frame and strip that damn invalid newline character that python adds for giggles!!
-        b64_data = frame.encode("base64").rstrip()
+    def retry_downlink(self, pending, status):
+        push_pkt = pending.push_pkt
+        push_pkt.gateway.scheduler.cancel(pending.txtmst)
+        window = self.schedule_downlink(push_pkt, pending.retry_windows, len(pending.frame))
+        if window is None:
+            logger.warning("gateway=%s downlink tmst=%d rejected status=%s, no retry window",
+                           push_pkt.gateway.eui, pending.txtmst, status)
+            sent = False
+        else:
+            rxslot, rxconf, txtmst = window
+            logger.info("gateway=%s downlink tmst=%d rejected status=%s, retry on RX%d",
+                        push_pkt.gateway.eui, pending.txtmst, status, rxslot)
+            self.incr(DOWNLINK_RETRY_CNT)
+            sent = self.transmit(pending.frame, txtmst, rxconf, push_pkt, (), pending.context)
+        if self.retry_handler is not None:
+            self.retry_handler(pending.context, window if sent else None)
+        return sent
+
+    def expire_tx_acks(self, now):
+        deadline = now - self.tx_ack_timeout
+        for gateway in self.gateways.values():
+            for pending in gateway.outstanding.expire(deadline):
+                self.incr(TX_ACK_TIMEOUT_CNT)
+
+    def schedule_downlink(self, push_pkt, windows, size):
+        """ windows: candidate (rxslot, rxconf, txtmst) in order of preference.
+            Returns the first window still reachable with the gateway radio free, booked
+            on the gateway scheduler, or None when the downlink is lost """
+        gateway = push_pkt.gateway
+        scheduler = gateway.scheduler
+        now_tmst = push_pkt.gateway_tmst()
+        if now_tmst is not None:
+            scheduler.expire(now_tmst)
+        lost = None
+        for i, window in enumerate(windows):
+            _rxslot, rxconf, txtmst = window
+            if rxconf is None:
+                continue
+            if not scheduler.reachable(txtmst, now_tmst):
+                lost = lost or DOWNLINK_LOST_LATE_CNT
+                continue
+            airtime = downlink.time_on_air_us(self.region.dr2sf(rxconf.dr), size, self.region.coderate)
+            if not scheduler.available(txtmst, airtime):
+                lost = lost or DOWNLINK_LOST_COLLISION_CNT
+                continue
+            scheduler.book(txtmst, airtime)
+            if i > 0:
+                self.incr(DOWNLINK_SAVED_CNT)
+                gateway.incr(DOWNLINK_SAVED_CNT)
+            return window
+        lost = lost or DOWNLINK_LOST_LATE_CNT
+        self.incr(lost)
+        gateway.incr(lost)
+        return None
 
+    def cancel_downlink(self, push_pkt, window):
+        """ Free the gateway radio booked by schedule_downlink for a downlink not sent """
+        push_pkt.gateway.scheduler.cancel(window[2])
+
+    def transmit(self, frame, tmst, rxconf, push_pkt, retry_windows=(), context=None):
+        """ Send frame in a PULL_RESP through the gateway of push_pkt. Until the TX_ACK
+            the downlink is kept for a retry on retry_windows, reported to retry_handler
+            with context """
+        gateway = push_pkt.gateway
         token = push_pkt.next_pull_response_token()
         tx_hdr = struct.pack('<BHB', push_pkt.version, token, PULL_RESP)
-        tx_json = {}
-        tx_json['freq'] = rxconf.freq
-        tx_json['datr'] = self.region.dr2sf(rxconf.dr)
-        tx_json['codr'] = self.region.coderate
-        tx_json['tmst'] = tmst
-        tx_json['modu'] ='LORA'
-        tx_json['ipol'] ='true'
-        tx_json['rfch'] = 0 
-        tx_json['ant']  = 0
-        tx_json['powe'] = 20
-        tx_json['data'] = b64_data
-        tx_json['size'] = len(frame)
-
-        tx_json_s = json.dumps({'txpk':tx_json})
+        tx_json_s = gateway.txpk_template % (tmst, repr(rxconf.freq), self.region.dr2sf(rxconf.dr), len(frame),
+                                             binascii.b2a_base64(frame)[:-1])
         tx_msg  = tx_hdr + tx_json_s 
-        if self.pull_dest_addr is not None:
+        if gateway.pull_dest_addr is not None:
             self.incr(PULL_RESP_CNT) 
+            gateway.incr(PULL_RESP_CNT)
             msg_bytes = len(tx_msg)
-            bytes_sent = self.socket_down.sendto(tx_msg, self.pull_dest_addr)
+            start = time.time()
+            bytes_sent = self.send(tx_msg, gateway.pull_dest_addr)
+            SENDTO_HIST.observe(time.time() - start)
             if bytes_sent != msg_bytes: 
-                logger.error("socket sendto %s:%d bytes sent=%d != msg size=%d" % (self.pull_dest_addr[0], self.pull_dest_addr[1], bytes_sent, msg_bytes))
+                gateway.scheduler.cancel(tmst)
+                logger.error("socket sendto %s:%d bytes sent=%d != msg size=%d",
+                             gateway.pull_dest_addr[0], gateway.pull_dest_addr[1], bytes_sent, msg_bytes)
                 return False
             elif logger.isEnabledFor(logging.DEBUG):
-                logger.debug("txpk=%s" %  tx_json_s)
+                logger.debug("gateway=%s txpk=%s", gateway.eui, tx_json_s)
+            # protocol version 1 packet forwarders do not send TX_ACK
+            if push_pkt.version > 1:
+                now = clock()
+                if now >= self.next_tx_ack_expiry:
+                    self.expire_tx_acks(now)
+                    self.next_tx_ack_expiry = now + self.tx_ack_timeout / 2
+                gateway.outstanding.add(downlink.PendingDownlink(token, frame, tmst, push_pkt, retry_windows, now, context))
             return True 
         else: # no client address condition can occur if pull response occurs before client's first pull request
-            logger.warning("pull response client address not set") 
-            return False
\ No newline at end of file
+            logger.warning("gateway=%s pull response client address not set", gateway.eui) 
+            gateway.scheduler.cancel(tmst)
+            return False
+
+class ShardedServer(Server):
+    """ Dispatcher owning the socket, received packets are routed to one of nb_workers 
+        worker processes by shard_fn(pkt). Workers are forked and send their downlinks 
+        through the inherited socket, TX_ACKs are routed back to the worker owning the
+        PULL_RESP token. """
+    def __init__(self, server_host, server_port, region_name, nb_workers, shard_fn, worker_init=None,
+                 discard_mtypes=None, worker_queue_size=WORKER_QUEUE_SIZE_DEFAULT, rcvbuf=0, sndbuf=0):
+        Server.__init__(self, server_host, server_port, region_name, discard_mtypes, rcvbuf, sndbuf)
+        self.counter[SHARD_DROP_CNT] = 0
+        self.nb_workers = nb_workers
+        self.shard_fn = shard_fn
+        self.worker_init = worker_init
+        self.worker_queues = [multiprocessing.Queue(worker_queue_size) for i in range(0, nb_workers)]
+        self.workers = []
+
+    def run(self, rx_handler, queue_size=0):
+        self.start_workers(rx_handler)
+        Server.run(self, rx_handler, queue_size)
+
+    def start_workers(self, rx_handler):
+        for index in range(0, self.nb_workers):
+            worker = multiprocessing.Process(target=self.worker_loop, args=(index, rx_handler), name='pktfwdr-worker-%d' % index)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+        logger.info("started %d worker processes", self.nb_workers)
+
+    def handle_packets(self, pkts):
+        for pkt in pkts:
+            self.dispatch(pkt)
+
+    def dispatch(self, pkt):
+        index = self.shard_fn(pkt) % self.nb_workers
+        gateway = pkt.gateway
+        self.put_worker(index, (PUSH_DATA, pkt.version, gateway.mac, gateway.pull_dest_addr, pkt.rxpk, pkt.rx_time))
+
+    def downlink_ack(self, gateway, token, status):
+        self.put_worker(token % self.nb_workers, (TX_ACK, None, gateway.mac, gateway.pull_dest_addr, (token, status), None))
+
+    def put_worker(self, index, item):
+        try:
+            self.worker_queues[index].put_nowait(item)
+        except Queue.Full:
+            self.incr(SHARD_DROP_CNT)
+
+    def worker_loop(self, index, rx_handler):
+        # Runs in the worker process: gateway state is local to the worker and PULL_RESP
+        # tokens are interleaved so that workers never hand out the same token
+        self.rx_handler = rx_handler
+        self.gateways = {}
+        self.token_offset = index
+        self.token_step = self.nb_workers
+        # packets are deduplicated by the dispatcher
+        self.dedup = None
+        if self.trace is not None:
+            self.trace = self.trace.reopen(index)
+        if self.worker_init is not None:
+            self.worker_init(index, self.nb_workers)
+
+        queue = self.worker_queues[index]
+        while True:
+            try:
+                cmd, version, mac, pull_dest_addr, data, rx_time = queue.get(timeout=self.release_timeout())
+            except Queue.Empty:
+                self.release_packets()
+                continue
+            gateway = self.get_gateway(mac)
+            gateway.pull_dest_addr = pull_dest_addr
+            if cmd == TX_ACK:
+                Server.downlink_ack(self, gateway, *data)
+            else:
+                Server.handle_packets(self, [RxPacket(version, data, gateway, rx_time)])
+            self.release_packets()
+
+# ReusePortServer worker channel messages: a gateway datagram or an rxpk to handle
+FORWARD_DATAGRAM = 0
+FORWARD_RXPK = 1
+# kind, source host length, source port
+FORWARD_HEADER = struct.Struct('<BBH')
+
+class ReusePortServer(Server):
+    """ nb_workers processes, each receiving on its own SO_REUSEPORT socket bound to the
+        server port. The kernel spreads the datagrams across the sockets by source address,
+        so each worker receives the PUSH_DATA of some of the gateways. Their rxpk are then
+        routed to worker shard_fn(pkt) % nb_workers as in ShardedServer, so that the copies
+        of a frame heard by several gateways meet in the dedup cache and the device sessions
+        of that worker. PULL_DATA and TX_ACK come from the gateway down socket and may reach
+        another worker: pull addresses are broadcast to the other workers and TX_ACKs are
+        forwarded to the worker owning the PULL_RESP token. Workers exchange these over unix
+        datagram socket pairs, a message is dropped when the channel of a worker is full. """
+    def __init__(self, server_host, server_port, region_name, nb_workers, shard_fn, worker_init=None,
+                 discard_mtypes=None, rcvbuf=0, sndbuf=0):
+        Server.__init__(self, server_host, server_port, region_name, discard_mtypes, rcvbuf, sndbuf, reuseport=True)
+        self.counter[SHARD_DROP_CNT] = 0
+        self.nb_workers = nb_workers
+        self.shard_fn = shard_fn
+        self.worker_init = worker_init
+        self.sockets = [self.socket_up] + [udp_socket(server_host, self.local_port, rcvbuf, sndbuf, True)
+                                           for i in range(1, nb_workers)]
+        # worker i receives the forwarded messages on channels[i][0]
+        self.channels = [socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM) for i in range(0, nb_workers)]
+        for channel in self.channels:
+            channel[1].setblocking(False)
+        self.index = None
+        self.workers = []
+
+    def run(self, rx_handler, queue_size=0):
+        """ Serve from the worker processes, returns when one of them exits. queue_size is
+            not used: the socket receive buffers queue the datagrams of each worker """
+        logger.info("server accepting connections on %s:%d with %d SO_REUSEPORT sockets",
+                    self.server_host, self.local_port, self.nb_workers)
+        for index in range(0, self.nb_workers):
+            worker = multiprocessing.Process(target=self.worker_loop, args=(index, rx_handler), name='pktfwdr-worker-%d' % index)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+        while all(worker.is_alive() for worker in self.workers):
+            time.sleep(1)
+        logger.critical("worker process exited")
+
+    def bind_worker(self, index):
+        # worker state: PULL_RESP tokens are interleaved as in ShardedServer
+        self.index = index
+        self.gateways = {}
+        self.token_offset = index
+        self.token_step = self.nb_workers
+        self.socket_up = self.socket_down = self.sockets[index]
+        if self.trace is not None:
+            self.trace = self.trace.reopen(index)
+
+    def worker_loop(self, index, rx_handler):
+        self.rx_handler = rx_handler
+        self.bind_worker(index)
+        if self.worker_init is not None:
+            self.worker_init(index, self.nb_workers)
+
+        channel = self.channels[index][0]
+        while True:
+            try:
+                readable = select.select([self.socket_up, channel], [], [], self.release_timeout())[0]
+                if self.socket_up in readable:
+                    msg, addr = self.socket_up.recvfrom(1024)
+                    self.receive(msg, addr, clock())
+                if channel in readable:
+                    self.forwarded(channel.recv(2048))
+            except (socket.error, select.error) as e:
+                if e.args[0] != errno.EINTR:
+                    logger.critical("Error receving from socket:  %s", e)
+                    sys.exit(1)
+            self.release_packets()
+
+    def forward(self, index, kind, data, addr):
+        """ Hand a message and a gateway address over to worker index """
+        host, port = (addr[0], addr[1]) if addr is not None else ('', 0)
+        try:
+            self.channels[index][1].send(FORWARD_HEADER.pack(kind, len(host), port) + host + data)
+        except socket.error as e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+            self.incr(SHARD_DROP_CNT)
+
+    def forwarded(self, data):
+        kind, length, port = FORWARD_HEADER.unpack_from(data)
+        start = FORWARD_HEADER.size
+        addr = (data[start:start + length], port) if length else None
+        msg = data[start + length:]
+        if kind == FORWARD_RXPK:
+            version, mac, rxpk, rx_time = marshal.loads(msg)
+            gateway = self.get_gateway(mac)
+            if addr is not None:
+                gateway.pull_dest_addr = addr
+            Server.accept_packets(self, [RxPacket(version, rxpk, gateway, rx_time)], rx_time)
+            return
+        cmd = ord(msg[3])
+        gateway = self.get_gateway(msg[4:12])
+        if cmd == PULL_DATA:
+            gateway.pull_dest_addr = addr
+        elif cmd == TX_ACK:
+            Server.tx_ack(self, msg, gateway)
+
+    def accept_packets(self, pkts, rx_time):
+        local = []
+        for pkt in pkts:
+            index = self.shard_fn(pkt) % self.nb_workers
+            if index == self.index:
+                local.append(pkt)
+            else:
+                gateway = pkt.gateway
+                self.forward(index, FORWARD_RXPK, marshal.dumps((pkt.version, gateway.mac, pkt.rxpk, pkt.rx_time)),
+                             gateway.pull_dest_addr)
+        if local:
+            Server.accept_packets(self, local, rx_time)
+
+    def pull_data(self, msg, gateway):
+        Server.pull_data(self, msg, gateway)
+        for index in range(0, self.nb_workers):
+            if index != self.index:
+                self.forward(index, FORWARD_DATAGRAM, msg[:12], gateway.pull_dest_addr)
+
+    def tx_ack(self, msg, gateway):
+        token, = struct.unpack('<H', msg[1:3])
+        index = token % self.nb_workers
+        if index != self.index:
+            # the source address is not used for TX_ACKs
+            self.forward(index, FORWARD_DATAGRAM, msg, None)
+            return
+        Server.tx_ack(self, msg, gateway)
@@ -1,14 +1,77 @@
+""" LoRaWAN regional parameters.
+
+    Regions are described by data (REGIONS) and compiled into lookup tables when
+    the Region is created: the datr string of an uplink maps to its DR, the
+    rxpk frequency to Hz, and channel_key(frequency in Hz, DR) to an Uplink,
+    the channel number and the RX1 RxConf for each RX1DROffset.
+"""
 from collections import namedtuple
 import logging
 
 logger = logging.getLogger('harness.lwregion')
 
 RxConf = namedtuple('RxConf', ['freq', 'dr'])
-
-def get_us915_region():
-    return US915Region()
-
-SUPPORTED = {'US915': get_us915_region}
+Uplink = namedtuple('Uplink', ['channel', 'dr', 'rx1'])
+
+def mhz2hz(freq_mhz):
+    return int(round(freq_mhz * 1000000))
+
+def hz2mhz(freq_hz):
+    return freq_hz / 1000000.0
+
+def channel_key(freq_hz, dr):
+    return freq_hz << 4 | dr
+
+def rx1_dr_table(nb_drs, offsets, min_dr, max_dr):
+    """ RX1 DR = upstream DR - offset, clamped to [min_dr, max_dr] """
+    return [[min(max_dr, max(min_dr, dr - offset)) for offset in offsets] for dr in range(0, nb_drs)]
+
+# datarates:       datr of each DR, None for RFU and FSK
+# uplink_channels: (first frequency Hz, spacing Hz, count, uplink DRs) blocks, channels numbered in block order
+# rx1_channels:    (first frequency Hz, spacing Hz, count), RX1 on channel % count, None for RX1 on the uplink frequency
+# rx1_dr:          RX1 DR by uplink DR and RX1DROffset
+# rx2:             (frequency Hz, DR)
+REGIONS = {
+    'US915': {
+        'coderate': '4/5',
+        'datarates': ["SF10BW125", "SF9BW125", "SF8BW125", "SF7BW125", "SF8BW500", None, None, None,
+                      "SF12BW500", "SF11BW500", "SF10BW500", "SF9BW500", "SF8BW500", "SF7BW500"],
+        'uplink_channels': [(902300000, 200000, 64, [0, 1, 2, 3]), (903000000, 1600000, 8, [4])],
+        'rx1_channels': (923300000, 600000, 8),
+        'rx1_dr': [[10, 9, 8, 8], [11, 10, 9, 8], [12, 11, 10, 9], [13, 12, 11, 10], [13, 13, 12, 11]],
+        'rx2': (923300000, 8),
+    },
+    'AU915': {
+        'coderate': '4/5',
+        'datarates': ["SF12BW125", "SF11BW125", "SF10BW125", "SF9BW125", "SF8BW125", "SF7BW125", "SF8BW500", None,
+                      "SF12BW500", "SF11BW500", "SF10BW500", "SF9BW500", "SF8BW500", "SF7BW500"],
+        'uplink_channels': [(915200000, 200000, 64, [0, 1, 2, 3, 4, 5]), (915900000, 1600000, 8, [6])],
+        'rx1_channels': (923300000, 600000, 8),
+        'rx1_dr': [[8, 8, 8, 8, 8, 8], [9, 8, 8, 8, 8, 8], [10, 9, 8, 8, 8, 8], [11, 10, 9, 8, 8, 8],
+                   [12, 11, 10, 9, 8, 8], [13, 12, 11, 10, 9, 8], [13, 13, 12, 11, 10, 9]],
+        'rx2': (923300000, 8),
+    },
+    'EU868': {
+        'coderate': '4/5',
+        'datarates': ["SF12BW125", "SF11BW125", "SF10BW125", "SF9BW125", "SF8BW125", "SF7BW125", "SF7BW250", None],
+        # default join channels then the usual network channels
+        'uplink_channels': [(868100000, 200000, 3, [0, 1, 2, 3, 4, 5]), (867100000, 200000, 5, [0, 1, 2, 3, 4, 5])],
+        'rx1_channels': None,
+        'rx1_dr': rx1_dr_table(7, [0, 1, 2, 3, 4, 5], 0, 7),
+        'rx2': (869525000, 0),
+    },
+    'AS923': {
+        'coderate': '4/5',
+        'datarates': ["SF12BW125", "SF11BW125", "SF10BW125", "SF9BW125", "SF8BW125", "SF7BW125", "SF7BW250", None],
+        'uplink_channels': [(923200000, 200000, 2, [0, 1, 2, 3, 4, 5]), (922000000, 200000, 6, [0, 1, 2, 3, 4, 5])],
+        'rx1_channels': None,
+        # DownlinkDwellTime 0, offsets 6 and 7 raise the DR
+        'rx1_dr': rx1_dr_table(7, [0, 1, 2, 3, 4, 5, -1, -2], 0, 5),
+        'rx2': (923200000, 2),
+    },
+}
+
+SUPPORTED = sorted(REGIONS)
 
 class Region(object):
     INVALID_FREQ = -1
@@ -16,74 +79,81 @@ class Region(object):
     JOIN_RX1_DELAY = 5
     JOIN_RX2_DELAY = 6
 
-    def __init__(self, region_name, coderate, rx1freqs, rx1_dr_offset, rx2conf, dr2sf, sf2txdr):
-        self.region = SUPPORTED.get(region_name,None)
-        assert self.region != None, "Unknown Region %s " % region_name
-        self.rx2conf = rx2conf
-        self.rx1freqs = rx1freqs
-        self.rx1_dr_offset = rx1_dr_offset
-        self.nb_rx1freqs = len(rx1freqs)
-        self.dr2sf_table = dr2sf
-        self.sf2txdr_map = sf2txdr
-        self.coderate = coderate 
-
-        # SF to DR map
-        self.sf2dr_map = {}
-        for i in range(0, len(dr2sf)):
-            self.sf2dr_map[dr2sf[i]] = i
+    def __init__(self, region_name, params=None):
+        params = params if params is not None else REGIONS.get(region_name, None)
+        assert params != None, "Unknown Region %s " % region_name
+        self.name = region_name
+        self.coderate = params['coderate']
+        self.dr2sf_table = params['datarates']
+        self.rx2conf = RxConf(freq=hz2mhz(params['rx2'][0]), dr=params['rx2'][1])
+        # channel_key(freq_hz, dr) -> Uplink
+        self.uplinks = {}
+        # uplink datr -> DR, rxpk frequency in MHz -> Hz
+        self.sf2txdr_map = {}
+        self.freq_hz = {}
+
+        rx1_channels = params['rx1_channels']
+        channel = 0
+        for first_hz, step_hz, count, drs in params['uplink_channels']:
+            for i in range(0, count):
+                freq_hz = first_hz + i * step_hz
+                if rx1_channels is None:
+                    rx1_freq = hz2mhz(freq_hz)
+                else:
+                    rx1_freq = hz2mhz(rx1_channels[0] + (channel % rx1_channels[2]) * rx1_channels[1])
+                self.freq_hz[hz2mhz(freq_hz)] = freq_hz
+                for dr in drs:
+                    rx1 = tuple(RxConf(freq=rx1_freq, dr=rx_dr) for rx_dr in params['rx1_dr'][dr])
+                    self.uplinks[channel_key(freq_hz, dr)] = Uplink(channel=channel, dr=dr, rx1=rx1)
+                    self.sf2txdr_map[self.dr2sf_table[dr]] = dr
+                channel += 1
+        self.nb_channels = channel
+
+    def get_uplink(self, freq_mhz, datarate):
+        """ Uplink of a frequency and DR, None when the region has no such channel """
+        if datarate is None:
+            return None
+        freq_hz = self.freq_hz.get(freq_mhz, None)
+        if freq_hz is None:
+            freq_hz = mhz2hz(freq_mhz)
+        return self.uplinks.get(freq_hz << 4 | datarate, None)
+
+    def lookup(self, freq_mhz, datr):
+        """ Uplink of an rxpk freq and datr, None when the region has no such channel """
+        # get_uplink inlined, this is the per join-request path
+        datarate = self.sf2txdr_map.get(datr, None)
+        if datarate is None:
+            return None
+        freq_hz = self.freq_hz.get(freq_mhz, None)
+        if freq_hz is None:
+            freq_hz = mhz2hz(freq_mhz)
+        return self.uplinks.get(freq_hz << 4 | datarate, None)
 
     def get_rx1_conf(self, tx_freq, tx_dr, rx1_dr_offset=0):
-        try:
-          chnl = self.tx_channel(tx_freq, tx_dr) % self.nb_rx1freqs 
-          rx_dr = self.rx1_dr_offset[tx_dr][rx1_dr_offset]
-          freq  = self.rx1freqs[chnl]
-          return RxConf(freq=freq, dr=rx_dr)
-        except:
+        uplink = self.get_uplink(tx_freq, tx_dr)
+        if uplink is None or rx1_dr_offset >= len(uplink.rx1):
             logger.error("REGION: get_rx1_config failed")
-            return None 
+            return None
+        return uplink.rx1[rx1_dr_offset]
 
     def get_rx2_conf(self):
         return self.rx2conf
 
     def dr2sf(self, dr):
-        try:
+        if 0 <= dr < len(self.dr2sf_table):
             return self.dr2sf_table[dr]
-        except:
-            return None
-
-    def sf2txdr(self, sf):
-        try:
-            return self.sf2txdr_map[sf]
-        except:
-             return 
-      
-    def tx_channel(self, freq_mhz, datarate):
-        """ To be implemented by the region """
         return None
 
-class US915Region(Region):
-    def __init__(self):
-        dr2sf = ["SF10BW125", "SF9BW125", "SF8BW125", "SF7BW125", "SF8BW500",
-                 None,None,None,
-                 "SF12BW500", "SF11BW500","SF10BW500","SF9BW500", "SF8BW500", "SF7BW500"]
-
-        sf2txdr = {"SF10BW125":0, "SF9BW125":1, "SF8BW125":2, "SF7BW125":3, "SF8BW500":4}
-
-        rx1_dr_offset =[[10,9,8,8], [11,10,9,8], [12,11,10,9], [13,12,11,10], [13,13,12,11]]
-        rx1_freqs = [ round(923.3 + (i *.6), 2) for i in range(0, 8)]
-        Region.__init__(self, 'US915', '4/5', rx1_freqs, rx1_dr_offset, RxConf(freq=923.3,dr=8), dr2sf, sf2txdr)
+    def sf2txdr(self, sf):
+        return self.sf2txdr_map.get(sf, None)
 
     def tx_channel(self, freq_mhz, datarate):
-        if datarate in [0,1,2,3]:
-            return int((freq_mhz  - 902.3) / .2) 
-        elif datarate == 4:
-            return 64 + int((freq_mhz  - 903.0) / 1.6) 
-        else:
-            return None
-       
+        """ Uplink channel number, None when the region has no such channel at datarate """
+        uplink = self.get_uplink(freq_mhz, datarate)
+        return uplink.channel if uplink is not None else None
 
 def get(region_name):
-    if region_name in SUPPORTED:
-        return SUPPORTED[region_name]()
+    if region_name in REGIONS:
+        return Region(region_name)
     else:
-        return None
\ No newline at end of file
+        return None
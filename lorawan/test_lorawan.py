@@ -2,7 +2,29 @@ import unittest
 import crypto
 import packet
 import region
+import packet_forwarder_server
+import devicestore
+import logqueue
+import metrics
+import loadgen
+import downlink
+import dedup
+import capture
+import timerwheel
+import confwatch
+import devaddrpool
 import binascii
+import socket
+import struct
+import time
+import os
+import sys
+import shutil
+import tempfile
+import logging
+import Queue
+import json
+import zlib
 
 class TestLoRaWAN(unittest.TestCase):
 
@@ -30,6 +52,246 @@ class TestLoRaWAN(unittest.TestCase):
         key  = binascii.unhexlify('00112233445566778899AABBCCDDEEFF')
         crypto.aes128_decrypt(data, key)
 
+    def test_key_context(self):
+        key = binascii.unhexlify('2b7e151628aed2a6abf7158809cf4f3c')
+        ctx = crypto.key_context(key)
+        self.assertTrue(crypto.key_context(key) is ctx)
+        data = binascii.unhexlify('6bc1bee22e409f96e93d7e117393172aae2d8a571e03ac9c9eb76fac45af8e51')
+        self.assertTrue(crypto.aes_cmac_ctx(data, ctx) == crypto.aes_cmac(data, key))
+        self.assertTrue(crypto.aes128_encrypt_ctx(data, ctx) == crypto.aes128_encrypt(data, key))
+        self.assertTrue(crypto.aes128_decrypt_ctx(data, ctx) == crypto.aes128_decrypt(data, key))
+        self.assertTrue(crypto.compute_uplink_mic_ctx(data, ctx, 0x01020304, 7) == crypto.compute_uplink_mic(data, key, 0x01020304, 7))
+        self.assertTrue(crypto.compute_nwk_skey_ctx(0x123456, 0x13, 0x4567, ctx) == crypto.compute_nwk_skey(0x123456, 0x13, 0x4567, key))
+        self.assertTrue(crypto.compute_app_skey_ctx(0x123456, 0x13, 0x4567, ctx) == crypto.compute_app_skey(0x123456, 0x13, 0x4567, key))
+        self.assertTrue(packet.encode_join_accept_frame(ctx, 0x123456, 0x13, 0x01020304) == 
+                        packet.encode_join_accept_frame(key, 0x123456, 0x13, 0x01020304))
+
+    def test_key_context_cache_bound(self):
+        cache = crypto.KeyContextCache(8)
+        keys = [struct.pack('>QQ', 0, i) for i in range(0, 100)]
+        for key in keys:
+            cache.get(key)
+            self.assertTrue(len(cache) <= 8)
+        # recently used keys are retained
+        ctx = cache.get(keys[-1])
+        self.assertTrue(cache.get(keys[-1]) is ctx)
+
+    def test_batch_crypto(self):
+        import array
+        keys = [struct.pack('>QQ', i, i * 7) for i in range(0, 5)]
+        nonces = [(0x010203 + i, 0x13, 0x4000 + i) for i in range(0, 5)]
+        packed = ''.join(crypto.pack_session_nonce(*nonce) for nonce in nonces)
+        nwkskeys = crypto.compute_nwk_skey_batch(array.array('B', ''.join(keys)), memoryview(packed))
+        for i in range(0, 5):
+            self.assertTrue(nwkskeys[i * 16:(i + 1) * 16] == crypto.compute_nwk_skey(nonces[i][0], nonces[i][1], nonces[i][2], keys[i]))
+
+        frames = [('\x40' + struct.pack('<IBH', 0x100 + i, 0, i)) + '\x01' * i for i in range(0, 5)]
+        params = ''.join(crypto.pack_uplink_mic_param(len(frames[i]), 0x100 + i, i) for i in range(0, 5))
+        mics = struct.unpack('<5I', crypto.compute_uplink_mic_batch(''.join(frames), params, nwkskeys))
+        for i in range(0, 5):
+            self.assertTrue(mics[i] == crypto.compute_uplink_mic(frames[i], nwkskeys[i * 16:(i + 1) * 16], 0x100 + i, i))
+
+        macpayloads = ''.join(packet.encode_join_accept_macpayload(0x123456 + i, 0x13, 0x200 + i) for i in range(0, 5))
+        jaccs = crypto.encode_join_accept_batch(''.join(keys), macpayloads)
+        size = crypto.JOIN_ACCEPT_FRAME_SIZE
+        for i in range(0, 5):
+            self.assertTrue(jaccs[i * size:(i + 1) * size] == packet.encode_join_accept_frame(keys[i], 0x123456 + i, 0x13, 0x200 + i))
+
+        self.assertRaises(ValueError, crypto.compute_nwk_skey_batch, ''.join(keys), packed[:-1])
+
+    def test_crypto_backends(self):
+        import crypto_ctypes
+        key = binascii.unhexlify('00112233445566778899AABBCCDDEEFF')
+        buf = binascii.unhexlify('00efbe0100000c250003030000010c25008e4a')
+        ctx = crypto.key_context(key)
+        self.assertTrue(crypto.aes_cmac(buf, key) == crypto_ctypes.aes_cmac(buf, key))
+        self.assertTrue(crypto.aes128_encrypt(buf[:16], key) == crypto_ctypes.aes128_encrypt(buf[:16], key))
+        self.assertTrue(crypto.compute_app_skey_ctx(1, 2, 3, ctx) == crypto_ctypes.compute_app_skey(1, 2, 3, key))
+        self.assertTrue(crypto.compute_uplink_mic_ctx(buf, ctx, 0x1234, 5) == crypto_ctypes.compute_uplink_mic(buf, key, 0x1234, 5))
+        self.assertRaises(ValueError, crypto.KeyContext, key[:15])
+
+    def test_device_store(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            device_file = os.path.join(tmpdir, '70B3D57ED0000001.csv')
+            with open(device_file, 'w') as f:
+                f.write('DEVEUI,APPKEY\n')
+                for i in [3, 1, 2]:
+                    f.write(' %016X , %032X\n' % (i, i * 0x11))
+            store, errors = devicestore.load(device_file)
+            self.assertTrue(errors == [] and len(store) == 3)
+            self.assertTrue(os.path.exists(devicestore.store_path(device_file)))
+            self.assertTrue([deveui for deveui, _ in store] == [struct.pack('>Q', i) for i in [1, 2, 3]])
+            store = devicestore.open_store(devicestore.store_path(device_file))
+            self.assertTrue(store.get(struct.pack('>Q', 2)) == struct.pack('>QQ', 0, 0x22))
+            self.assertTrue(store.find(struct.pack('>Q', 4)) == -1)
+            store.close()
+
+            with open(device_file, 'w') as f:
+                f.write('DEVEUI,APPKEY\n0000000000000001,%032X\nZZ00000000000002,%032X\n0000000000000003\n' % (1, 2))
+                f.write('0000000000000004,0011\n0000000000000001,%032X\n' % 5)
+            store, errors = devicestore.load(device_file)
+            self.assertTrue(store is None)
+            self.assertTrue(len(errors) == 3 and 'entry=2' in errors[0] and 'row 3' in errors[1] and 'entry=4' in errors[2])
+
+            with open(device_file, 'w') as f:
+                f.write('DEVEUI,APPKEY\n0000000000000001,%032X\n0000000000000001,%032X\n' % (1, 2))
+            store, errors = devicestore.load(device_file)
+            self.assertTrue(store is None and len(errors) == 1 and 'Duplicate' in errors[0])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_conf_watch(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            def write_devices(name, devices):
+                with open(os.path.join(tmpdir, name), 'w') as f:
+                    f.write('DEVEUI,APPKEY\n')
+                    for deveui, appkey in devices:
+                        f.write('%016X,%032X\n' % (deveui, appkey))
+            write_devices('0000000000000001.csv', [(1, 1), (2, 2), (3, 3)])
+            events = []
+            watcher = confwatch.DirectoryWatcher(tmpdir, '*.csv', lambda changed, removed: events.append((changed, removed)))
+            old, _ = devicestore.load(os.path.join(tmpdir, '0000000000000001.csv'))
+            watcher.check()
+            self.assertTrue(events == [])
+
+            write_devices('0000000000000001.csv', [(2, 2), (3, 0x33), (4, 4), (5, 5)])
+            write_devices('0000000000000002.csv', [(1, 1)])
+            watcher.check()
+            self.assertTrue(events == [([os.path.join(tmpdir, '0000000000000001.csv'), os.path.join(tmpdir, '0000000000000002.csv')], [])])
+            new, _ = devicestore.load(os.path.join(tmpdir, '0000000000000001.csv'))
+            added, removed, changed = devicestore.diff(old, new)
+            self.assertTrue(added == [struct.pack('>Q', 4), struct.pack('>Q', 5)])
+            self.assertTrue(removed == [struct.pack('>Q', 1)] and changed == [struct.pack('>Q', 3)])
+            self.assertTrue(devicestore.diff(new, new) == ([], [], []))
+
+            os.remove(os.path.join(tmpdir, '0000000000000002.csv'))
+            watcher.check()
+            self.assertTrue(events[-1] == ([], [os.path.join(tmpdir, '0000000000000002.csv')]))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_log_queue(self):
+        class Handler(logqueue.BatchStreamHandler):
+            def __init__(self):
+                logqueue.BatchStreamHandler.__init__(self)
+                self.messages = []
+                self.flushes = 0
+            def emit(self, record):
+                self.messages.append(self.format(record))
+            def flush_batch(self):
+                self.flushes += 1
+
+        queue = Queue.Queue()
+        handler = Handler()
+        log = logging.getLogger('harness.test_log_queue')
+        log.propagate = False
+        log.addHandler(logqueue.QueueHandler(queue, serialize=False))
+        for i in range(0, 10):
+            log.warning("message %d", i)
+        listener = logqueue.QueueListener(queue, handler, batch_size=4)
+        listener.start()
+        listener.stop()
+        self.assertTrue(handler.messages == ["message %d" % i for i in range(0, 10)])
+        self.assertTrue(handler.flushes == 3)
+
+    def test_results_csv(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'results.csv')
+            log = logging.getLogger('harness.test_results_csv')
+            log.propagate = False
+            for i in range(0, 2):
+                handler = logqueue.CsvHandler(path, ('deveui', 'state', 'rxslot', 'end_time'))
+                jsonl = logqueue.JsonLinesHandler(os.path.join(tmpdir, 'results.jsonl'))
+                log.addHandler(handler)
+                log.addHandler(jsonl)
+                log.warning('otaa_success', extra={'row': ('0000000000000001', 'otaa_success', None, 1760000000.123456)})
+                log.warning('join_request', extra={'result': {'event': 'join_request'}})
+                for h in [handler, jsonl]:
+                    log.removeHandler(h)
+                    h.flush_batch()
+                    h.close()
+            with open(path) as f:
+                lines = f.read().splitlines()
+            self.assertTrue(lines == ['deveui,state,rxslot,end_time'] + ['0000000000000001,otaa_success,,1760000000.123456'] * 2)
+            with open(os.path.join(tmpdir, 'results.jsonl')) as f:
+                self.assertTrue(len(f.read().splitlines()) == 2)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_metrics(self):
+        registry = metrics.Registry()
+        hist = registry.histogram('test_seconds', 'test', (0.001, 0.01))
+        self.assertTrue(registry.histogram('test_seconds', 'test') is hist)
+        for value in [0.0005, 0.001, 0.005, 0.5]:
+            hist.observe(value)
+        hist.observe(0.002, 2)
+        counter = {'drop': 3}
+        registry.add_counters('test', counter, {'gateway': 'AA'})
+        counter['drop'] += 1
+        text = registry.render()
+        for line in ['test_seconds_bucket{le="0.001"} 2', 'test_seconds_bucket{le="0.01"} 5', 
+                     'test_seconds_bucket{le="+Inf"} 6', 'test_seconds_count 6', 'test_drop{gateway="AA"} 4']:
+            self.assertTrue(line in text.splitlines())
+
+        import urllib2
+        server = metrics.start_http_server(0, metrics_registry=registry)
+        body = urllib2.urlopen('http://localhost:%d/metrics' % server.server_port, timeout=2).read()
+        # samples of another endpoint served again with a worker label
+        scrape = metrics.scrape_collector([('http://localhost:%d/metrics' % server.server_port, {'worker': '1'})])
+        samples = scrape()
+        server.shutdown()
+        server.server_close()
+        self.assertTrue(body == registry.render())
+        self.assertTrue(('test_drop', {'gateway': 'AA', 'worker': '1'}, '4') in samples)
+        self.assertTrue(('test_seconds_bucket', {'le': '+Inf', 'worker': '1'}, '6') in samples)
+        self.assertTrue(metrics.parse_samples('# HELP x y\nx_total 3\n') == [('x_total', {}, '3')])
+
+    def test_loadgen_frames(self):
+        appkey = binascii.unhexlify('00112233445566778899AABBCCDDEEFF')
+        frame = packet.encode_join_accept_frame(appkey, 0x123456, 0x13, 0x01020304)
+        self.assertTrue(loadgen.decode_join_accept(frame, appkey) == (0x123456, 0x13, 0x01020304))
+        self.assertTrue(loadgen.decode_join_accept(frame, appkey[::-1]) is None)
+
+        nwkskey = crypto.compute_nwk_skey(0x123456, 0x13, 7, appkey)
+        p = packet.Packet(loadgen.encode_uplink_frame(0x01020304, 3, nwkskey))
+        self.assertTrue(p.valid and p.DevAddr == 0x01020304 and p.FCnt == 3)
+        self.assertTrue(p.MIC == crypto.compute_uplink_mic(p.PHYPayload[:-4], nwkskey, 0x01020304, 3))
+
+        # rxpk tmst follow the clock, spaced by spacing_us within a burst and across the 32 bit wraparound
+        gateway = loadgen.SimGateway(0, ('localhost', 0), spacing_us=1000)
+        clock = [2414364568 / 1e6]
+        saved_time, loadgen.time.time = loadgen.time.time, lambda: clock[0]
+        try:
+            self.assertTrue([gateway.next_tmst() for i in range(0, 3)] == [2414364568, 2414365568, 2414366568])
+            clock[0] += 0.5
+            self.assertTrue(gateway.next_tmst() == 2414864568)
+            clock[0] = 0x1FFFFFFFE / 1e6
+            self.assertTrue(gateway.next_tmst() == 0xFFFFFFFE and gateway.next_tmst() == 998)
+        finally:
+            loadgen.time.time = saved_time
+            gateway.socket.close()
+        # join-accepts of a burst of join-requests do not collide, on RX1 or RX2
+        for region_name in region.SUPPORTED:
+            lw_region = region.get(region_name)
+            channels = loadgen.uplink_channels(region_name)
+            spacing = loadgen.join_accept_spacing_us(region_name, channels)
+            scheduler = downlink.DownlinkScheduler()
+            for i in range(0, 20):
+                uplink = lw_region.lookup(*channels[i % len(channels)])
+                windows = [(uplink.rx1[0], lw_region.JOIN_RX1_DELAY), (lw_region.get_rx2_conf(), lw_region.JOIN_RX2_DELAY)]
+                rxconf, delay = windows[i % 2]
+                txtmst = i * spacing + delay * 1000000
+                airtime = downlink.time_on_air_us(lw_region.dr2sf(rxconf.dr), crypto.JOIN_ACCEPT_FRAME_SIZE, lw_region.coderate)
+                self.assertTrue(scheduler.available(txtmst, airtime))
+                scheduler.book(txtmst, airtime)
+        for region_name in region.SUPPORTED:
+            lw_region = region.get(region_name)
+            channels = loadgen.uplink_channels(region_name)
+            self.assertTrue(channels and all(lw_region.lookup(freq, datr) is not None for freq, datr in channels))
+
     def test_lorawan_packet_join_request(self):
         PHYPayload = binascii.unhexlify('00efbe0100000c250003030000010c25008e4aa15c1e3c')
         p = packet.Packet(PHYPayload)
@@ -39,6 +301,23 @@ class TestLoRaWAN(unittest.TestCase):
         p = packet.Packet(PHYPayload)
         self.assertFalse(p.is_join_request())
 
+    def test_lorawan_packet_lazy_fields(self):
+        PHYPayload = binascii.unhexlify('00efbe0100000c250003030000010c25008e4aa15c1e3c')
+        p = packet.Packet(bytearray(PHYPayload))
+        self.assertFalse(hasattr(p, '__dict__'))
+        self.assertTrue(p.AppEui == binascii.unhexlify('00250c000001beef'))
+        self.assertTrue(p.get_DevEui() == binascii.unhexlify('00250c0100000303'))
+        self.assertTrue(p.DevNonce == 0x4a8e)
+        self.assertTrue(p.DevAddr is None)
+
+        PHYPayload = binascii.unhexlify('4004030201800a00016b9fa3c1')
+        p = packet.Packet(PHYPayload)
+        self.assertTrue((p.DevAddr, p.FCtrl, p.FCnt) == (0x01020304, 0x80, 10))
+        self.assertTrue(p.MIC == 0xc1a39f6b)
+        self.assertTrue(isinstance(p.PHYPayload, memoryview) and p.PHYPayload[:-4].tobytes() == PHYPayload[:-4])
+        self.assertTrue(p.DevEui is None)
+        self.assertFalse(packet.Packet(PHYPayload[:7]).valid)
+
     def test_lorawan_packet_join_accept(self):
         appkey = binascii.unhexlify('00112233445566778899AABBCCDDEEFF')
         expected = "2000a7a47881fd814024d3d420bacfa308"
@@ -86,5 +365,799 @@ class TestLoRaWAN(unittest.TestCase):
             sf = r.dr2sf(dr)
             self.assertTrue(sf == dr2sf[dr])
 
+    def test_region_tables(self):
+        # regional parameters formulas, channel plans on a 100kHz grid
+        def us915(freq, dr, offset):
+            n = int(round((freq - 902.3) / 0.2))
+            if dr in [0, 1, 2, 3] and 0 <= n < 64 and abs(902.3 + n * 0.2 - freq) < 1e-6:
+                channel = n
+            elif dr == 4 and 0 <= int(round((freq - 903.0) / 1.6)) < 8 and abs((freq - 903.0) / 1.6 - round((freq - 903.0) / 1.6)) < 1e-6:
+                channel = 64 + int(round((freq - 903.0) / 1.6))
+            else:
+                return None
+            return channel, round(923.3 + (channel % 8) * 0.6, 1), min(13, max(8, 10 + dr - offset))
+
+        def au915(freq, dr, offset):
+            n = int(round((freq - 915.2) / 0.2))
+            if 0 <= dr <= 5 and 0 <= n < 64 and abs(915.2 + n * 0.2 - freq) < 1e-6:
+                channel = n
+            elif dr == 6 and 0 <= int(round((freq - 915.9) / 1.6)) < 8 and abs((freq - 915.9) / 1.6 - round((freq - 915.9) / 1.6)) < 1e-6:
+                channel = 64 + int(round((freq - 915.9) / 1.6))
+            else:
+                return None
+            return channel, round(923.3 + (channel % 8) * 0.6, 1), min(13, max(8, 8 + dr - offset))
+
+        def plan(freqs, max_dr, offsets):
+            def formula(freq, dr, offset):
+                if not 0 <= dr <= 5 or round(freq, 1) not in freqs or abs(round(freq, 1) - freq) > 1e-6:
+                    return None
+                return freqs.index(round(freq, 1)), round(freq, 1), min(max_dr, max(0, dr - offsets[offset]))
+            return formula
+
+        formulas = {'US915': (us915, 902.0, 928.0, 4),
+                    'AU915': (au915, 915.0, 928.0, 6),
+                    'EU868': (plan([868.1, 868.3, 868.5, 867.1, 867.3, 867.5, 867.7, 867.9], 7, range(0, 6)), 863.0, 870.0, 6),
+                    'AS923': (plan([923.2, 923.4, 922.0, 922.2, 922.4, 922.6, 922.8, 923.0], 5, [0, 1, 2, 3, 4, 5, -1, -2]), 915.0, 928.0, 8)}
+        self.assertTrue(sorted(formulas) == region.SUPPORTED)
+        logging.getLogger('harness.lwregion').disabled = True
+        try:
+            for name, (formula, start, end, nb_offsets) in formulas.items():
+                r = region.get(name)
+                nb_channels = 0
+                for i in range(0, int(round((end - start) * 10)) + 1):
+                    freq = round(start + i * 0.1, 1)
+                    for dr in range(0, 16):
+                        expected = formula(freq, dr, 0)
+                        self.assertTrue(r.tx_channel(freq, dr) == (expected[0] if expected else None))
+                        nb_channels += expected is not None and dr == r.sf2txdr(r.dr2sf(dr))
+                        if expected:
+                            self.assertTrue(r.lookup(freq, r.dr2sf(dr)) == (expected[0], dr, r.get_uplink(freq, dr).rx1))
+                        for offset in range(0, nb_offsets):
+                            expected = formula(freq, dr, offset)
+                            expected = region.RxConf(expected[1], expected[2]) if expected else None
+                            self.assertTrue(r.get_rx1_conf(freq, dr, offset) == expected)
+                            if expected:
+                                self.assertTrue(r.dr2sf(expected.dr) is not None)
+                self.assertTrue(nb_channels > 0)
+                self.assertTrue(r.dr2sf(r.get_rx2_conf().dr) is not None)
+                self.assertTrue(r.sf2txdr('SF7BW125') is not None and r.sf2txdr('SF13BW125') is None)
+                self.assertTrue(r.dr2sf(16) is None and r.dr2sf(-1) is None)
+        finally:
+            logging.getLogger('harness.lwregion').disabled = False
+
+    def test_server_gateway_table(self):
+        server = packet_forwarder_server.Server("localhost", 0, "US915")
+        server_addr = server.socket_up.getsockname()
+        gw_socks = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for i in range(0, 2)]
+        macs = [binascii.unhexlify('0000000000000001'), binascii.unhexlify('0000000000000002')]
+        for sock, mac in zip(gw_socks, macs):
+            sock.bind(("localhost", 0))
+            sock.settimeout(1)
+            msg = struct.pack('<BHB', 2, 1, packet_forwarder_server.PULL_DATA) + mac
+            server.receive(msg, sock.getsockname())
+            ack = sock.recv(1024)
+            self.assertTrue(ord(ack[3]) == packet_forwarder_server.PULL_ACK)
+
+        self.assertTrue(len(server.gateways) == 2)
+        for sock, mac in zip(gw_socks, macs):
+            gateway = server.gateways[mac]
+            self.assertTrue(gateway.pull_dest_addr == sock.getsockname())
+
+        # downlink goes out through the gateway that received the uplink
+        rxpk = {'data': 'AA==', 'freq': 902.3, 'datr': 'SF10BW125', 'tmst': 0}
+        pkt = packet_forwarder_server.RxPacket(2, rxpk, server.gateways[macs[1]])
+        self.assertTrue(server.transmit('\x20', 5000000, region.RxConf(923.3, 10), pkt))
+        msg = gw_socks[1].recv(1024)
+        self.assertTrue(ord(msg[3]) == packet_forwarder_server.PULL_RESP)
+        self.assertTrue(server.gateways[macs[1]].counter[packet_forwarder_server.PULL_RESP_CNT] == 1)
+        self.assertTrue(server.gateways[macs[0]].counter[packet_forwarder_server.PULL_RESP_CNT] == 0)
+
+        for sock in gw_socks:
+            sock.close()
+        server.socket_up.close()
+
+    def test_push_data_fast_path(self):
+        server = packet_forwarder_server.Server("localhost", 0, "US915")
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(("localhost", 0))
+        sock.settimeout(1)
+        mac = '\x00' * 7 + '\x01'
+        received = []
+        server.rx_handler = received.append
+        server.receive(struct.pack('<BHB', 2, 1, packet_forwarder_server.PULL_DATA) + mac, sock.getsockname())
+        sock.recv(1024)
+
+        # stat only datagrams are acknowledged without being decoded
+        stat = json.dumps({'stat': {'time': '2014-01-12 08:59:28 GMT', 'rxnb': 2, 'rxok': 2}})
+        server.receive(struct.pack('<BHB', 2, 2, packet_forwarder_server.PUSH_DATA) + mac + stat, sock.getsockname())
+        self.assertTrue(ord(sock.recv(1024)[3]) == packet_forwarder_server.PUSH_ACK)
+        self.assertTrue(server.counter[packet_forwarder_server.STAT_ONLY_CNT] == 1)
+
+        frame = binascii.unhexlify('00efbe0100000c250003030000010c25008e4aa15c1e3c')
+        rxpk = {'tmst': 1000, 'freq': 902.7, 'datr': 'SF10BW125', 'data': binascii.b2a_base64(frame).strip()}
+        server.receive(struct.pack('<BHB', 2, 3, packet_forwarder_server.PUSH_DATA) + mac + json.dumps({'rxpk': [rxpk], 'stat': {}}),
+                       sock.getsockname())
+        sock.recv(1024)
+        self.assertTrue(len(received) == 1 and received[0].DevNonce == 0x4a8e and received[0].freq == 902.7)
+
+        # PULL_RESP rendered from the gateway template
+        frame = '\x20' + '\xa5' * 60
+        self.assertTrue(server.transmit(frame, 5001000, region.RxConf(923.9, 10), received[0]))
+        txpk = json.loads(sock.recv(1024)[4:])['txpk']
+        self.assertTrue(txpk == {'tmst': 5001000, 'freq': 923.9, 'rfch': 0, 'powe': 20, 'ant': 0, 'modu': 'LORA',
+                                 'datr': 'SF10BW500', 'codr': '4/5', 'ipol': True, 'size': len(frame),
+                                 'data': binascii.b2a_base64(frame).strip()})
+        sock.close()
+        server.socket_up.close()
+
+    def test_rxpk_dedup(self):
+        server = packet_forwarder_server.Server("localhost", 0, "US915")
+        server.dedup = dedup.DedupCache(0.2, 2)
+        received = []
+        server.rx_handler = received.append
+        socks = []
+        for i in range(0, 3):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(("localhost", 0))
+            socks.append(sock)
+
+        frame = binascii.unhexlify('00efbe0100000c250003030000010c25008e4aa15c1e3c')
+        def push_data(sock, rssi, now, data=frame):
+            rxpk = {'tmst': 1000, 'freq': 902.3, 'datr': 'SF10BW125', 'rssi': rssi, 'lsnr': 5.0,
+                    'data': binascii.b2a_base64(data).strip()}
+            mac = struct.pack('>Q', socks.index(sock))
+            server.receive(struct.pack('<BHB', 2, 1, packet_forwarder_server.PUSH_DATA) + mac + json.dumps({'rxpk': [rxpk]}),
+                           sock.getsockname(), now)
+
+        now = time.time()
+        push_data(socks[0], -100, now)
+        push_data(socks[1], -60, now + 0.05)
+        push_data(socks[2], -80, now + 0.1)
+        server.release_packets()
+        self.assertTrue(received == [] and server.counter[packet_forwarder_server.DUPLICATE_CNT] == 2)
+        self.assertTrue(0 < server.release_timeout() <= 0.2)
+
+        # best copy released once the window ends, late copies are dropped
+        self.assertTrue(len(server.dedup.release(now + 0.25)) == 1)
+        push_data(socks[0], -50, now + 0.3)
+        self.assertTrue(server.dedup.release(now + 0.35) == [])
+        self.assertTrue(len(server.dedup.release(now + 0.45)) == 0 and len(server.dedup) == 0)
+
+        push_data(socks[0], -100, now)
+        push_data(socks[1], -60, now)
+        time.sleep(0.25)
+        server.release_packets()
+        self.assertTrue(len(received) == 1 and received[0].gateway.mac == struct.pack('>Q', 1))
+
+        # bounded: the oldest frame is released early
+        for i in range(0, 3):
+            push_data(socks[0], -100, time.time(), frame[:-1] + chr(i))
+        self.assertTrue(len(server.dedup.release(time.time())) == 1 and len(server.dedup) == 2)
+        for sock in socks:
+            sock.close()
+        server.socket_up.close()
+
+    def test_server_rx_queue_drop(self):
+        server = packet_forwarder_server.Server("localhost", 0, "US915")
+        server.start_receiver(1)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        msg = struct.pack('<BHB', 2, 1, packet_forwarder_server.PULL_DATA) + '\x00' * 8
+        for i in range(0, 3):
+            sock.sendto(msg, server.socket_up.getsockname())
+
+        deadline = time.time() + 1
+        while server.counter[packet_forwarder_server.QUEUE_DROP_CNT] < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(server.queue_depth == 1)
+        self.assertTrue(server.counter[packet_forwarder_server.QUEUE_DROP_CNT] == 2)
+        self.assertTrue(server.counter[packet_forwarder_server.QUEUE_MAX_DEPTH_CNT] == 1)
+        sock.close()
+
+    def test_sharded_server_dispatch(self):
+        server = packet_forwarder_server.ShardedServer("localhost", 0, "US915", 3, lambda pkt: pkt.DevAddr)
+        gateway = server.get_gateway('\x00' * 8)
+        for devaddr in range(0, 6):
+            data = struct.pack('<BIBH', packet.UNCONFIRMED_UL_MTYPE << 5, devaddr, 0, 1) + '\x00' * 4
+            rxpk = {'data': binascii.b2a_base64(data).strip(), 'freq': 902.3, 'datr': 'SF10BW125', 'tmst': 0}
+            server.dispatch(packet_forwarder_server.RxPacket(2, rxpk, gateway))
+
+        for index in range(0, 3):
+            for i in range(0, 2):
+                _cmd, _version, mac, _addr, rxpk, _rx_time = server.worker_queues[index].get(timeout=1)
+                pkt = packet.Packet(binascii.a2b_base64(rxpk['data']))
+                self.assertTrue(pkt.DevAddr % 3 == index)
+
+        # TX_ACK goes to the worker that sent the PULL_RESP token
+        server.downlink_ack(gateway, 3 * 7 + 2, 'TOO_LATE')
+        cmd, _version, _mac, _addr, ack, _rx_time = server.worker_queues[2].get(timeout=1)
+        self.assertTrue(cmd == packet_forwarder_server.TX_ACK and ack == (23, 'TOO_LATE'))
+        server.socket_up.close()
+
+    def test_reuseport_server(self):
+        # join-requests go to worker 1, whatever socket they reach
+        server = packet_forwarder_server.ReusePortServer("localhost", 0, "US915", 2, lambda pkt: 1, rcvbuf=65536)
+        self.assertTrue(len(set(sock.getsockname() for sock in server.sockets)) == 1)
+        self.assertTrue(server.sockets[1].getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) >= 65536)
+        gw_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        gw_sock.bind(("localhost", 0))
+        mac = '\x01' * 8
+
+        # worker 0 acknowledges the PULL_DATA and broadcasts the pull address
+        server.bind_worker(0)
+        server.receive(struct.pack('<BHB', 2, 1, packet_forwarder_server.PULL_DATA) + mac, gw_sock.getsockname())
+        self.assertTrue(ord(gw_sock.recv(64)[3]) == packet_forwarder_server.PULL_ACK)
+        # TX_ACK of a worker 1 token is forwarded
+        server.receive(struct.pack('<BHB', 2, 7, packet_forwarder_server.TX_ACK) + mac, gw_sock.getsockname())
+        self.assertTrue(server.gateways[mac].counter[packet_forwarder_server.TX_ACK_CNT] == 0)
+
+        server.bind_worker(1)
+        server.forwarded(server.channels[1][0].recv(2048))
+        self.assertTrue(server.get_gateway(mac).pull_dest_addr == gw_sock.getsockname())
+        server.forwarded(server.channels[1][0].recv(2048))
+        self.assertTrue(server.gateways[mac].counter[packet_forwarder_server.TX_ACK_CNT] == 1)
+
+        # the rxpk of a PUSH_DATA received by worker 0 is handled by worker 1, with the copy of another gateway
+        received = []
+        server.rx_handler = received.append
+        server.dedup = dedup.DedupCache(0.2, 16)
+        frame = binascii.unhexlify('00efbe0100000c250003030000010c25008e4aa15c1e3c')
+        def push_data(mac, rssi, now):
+            rxpk = {'tmst': 1000, 'freq': 902.3, 'datr': 'SF10BW125', 'rssi': rssi, 'lsnr': 5.0,
+                    'data': binascii.b2a_base64(frame).strip()}
+            server.receive(struct.pack('<BHB', 2, 3, packet_forwarder_server.PUSH_DATA) + mac + json.dumps({'rxpk': [rxpk]}),
+                           gw_sock.getsockname(), now)
+            self.assertTrue(ord(gw_sock.recv(64)[3]) == packet_forwarder_server.PUSH_ACK)
+        now = time.time()
+        server.bind_worker(0)
+        push_data(mac, -100, now)
+        self.assertTrue(len(server.dedup) == 0)
+        server.bind_worker(1)
+        push_data('\x02' * 8, -60, now)
+        server.forwarded(server.channels[1][0].recv(2048))
+        self.assertTrue(len(server.dedup) == 1 and server.counter[packet_forwarder_server.DUPLICATE_CNT] == 1)
+        released = server.dedup.release(now + 0.25)
+        self.assertTrue(len(released) == 1 and released[0].gateway.mac == '\x02' * 8)
+
+        if os.path.exists(packet_forwarder_server.PROC_NET_UDP[0]):
+            self.assertTrue(packet_forwarder_server.udp_drops(server.local_port) == 0)
+        for sock in server.sockets + [gw_sock]:
+            sock.close()
+
+    def test_udp_drops(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'udp')
+            with open(path, 'w') as f:
+                f.write("   sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode ref pointer drops\n")
+                for port, drops in [(1780, 12), (1780, 3), (1781, 100)]:
+                    f.write("  1: 0100007F:%04X 00000000:0000 07 00000000:00000000 00:00000000 00000000     0        0 1234 2 0000000000000000 %d\n" % (port, drops))
+            self.assertTrue(packet_forwarder_server.udp_drops(1780, [path]) == 15)
+            self.assertTrue(packet_forwarder_server.udp_drops(1780, [os.path.join(tmpdir, 'none')]) is None)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_trace_replay(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'pf.trace')
+            writer = capture.TraceWriter(path, 4096)
+            mac = '\x02' * 8
+            addr = ('127.0.0.1', 1700)
+            frame = binascii.unhexlify('00efbe0100000c250003030000010c25008e4aa15c1e3c')
+            rxpk = {'tmst': 1000, 'freq': 902.3, 'datr': 'SF10BW125', 'rssi': -60, 'lsnr': 5.0,
+                    'data': binascii.b2a_base64(frame).strip()}
+            writer.rx(addr, struct.pack('<BHB', 2, 1, packet_forwarder_server.PULL_DATA) + mac)
+            writer.tx(addr, struct.pack('<BHB', 2, 1, packet_forwarder_server.PULL_ACK))
+            writer.rx(addr, struct.pack('<BHB', 2, 2, packet_forwarder_server.PUSH_DATA) + mac + json.dumps({'rxpk': [rxpk]}))
+            writer.close()
+            records = list(capture.read_trace(path))
+            self.assertTrue([record[1] for record in records] == [capture.RX, capture.TX, capture.RX])
+            self.assertTrue(records[0][2] == addr and records[0][0] <= records[2][0])
+
+            # an existing trace is not truncated, the next one gets a new name
+            writer = capture.TraceWriter(path, 4096)
+            writer.close()
+            self.assertTrue(writer.path != path and os.path.dirname(writer.path) == tmpdir and writer.path.endswith('.trace'))
+            self.assertTrue(len(list(capture.read_trace(path))) == 3 and list(capture.read_trace(writer.path)) == [])
+            worker = writer.reopen(1)
+            worker.close()
+            self.assertTrue(worker.path == writer.path + '.1')
+
+            # replayed on the synthetic clock: packets are received at the trace time
+            server = capture.ReplayServer("US915")
+            server.dedup = dedup.DedupCache(0.2)
+            received = []
+            self.assertTrue(server.replay(received.append, path)[0] == 2)
+            self.assertTrue(len(received) == 1 and received[0].rx_time == records[2][0])
+            self.assertTrue(server.sent == 2 and server.gateways[mac].pull_dest_addr == addr)
+            self.assertTrue(packet_forwarder_server.clock is time.time)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_timing_wheel(self):
+        wheel = timerwheel.TimingWheel(1.0, (4, 4))
+        now = 1000.0
+        # level 0, level 1 and overflow timers
+        deadlines = [1001.5, 1003.0, 1007.2, 1015.9, 1040.0, 1016.0]
+        timers = [wheel.schedule(deadline, i, now) for i, deadline in enumerate(deadlines)]
+        wheel.cancel(timers[5])
+        wheel.cancel(timers[5])
+        self.assertTrue(len(wheel) == 5 and wheel.next_tick() == 1001.0)
+
+        expired = {}
+        while len(wheel):
+            now += 0.5
+            for i in wheel.advance(now):
+                expired[i] = now
+        for i, deadline in enumerate(deadlines[:5]):
+            self.assertTrue(deadline <= expired[i] < deadline + 1.0)
+        self.assertTrue(5 not in expired and wheel.next_tick() is None)
+        # idle wheel catches up without walking the ticks
+        self.assertTrue(wheel.advance(now + 1e6) == [] and wheel.current == int(now + 1e6))
+
+    def test_server_timers(self):
+        server = packet_forwarder_server.Server("localhost", 0, "US915")
+        server.timers = timerwheel.TimingWheel(0.01)
+        expired = []
+        server.timer_handler = expired.extend
+        now = time.time()
+        server.timers.schedule(now + 0.02, 'join', now)
+        self.assertTrue(0 < server.release_timeout() <= 0.01)
+        time.sleep(0.04)
+        server.release_packets()
+        self.assertTrue(expired == ['join'] and server.release_timeout() is None)
+        server.socket_up.close()
+
+    def test_devaddr_pool(self):
+        # type 0 NetID 000013: '0' prefix, NwkID 0x13, 25 bit NwkAddr
+        self.assertTrue(devaddrpool.devaddr_prefix(0x000013) == 0x26000000)
+        # type 3 NetID 600005: '1110' prefix, 11 bit NwkID, 17 bit NwkAddr
+        self.assertTrue(devaddrpool.devaddr_prefix(0x600005) == 0xE00A0000)
+        self.assertTrue(devaddrpool.nwkaddr(0xE00A1234) == 0x1234 and devaddrpool.nwkaddr(0x26001234) == 0x1234)
+
+        pool = devaddrpool.DevAddrPool(0x000013, 2, 8, 3)
+        devaddrs = [pool.allocate() for i in range(0, 3)]
+        self.assertTrue(devaddrs == [0x26000002, 0x26000005, 0x26000008])
+        self.assertTrue(pool.allocate() is None and len(pool) == 3)
+        self.assertTrue(pool.release(0x26000005) and not pool.release(0x26000005))
+        self.assertTrue(not pool.release(0x26000003) and not pool.release(0x00000005))
+        self.assertTrue(pool.allocate() == 0x26000005 and pool.allocate() is None)
+
+        # a released address is reused once the others were, released ones in release order
+        pool = devaddrpool.DevAddrPool(0x000013, 1, 4)
+        first = pool.allocate()
+        pool.release(first)
+        self.assertTrue([pool.allocate() for i in range(0, 4)] == [0x26000002, 0x26000003, 0x26000004, first])
+        self.assertTrue(pool.release(0x26000003) and pool.release(first) and len(pool) == 2)
+        self.assertTrue([pool.allocate() for i in range(0, 3)] == [0x26000003, first, None])
+        self.assertRaises(ValueError, devaddrpool.DevAddrPool, 0x600005, 1, 1 << 17)
+
+    def test_gateway_token_partition(self):
+        gateways = [packet_forwarder_server.Gateway('\x00' * 8, index, 4) for index in range(0, 4)]
+        tokens = set()
+        for gateway in gateways:
+            for i in range(0, 100):
+                tokens.add(gateway.next_pull_response_token())
+        self.assertTrue(len(tokens) == 400)
+
+    def test_downlink_scheduler(self):
+        self.assertTrue(downlink.time_on_air_us('SF7BW125', 13, crc=True) == 46335)
+        self.assertTrue(downlink.time_on_air_us('SF12BW125', 17, crc=True) == 1318911)
+        self.assertTrue(downlink.tmst_diff(5, 0xFFFFFFFF) == 6)
+
+        server = packet_forwarder_server.Server("localhost", 0, "US915")
+        gateway = server.get_gateway('\x00' * 8)
+        rxpk = {'data': 'AA==', 'freq': 902.3, 'datr': 'SF10BW125', 'tmst': 1000}
+        windows = [(1, region.RxConf(923.3, 10), 5001000), (2, region.RxConf(923.3, 8), 6001000)]
+        pkt = packet_forwarder_server.RxPacket(2, rxpk, gateway, time.time())
+        self.assertTrue(server.schedule_downlink(pkt, windows, 17)[0] == 1)
+        # RX1 collides with the first downlink, falls back to RX2
+        self.assertTrue(server.schedule_downlink(pkt, windows, 17)[0] == 2)
+        self.assertTrue(server.schedule_downlink(pkt, windows, 17) is None)
+        self.assertTrue(server.counter[packet_forwarder_server.DOWNLINK_SAVED_CNT] == 1)
+        self.assertTrue(server.counter[packet_forwarder_server.DOWNLINK_LOST_COLLISION_CNT] == 1)
+
+        # received 5.5s ago, RX1 is too late
+        pkt = packet_forwarder_server.RxPacket(2, dict(rxpk, tmst=10000000), gateway, time.time() - 5.5)
+        windows = [(1, region.RxConf(923.3, 10), 15000000), (2, region.RxConf(923.3, 8), 16000000)]
+        self.assertTrue(server.schedule_downlink(pkt, windows, 17)[0] == 2)
+        self.assertTrue(len(gateway.scheduler) == 1)
+        self.assertTrue(server.counter[packet_forwarder_server.DOWNLINK_SAVED_CNT] == 2)
+        # a downlink not sent frees the radio
+        server.cancel_downlink(pkt, windows[1])
+        self.assertTrue(len(gateway.scheduler) == 0 and server.schedule_downlink(pkt, windows, 17)[0] == 2)
+        server.socket_up.close()
+
+    def test_tx_ack_retry(self):
+        server = packet_forwarder_server.Server("localhost", 0, "US915")
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(("localhost", 0))
+        sock.settimeout(1)
+        mac = '\x00' * 7 + '\x01'
+        server.receive(struct.pack('<BHB', 2, 1, packet_forwarder_server.PULL_DATA) + mac, sock.getsockname())
+        sock.recv(1024)
+        gateway = server.gateways[mac]
+
+        rxpk = {'data': 'AA==', 'freq': 902.3, 'datr': 'SF10BW125', 'tmst': 1000}
+        pkt = packet_forwarder_server.RxPacket(2, rxpk, gateway, time.time())
+        windows = [(1, region.RxConf(923.3, 10), 5001000), (2, region.RxConf(923.3, 8), 6001000)]
+        server.schedule_downlink(pkt, windows, 17)
+        self.assertTrue(server.transmit('\x20' * 17, 5001000, windows[0][1], pkt, windows[1:], 'device'))
+        msg = sock.recv(1024)
+        self.assertTrue(len(gateway.outstanding) == 1)
+
+        # gateway jit queue rejects RX1, the join-accept goes out on RX2
+        retried = []
+        server.retry_handler = lambda context, window: retried.append((context, window))
+        ack = json.dumps({'txpk_ack': {'error': 'COLLISION_PACKET'}})
+        server.receive(msg[:3] + chr(packet_forwarder_server.TX_ACK) + mac + ack, sock.getsockname())
+        msg = sock.recv(1024)
+        self.assertTrue(json.loads(msg[4:])['txpk']['tmst'] == 6001000)
+        self.assertTrue(retried == [('device', windows[1])])
+        self.assertTrue(server.counter[packet_forwarder_server.DOWNLINK_RETRY_CNT] == 1)
+        self.assertTrue(len(gateway.scheduler) == 1)
+
+        # no retry window left
+        server.receive(msg[:3] + chr(packet_forwarder_server.TX_ACK) + mac + ack, sock.getsockname())
+        self.assertTrue(len(gateway.outstanding) == 0)
+        self.assertTrue(server.counter[packet_forwarder_server.DOWNLINK_RETRY_CNT] == 1)
+        self.assertTrue(server.counter[packet_forwarder_server.TX_ACK_ERROR_CNT] == 2)
+        self.assertTrue(retried[1:] == [('device', None)])
+
+        server.transmit('\x20' * 17, 7001000, windows[0][1], pkt)
+        sock.recv(1024)
+        server.expire_tx_acks(time.time() + server.tx_ack_timeout + 1)
+        self.assertTrue(len(gateway.outstanding) == 0)
+        self.assertTrue(server.counter[packet_forwarder_server.TX_ACK_TIMEOUT_CNT] == 1)
+        sock.close()
+        server.socket_up.close()
+
+class StubForwarder(object):
+    """ Packet forwarder server of the harness tests, keeps the transmitted frames """
+    def __init__(self):
+        self.accept = True
+        self.frames = []
+        # txtmst of the booked windows
+        self.booked = []
+
+    def schedule_downlink(self, pkt, windows, size):
+        self.booked.append(windows[0][2])
+        return windows[0]
+
+    def cancel_downlink(self, pkt, window):
+        self.booked.remove(window[2])
+
+    def transmit(self, frame, txtmst, rxconf, pkt, retry_windows=(), context=None):
+        if self.accept:
+            self.frames.append(frame)
+            self.context = context
+        return self.accept
+
+class TestHarness(unittest.TestCase):
+    """ harness.py packet handlers on a stub packet forwarder """
+    JOINEUI = '70B3D57ED0000001'
+
+    @classmethod
+    def setUpClass(cls):
+        # the harness opens test.log in the working directory when imported
+        cls.tmpdir = tempfile.mkdtemp()
+        cwd = os.getcwd()
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        os.chdir(cls.tmpdir)
+        try:
+            import harness
+        finally:
+            sys.path.pop(0)
+            os.chdir(cwd)
+        for handler in list(harness.logger.handlers):
+            harness.logger.removeHandler(handler)
+            handler.close()
+        harness.logger.addHandler(logging.NullHandler())
+        cls.harness = harness
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def setUp(self):
+        harness = self.harness
+        harness.forwarder = self.forwarder = StubForwarder()
+        harness.lw_region = region.get('US915')
+        harness.join_timeouts = timerwheel.TimingWheel()
+        harness.join_accept_precompute = None
+        harness.devaddr_range = harness.DEVADDR_RANGE_DEFAULT
+        harness.devaddr_shard = (0, 1)
+        harness.devaddr_pools.clear()
+        harness.devaddr_index.clear()
+        harness.appdb.clear()
+        del harness.pending_reloads[:]
+        for name in harness.counter:
+            harness.counter[name] = 0
+        self.app = harness.Application(self.JOINEUI)
+        self.app.import_devices(self.JOINEUI, self.device_file([(1, 0x11), (2, 0x22)]))
+        harness.appdb[binascii.unhexlify(self.JOINEUI)] = self.app
+
+    def device_file(self, devices, joineui=JOINEUI):
+        """ Device file of joineui with the (deveui, appkey) integers """
+        path = os.path.join(self.tmpdir, joineui + '.csv')
+        if os.path.exists(devicestore.store_path(path)):
+            os.remove(devicestore.store_path(path))
+        with open(path, 'w') as f:
+            f.write('DEVEUI,APPKEY\n')
+            for deveui, appkey in devices:
+                f.write('%016X,%032X\n' % (deveui, appkey))
+        return path
+
+    def device(self, deveui):
+        return self.app.deveui2device(struct.pack('>Q', deveui))
+
+    def join_request(self, deveui, appkey, devnonce=1):
+        frame = packet.encode_join_request_frame(self.JOINEUI, '%016X' % deveui, devnonce, struct.pack('>QQ', 0, appkey))
+        rxpk = {'tmst': 1000000, 'freq': 902.3, 'datr': 'SF10BW125', 'data': binascii.b2a_base64(frame).strip()}
+        return self.harness.packet_forwarder_server.RxPacket(2, rxpk, None, self.harness.packet_forwarder_server.clock())
+
+    def uplink(self, device, nwkskey=None, devaddr=None):
+        """ First uplink of the device session, with a wrong MIC when nwkskey is given """
+        if nwkskey is None:
+            session = device.session
+            nwkskey = crypto.compute_nwk_skey(session.appnonce, self.app.netid, session.devnonce, device.appkey)
+        frame = loadgen.encode_uplink_frame(devaddr or device.devaddr, 1, nwkskey)
+        rxpk = {'tmst': 2000000, 'freq': 902.3, 'datr': 'SF10BW125', 'data': binascii.b2a_base64(frame).strip()}
+        return self.harness.packet_forwarder_server.RxPacket(2, rxpk, None, self.harness.packet_forwarder_server.clock())
+
+    def state(self, deveui):
+        result = self.device(deveui).result
+        return result.state if result is not None else None
+
+    def test_harness_test_steps(self):
+        harness = self.harness
+        device = self.device(1)
+        # a device is not tested before its join-request
+        harness.test_step(self.app, device, harness.OTAA_SUCCESS_STATE, 1.0)
+        self.assertTrue(device.result is None and self.app.summary() == {'pending': 0, 'passed': 0, 'failed': 0, 'untested': 2})
+
+        harness.rx_handler(self.join_request(1, 0x11))
+        self.assertTrue(self.state(1) == harness.JOIN_ACCEPT_STATE and device.result.attempts == 1)
+        self.assertTrue(self.app.summary() == {'pending': 1, 'passed': 0, 'failed': 0, 'untested': 1})
+        harness.rx_handler(self.uplink(device))
+        self.assertTrue(self.state(1) == harness.OTAA_SUCCESS_STATE and not device.joining)
+        self.assertTrue(harness.counter[harness.OTAA_SUCCESS_CNT] == 1)
+        # join-accept steps are only taken after a join-request
+        harness.test_step(self.app, device, harness.JOIN_ACCEPT_LOST_STATE, 2.0)
+        harness.test_step(self.app, device, harness.MIC_FAILED_STATE, 3.0)
+        self.assertTrue(self.state(1) == harness.OTAA_SUCCESS_STATE and device.result.end_time is not None)
+
+        # another attempt, the verdict is the one of the last attempt
+        harness.rx_handler(self.join_request(1, 0x11, 2))
+        harness.rx_handler(self.uplink(device, '\x00' * 16))
+        self.assertTrue(self.state(1) == harness.MIC_FAILED_STATE and device.result.attempts == 2)
+        self.assertTrue(harness.counter[harness.MIC_FAILED_CNT] == 1)
+        self.assertTrue(self.app.summary() == {'pending': 0, 'passed': 0, 'failed': 1, 'untested': 1})
+
+    def test_harness_join_accept_lost(self):
+        harness = self.harness
+        pool = harness.devaddr_pool(self.app.netid)
+
+        # join-accept not sent to the packet forwarder
+        self.forwarder.accept = False
+        harness.rx_handler(self.join_request(1, 0x11))
+        self.assertTrue(self.state(1) == harness.JOIN_ACCEPT_LOST_STATE and not self.device(1).joining)
+        self.assertTrue(len(pool) == 0 and self.app.summary()['failed'] == 1)
+
+        # no DevAddr left
+        self.forwarder.accept = True
+        harness.devaddr_range = (1, 1)
+        harness.devaddr_pools.clear()
+        harness.rx_handler(self.join_request(1, 0x11, 2))
+        harness.rx_handler(self.join_request(2, 0x22))
+        self.assertTrue(self.state(1) == harness.JOIN_ACCEPT_STATE and self.state(2) == harness.JOIN_ACCEPT_LOST_STATE)
+        self.assertTrue(harness.counter[harness.DEVADDR_EXHAUSTED_CNT] == 1 and len(self.forwarder.frames) == 1)
+        # the window booked for the join-accept not sent is free again
+        self.assertTrue(len(self.forwarder.booked) == 2)
+        harness.rx_batch_handler([self.join_request(2, 0x22, 2), self.join_request(2, 0x22, 3)])
+        self.assertTrue(len(self.forwarder.booked) == 2 and harness.counter[harness.DEVADDR_EXHAUSTED_CNT] == 3)
+        self.assertTrue(self.app.summary() == {'pending': 1, 'passed': 0, 'failed': 1, 'untested': 0})
+
+        # a session left without join-accept fails when it expires
+        device = self.device(2)
+        harness.test_step(self.app, device, harness.JOIN_REQUEST_STATE, 1.0)
+        harness.devaddr_range = (1, None)
+        harness.devaddr_pools.clear()
+        self.assertTrue(self.app.set_device_session(device, 1, 1))
+        harness.join_timeout_handler([(self.app, device)])
+        self.assertTrue(self.state(2) == harness.JOIN_ACCEPT_LOST_STATE and not device.joining)
+
+    def test_harness_join_accept_retry(self):
+        harness = self.harness
+        harness.rx_handler(self.join_request(1, 0x11))
+        harness.rx_handler(self.join_request(2, 0x22))
+        devices = [self.device(1), self.device(2)]
+        context = self.forwarder.context
+        self.assertTrue(context == (self.app, devices[1], devices[1].session) and devices[1].result.rxslot == 1)
+
+        # rejected on RX1, sent again on RX2: the result has the window used
+        rx2 = harness.join_accept_windows(self.join_request(2, 0x22), harness.lw_region.lookup(902.3, 'SF10BW125'))[1]
+        harness.join_accept_retried(context, rx2)
+        self.assertTrue(self.state(2) == harness.JOIN_ACCEPT_STATE and devices[1].result.rxslot == 2)
+        self.assertTrue(self.app.summary()['pending'] == 2)
+        # rejected again, no window left
+        harness.join_accept_retried(context, None)
+        self.assertTrue(self.state(2) == harness.JOIN_ACCEPT_LOST_STATE and not devices[1].joining)
+        # a reject of an attempt over is ignored
+        harness.rx_handler(self.uplink(devices[0]))
+        harness.join_accept_retried((self.app, devices[0], None), None)
+        self.assertTrue(self.state(1) == harness.OTAA_SUCCESS_STATE)
+
+    def test_harness_devaddr_index(self):
+        harness = self.harness
+        app = harness.Application('70B3D57ED0000002')
+        app.import_devices('70B3D57ED0000002', self.device_file([(1, 0x11)], '70B3D57ED0000002'))
+        harness.appdb[binascii.unhexlify('70B3D57ED0000002')] = app
+        harness.rx_handler(self.join_request(1, 0x11))
+        device = self.device(1)
+        other = app.deveui2device(struct.pack('>Q', 1))
+        app.new_device_session(other, 1)
+        # one index for the sessions of all the applications
+        self.assertTrue(harness.devaddr_index == {device.devaddr: (self.app, device), other.devaddr: (app, other)})
+        self.assertTrue(self.app.devaddr2device(device.devaddr) is device and app.devaddr2device(device.devaddr) is None)
+
+        # a new join-request replaces the DevAddr of the session
+        devaddr = device.devaddr
+        harness.rx_handler(self.join_request(1, 0x11, 2))
+        self.assertTrue(device.devaddr != devaddr and devaddr not in harness.devaddr_index and len(harness.devaddr_index) == 2)
+        harness.rx_handler(self.uplink(device, '\x00' * 16, devaddr))
+        self.assertTrue(self.state(1) == harness.JOIN_ACCEPT_STATE)
+        harness.rx_handler(self.uplink(device))
+        self.assertTrue(self.state(1) == harness.OTAA_SUCCESS_STATE and harness.devaddr_index == {other.devaddr: (app, other)})
+
+    def test_harness_device_on_demand(self):
+        harness = self.harness
+        # devices stay in the store until their first join-request
+        self.assertTrue(self.app.devices == {} and self.app.nb_devices == 2)
+        self.assertTrue(self.app.deveui2device(struct.pack('>Q', 3)) is None and self.app.devices == {})
+        harness.rx_handler(self.join_request(3, 0x33))
+        self.assertTrue(harness.counter[harness.UNKNOWN_DEVEUI_CNT] == 1 and self.app.devices == {})
+        harness.rx_handler(self.join_request(1, 0x11))
+        device = self.device(1)
+        self.assertTrue(self.app.devices == {device.deveui: device} and self.device(1) is device)
+        self.assertTrue(device.appkey == struct.pack('>QQ', 0, 0x11) and not hasattr(device, '__dict__'))
+        # the session is freed once the device passed, the result is kept
+        self.assertTrue(device.joining and not hasattr(device.session, '__dict__'))
+        harness.rx_handler(self.uplink(device))
+        self.assertTrue(device.session is None and device.devaddr is None and self.state(1) == harness.OTAA_SUCCESS_STATE)
+
+    def test_harness_conf_reload(self):
+        harness = self.harness
+        pool = harness.devaddr_pool(self.app.netid)
+        reloader = harness.ConfReloader(harness.appdb)
+        harness.rx_handler(self.join_request(1, 0x11))
+        harness.rx_handler(self.join_request(2, 0x22))
+        self.assertTrue(len(pool) == 2)
+
+        # device 2 gets a new AppKey and device 3 is added, reloads are applied by the next packet
+        path = self.device_file([(1, 0x11), (2, 0x23), (3, 0x33)])
+        reloader([path], [])
+        self.assertTrue(self.app.nb_devices == 2 and len(harness.pending_reloads) == 1)
+        harness.rx_handler(self.uplink(self.device(1)))
+        self.assertTrue(self.app.nb_devices == 3 and harness.pending_reloads == [])
+        # device 1 kept its session and passed, device 2 is forgotten with its session and result
+        self.assertTrue(self.state(1) == harness.OTAA_SUCCESS_STATE and len(pool) == 0)
+        self.assertTrue(sorted(self.app.devices) == [struct.pack('>Q', 1)] and harness.devaddr_index == {})
+        self.assertTrue(self.app.summary() == {'pending': 0, 'passed': 1, 'failed': 0, 'untested': 2})
+        harness.rx_handler(self.join_request(2, 0x23))
+        harness.rx_handler(self.join_request(3, 0x33))
+        self.assertTrue(self.device(2).appkey == struct.pack('>QQ', 0, 0x23) and self.device(2).result.attempts == 1)
+        self.assertTrue(loadgen.decode_join_accept(self.forwarder.frames[-2], self.device(2).appkey)[2] == self.device(2).devaddr)
+
+        # device 3 is removed, a new JoinEUI file adds an application
+        path = self.device_file([(1, 0x11), (2, 0x23)])
+        reloader([path, self.device_file([(4, 0x44)], '70B3D57ED0000002')], [])
+        harness.apply_reloads()
+        self.assertTrue(self.app.nb_devices == 2 and self.device(3) is None and len(pool) == 1)
+        self.assertTrue(self.app.summary() == {'pending': 1, 'passed': 1, 'failed': 0, 'untested': 0})
+        app = harness.appdb[binascii.unhexlify('70B3D57ED0000002')]
+        self.assertTrue(app.nb_devices == 1 and app.store.get(struct.pack('>Q', 4)) == struct.pack('>QQ', 0, 0x44))
+
+        # a removed device file removes the application, its sessions end
+        device = self.device(2)
+        reloader([], [path])
+        harness.apply_reloads()
+        self.assertTrue(binascii.unhexlify(self.JOINEUI) not in harness.appdb and len(pool) == 0)
+        self.assertTrue(not device.joining and harness.counter[harness.CONF_RELOAD_CNT] == 4)
+
+    def test_harness_shard_key(self):
+        harness = self.harness
+        harness.devaddr_range = (100, 1000)
+        nwkskey = '\x00' * 16
+        for netid in [0x000013, 0x600005]:
+            for nb_workers in [1, 3, 4]:
+                for index in range(0, nb_workers):
+                    # the uplinks of the DevAddrs allocated by a worker are routed to it
+                    harness.devaddr_shard = (index, nb_workers)
+                    harness.devaddr_pools.clear()
+                    devaddrs = [harness.allocate_devaddr(netid) for i in range(0, 5)]
+                    self.assertTrue(devaddrpool.nwkaddr(devaddrs[0]) == 100 + index)
+                    for devaddr in devaddrs:
+                        pkt = packet.Packet(loadgen.encode_uplink_frame(devaddr, 1, nwkskey))
+                        self.assertTrue(harness.shard_key(pkt) % nb_workers == index)
+        jreq = self.join_request(1, 0x11)
+        self.assertTrue(harness.shard_key(jreq) == zlib.crc32(struct.pack('>Q', 1)) & 0xFFFFFFFF)
+
+    def test_harness_join_timeout(self):
+        harness = self.harness
+        pool = harness.devaddr_pool(self.app.netid)
+        harness.rx_handler(self.join_request(1, 0x11))
+        harness.rx_handler(self.join_request(2, 0x22))
+        devices = [self.device(1), self.device(2)]
+        devaddrs = [device.devaddr for device in devices]
+        self.assertTrue(len(pool) == 2 and len(harness.join_timeouts) == 2)
+        harness.rx_handler(self.uplink(devices[1]))
+        self.assertTrue(len(pool) == 1 and len(harness.join_timeouts) == 1)
+
+        now = harness.packet_forwarder_server.clock()
+        self.assertTrue(harness.join_timeouts.advance(now + 1) == [])
+        expired = harness.join_timeouts.advance(now + harness.join_timeout + 2)
+        self.assertTrue(expired == [(self.app, devices[0])])
+        harness.join_timeout_handler(expired)
+        self.assertTrue(self.state(1) == harness.NO_UPLINK_STATE and self.state(2) == harness.OTAA_SUCCESS_STATE)
+        self.assertTrue(harness.counter[harness.NO_UPLINK_CNT] == 1 and harness.counter[harness.JOIN_TIMEOUT_CNT] == 1)
+        # the session, its DevAddr and its index entry are released
+        self.assertTrue(not devices[0].joining and len(pool) == 0 and harness.devaddr_index == {})
+        self.assertTrue(pool.index(devaddrs[0]) is not None and not pool.release(devaddrs[0]))
+        # a late uplink is ignored
+        harness.rx_handler(self.uplink(devices[0], '\x00' * 16, devaddrs[0]))
+        self.assertTrue(self.state(1) == harness.NO_UPLINK_STATE and harness.counter[harness.MIC_FAILED_CNT] == 0)
+
+    def test_harness_prepared_join_accept(self):
+        harness = self.harness
+        harness.join_accept_precompute = harness.JoinAcceptPrecompute(10)
+        pool = harness.devaddr_pool(self.app.netid)
+
+        # preparing again replaces the entry and frees its DevAddr
+        self.app.prepare_join_accept(struct.pack('>Q', 1), struct.pack('>QQ', 0, 0x11))
+        self.app.prepare_join_accept(struct.pack('>Q', 1), struct.pack('>QQ', 0, 0x11))
+        self.assertTrue(len(pool) == 1)
+        harness.join_request_handler(self.join_request(1, 0x11))
+        device = self.device(1)
+        appnonce, netid, devaddr = loadgen.decode_join_accept(self.forwarder.frames[-1], device.appkey)
+        self.assertTrue(devaddr == device.devaddr and appnonce == device.session.appnonce)
+        self.assertTrue(harness.counter[harness.PRECOMPUTED_JOIN_ACCEPT_CNT] == 1)
+        self.assertTrue(harness.join_accept_precompute.refill.get_nowait()[1] == device.deveui)
+
+        # a frame prepared with an AppKey replaced since is discarded with its DevAddr
+        self.app.prepare_join_accept(struct.pack('>Q', 2), struct.pack('>QQ', 0, 0x22))
+        self.assertTrue(len(pool) == 2)
+        store, errors = devicestore.load(self.device_file([(1, 0x11), (2, 0x99)]))
+        self.app.reload_store(store, [])
+        harness.join_request_handler(self.join_request(2, 0x99))
+        device = self.device(2)
+        self.assertTrue(harness.counter[harness.PRECOMPUTED_JOIN_ACCEPT_CNT] == 1)
+        self.assertTrue(loadgen.decode_join_accept(self.forwarder.frames[-1], device.appkey)[2] == device.devaddr)
+        self.assertTrue(len(pool) == 2)
+
+    def test_harness_precompute_reload(self):
+        harness = self.harness
+        pool = harness.devaddr_pool(self.app.netid)
+        reloader = harness.ConfReloader(harness.appdb)
+        self.app.prepare_join_accept(struct.pack('>Q', 1), struct.pack('>QQ', 0, 0x11))
+        self.assertTrue(len(pool) == 1)
+
+        # device 1 re-keyed and device 2 removed, a join-accept prepared before is discarded
+        reloader([self.device_file([(1, 0x12)])], [])
+        harness.apply_reloads()
+        self.assertTrue(len(pool) == 0)
+        # the precompute thread, with the keys read before the reload, prepares nothing
+        self.app.prepare_join_accept(struct.pack('>Q', 1), struct.pack('>QQ', 0, 0x11))
+        self.app.prepare_join_accept(struct.pack('>Q', 2), struct.pack('>QQ', 0, 0x22))
+        self.assertTrue(len(pool) == 0)
+        self.app.prepare_join_accept(struct.pack('>Q', 1), struct.pack('>QQ', 0, 0x12))
+        self.assertTrue(len(pool) == 1)
+
+        # nor for a removed application
+        reloader([], [os.path.join(self.tmpdir, self.JOINEUI + '.csv')])
+        harness.apply_reloads()
+        self.app.prepare_join_accept(struct.pack('>Q', 1), struct.pack('>QQ', 0, 0x12))
+        self.assertTrue(len(pool) == 0 and harness.appdb == {})
+
 if __name__ == '__main__':
     unittest.main()
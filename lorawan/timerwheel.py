@@ -0,0 +1,107 @@
+""" Hierarchical timing wheel.
+
+    Level 0 has one slot per tick, each slot of level n spans a whole turn of
+    level n - 1. A timer is armed in the slot of the lowest level whose turn
+    covers its expiry and moves down a level each time a lower level wraps
+    around to its slot, timers beyond the last level wait in an overflow set.
+    Arming and cancelling are O(1), a timer is moved at most once per level
+    and expires within one tick after its deadline.
+"""
+import math
+
+TICK_DEFAULT = 1.0
+# 64s, 68min and 72h turns with 1s ticks
+SLOTS_DEFAULT = (64, 64, 64)
+
+class Timer(object):
+    __slots__ = ('expiry', 'item', 'bucket')
+
+    def __init__(self, expiry, item):
+        # tick number
+        self.expiry = expiry
+        self.item = item
+        self.bucket = None
+
+class TimingWheel(object):
+    def __init__(self, tick=TICK_DEFAULT, slots=SLOTS_DEFAULT):
+        self.tick = tick
+        self.wheels = [[set() for i in range(0, size)] for size in slots]
+        # ticks spanned by a slot of each level
+        self.spans = [1]
+        for size in slots[:-1]:
+            self.spans.append(self.spans[-1] * size)
+        self.overflow = set()
+        # last tick processed, set on first use
+        self.current = None
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def schedule(self, deadline, item, now):
+        """ Arm a timer expiring item at deadline, returns the Timer to cancel it """
+        if self.current is None:
+            self.current = int(now / self.tick)
+        timer = Timer(max(int(math.ceil(deadline / self.tick)), self.current + 1), item)
+        self.place(timer)
+        self.count += 1
+        return timer
+
+    def cancel(self, timer):
+        if timer.bucket is not None:
+            timer.bucket.discard(timer)
+            timer.bucket = None
+            self.count -= 1
+
+    def place(self, timer):
+        delta = timer.expiry - self.current
+        for wheel, span in zip(self.wheels, self.spans):
+            if delta < span * len(wheel):
+                bucket = wheel[(timer.expiry // span) % len(wheel)]
+                break
+        else:
+            bucket = self.overflow
+        bucket.add(timer)
+        timer.bucket = bucket
+
+    def next_tick(self):
+        """ Time the wheel has to be advanced to, None when no timer is armed """
+        if self.count == 0:
+            return None
+        return (self.current + 1) * self.tick
+
+    def advance(self, now):
+        """ Items of the timers expired at now """
+        now_tick = int(now / self.tick)
+        if self.current is None or self.count == 0:
+            if self.current is None or self.current < now_tick:
+                self.current = now_tick
+            return []
+        expired = []
+        wheels = self.wheels
+        spans = self.spans
+        while self.current < now_tick and self.count > 0:
+            tick = self.current = self.current + 1
+            # higher levels first, a timer can move down several levels on one tick
+            top = len(wheels) - 1
+            if tick % (spans[top] * len(wheels[top])) == 0:
+                self.cascade(self.overflow)
+            for level in range(top, 0, -1):
+                if tick % spans[level] == 0:
+                    self.cascade(wheels[level][(tick // spans[level]) % len(wheels[level])])
+            bucket = wheels[0][tick % len(wheels[0])]
+            if bucket:
+                for timer in bucket:
+                    timer.bucket = None
+                    expired.append(timer.item)
+                self.count -= len(bucket)
+                bucket.clear()
+        self.current = max(self.current, now_tick)
+        return expired
+
+    def cascade(self, bucket):
+        if bucket:
+            timers = list(bucket)
+            bucket.clear()
+            for timer in timers:
+                self.place(timer)